@@ -1,7 +1,8 @@
 import os
+import asyncio
+import threading
+import time
 from typing import Dict, Optional
-import msal
-from azure.identity import ClientSecretCredential
 import logging
 from dotenv import load_dotenv
 
@@ -16,7 +17,14 @@ class AzureAuthService:
         self.authority = None
         # Use the database scope that worked
         self.scope = ["https://database.windows.net//.default"]
+        # (client_id, scope) -> (access_token, expires_at on the monotonic clock)
         self.token_cache = {}
+        self.token_refresh_skew = 300  # refresh 5 minutes before expiry, like MSAL
+        self._app = None
+        self._token_lock = threading.Lock()
+        # (server, database) -> ODBC connection string with a %s token slot
+        self._conn_templates = {}
+        self._refresher_task: Optional[asyncio.Task] = None
         
     def configure(self, tenant_id: str, client_id: str, client_secret: str):
         """Configure OAuth2 credentials"""
@@ -25,6 +33,11 @@ class AzureAuthService:
         self.client_secret = client_secret
         self.authority = f"https://login.microsoftonline.com/{tenant_id}"
         
+        # Drop the client and tokens issued for the previous credentials
+        with self._token_lock:
+            self._app = None
+            self.token_cache.clear()
+        
     def is_configured(self) -> bool:
         """Check if OAuth2 is configured"""
         return all([self.tenant_id, self.client_id, self.client_secret])
@@ -35,24 +48,43 @@ class AzureAuthService:
             logger.error("OAuth2 not configured")
             return None
             
-        try:
-            # Create MSAL confidential client
-            app = msal.ConfidentialClientApplication(
-                self.client_id,
-                authority=self.authority,
-                client_credential=self.client_secret
-            )
+        key = (self.client_id, tuple(self.scope))
+        
+        # Fast path: serve a still-valid token from the in-memory cache
+        cached = self.token_cache.get(key)
+        if cached and cached[1] - self.token_refresh_skew > time.monotonic():
+            return cached[0]
+        
+        # Only one request refreshes; the others wait and reuse its token
+        with self._token_lock:
+            cached = self.token_cache.get(key)
+            if cached and cached[1] - self.token_refresh_skew > time.monotonic():
+                return cached[0]
             
-            # Try to get token from cache first
-            result = app.acquire_token_silent(self.scope, account=None)
+            return self._acquire_token(key)
+    
+    def _acquire_token(self, key) -> Optional[str]:
+        """Fetch a new token from AAD and cache it; caller holds _token_lock"""
+        try:
+            # Create MSAL confidential client once and reuse it
+            if self._app is None:
+                import msal
+                self._app = msal.ConfidentialClientApplication(
+                    self.client_id,
+                    authority=self.authority,
+                    client_credential=self.client_secret
+                )
             
-            if not result:
-                # Get new token
-                logger.info(f"Acquiring new token for scope: {self.scope}")
-                result = app.acquire_token_for_client(scopes=self.scope)
+            # Our own cache already missed, so go straight to the client
+            # credentials grant; a silent lookup with account=None would
+            # only rescan MSAL's cache
+            logger.info(f"Acquiring new token for scope: {self.scope}")
+            result = self._app.acquire_token_for_client(scopes=self.scope)
             
             if "access_token" in result:
                 logger.info("Successfully acquired access token")
+                expires_at = time.monotonic() + int(result.get("expires_in", 3599))
+                self.token_cache[key] = (result["access_token"], expires_at)
                 return result["access_token"]
             else:
                 error = result.get('error', 'Unknown error')
@@ -64,25 +96,73 @@ class AzureAuthService:
             logger.error(f"Error acquiring token: {str(e)}")
             return None
     
+    def _refresh_token(self):
+        """Replace the cached token even if it is still valid"""
+        if not self.is_configured():
+            return
+        with self._token_lock:
+            self._acquire_token((self.client_id, tuple(self.scope)))
+    
+    def _next_refresh_delay(self) -> float:
+        """Seconds until the refresher should renew the token"""
+        cached = None
+        if self.is_configured():
+            cached = self.token_cache.get((self.client_id, tuple(self.scope)))
+        if not cached:
+            # Nothing to renew yet (or the last attempt failed); check again shortly
+            return 60
+        # Renew a minute before requests would start treating the token as stale
+        return max(60, cached[1] - self.token_refresh_skew - 60 - time.monotonic())
+    
+    async def _refresh_tokens_forever(self):
+        """Keep the cached token warm so requests never wait on AAD"""
+        while True:
+            await asyncio.sleep(self._next_refresh_delay())
+            try:
+                # MSAL is blocking; keep it off the event loop
+                await asyncio.to_thread(self._refresh_token)
+            except Exception as e:
+                logger.error(f"Background token refresh failed: {str(e)}")
+    
+    def start_token_refresher(self):
+        """Start the background refresher on the running loop (idempotent)"""
+        if self._refresher_task is None or self._refresher_task.done():
+            self._refresher_task = asyncio.get_running_loop().create_task(self._refresh_tokens_forever())
+    
+    async def stop_token_refresher(self):
+        """Cancel the background refresher"""
+        task, self._refresher_task = self._refresher_task, None
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+    
     def get_fabric_connection_string(self, server: str, database: str) -> Optional[str]:
         """Build connection string with OAuth2 token"""
         token = self.get_access_token()
         if not token:
             return None
         
-        # Use the token in the password field with UID
-        connection_string = (
-            f"Driver={{ODBC Driver 18 for SQL Server}};"
-            f"Server={server};"
-            f"Database={database};"
-            f"UID=token;"
-            f"PWD={token};"
-            f"Encrypt=no;"
-            f"TrustServerCertificate=yes;"
-            f"Connection Timeout=30;"
-        )
+        # The fixed fields are formatted once per (server, database); each
+        # call only substitutes the token
+        template = self._conn_templates.get((server, database))
+        if template is None:
+            # Use the token in the password field with UID
+            template = (
+                "Driver={ODBC Driver 18 for SQL Server};"
+                "Server=%s;"
+                "Database=%s;"
+                "UID=token;"
+                "PWD=%%s;"
+                "Encrypt=no;"
+                "TrustServerCertificate=yes;"
+                "Connection Timeout=30;"
+            ) % (server.replace('%', '%%'), database.replace('%', '%%'))
+            self._conn_templates[(server, database)] = template
         
-        return connection_string
+        return template % token
     
     def test_configuration(self) -> Dict:
         """Test OAuth2 configuration"""
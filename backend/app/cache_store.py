@@ -0,0 +1,84 @@
+import os
+import json
+import time
+import zlib
+import sqlite3
+import logging
+import threading
+from typing import Any, Optional
+
+logger = logging.getLogger(__name__)
+
+class PersistentCache:
+    """Small SQLite-backed key/value store so caches survive process restarts"""
+    
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = None
+        try:
+            # Autocommit + WAL: each write is durable without blocking readers
+            self._conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS kv (k TEXT PRIMARY KEY, v BLOB, exp REAL)")
+        except sqlite3.Error as e:
+            logger.warning(f"Persistent cache disabled ({path}): {e}")
+            self._conn = None
+    
+    def get(self, key: str) -> Optional[Any]:
+        """Return the stored value, or None when missing or expired"""
+        if self._conn is None:
+            return None
+        try:
+            with self._lock:
+                row = self._conn.execute("SELECT v, exp FROM kv WHERE k = ?", (key,)).fetchone()
+            if row is None or row[1] <= time.time():
+                return None
+            return json.loads(zlib.decompress(row[0]))
+        except (sqlite3.Error, zlib.error, ValueError) as e:
+            logger.warning(f"Persistent cache read failed for {key}: {e}")
+            return None
+    
+    def set(self, key: str, value: Any, ttl: float) -> None:
+        """Store a JSON-serializable value, compressed"""
+        if self._conn is None:
+            return
+        try:
+            blob = zlib.compress(json.dumps(value).encode(), 6)
+            with self._lock:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO kv (k, v, exp) VALUES (?, ?, ?)",
+                    (key, blob, time.time() + ttl)
+                )
+        except (sqlite3.Error, TypeError, ValueError) as e:
+            logger.warning(f"Persistent cache write failed for {key}: {e}")
+    
+    def delete(self, key: str) -> None:
+        if self._conn is None:
+            return
+        try:
+            with self._lock:
+                self._conn.execute("DELETE FROM kv WHERE k = ?", (key,))
+        except sqlite3.Error as e:
+            logger.warning(f"Persistent cache delete failed for {key}: {e}")
+    
+    def purge_expired(self) -> int:
+        """Delete expired entries; returns how many were removed"""
+        if self._conn is None:
+            return 0
+        try:
+            with self._lock:
+                return self._conn.execute("DELETE FROM kv WHERE exp <= ?", (time.time(),)).rowcount
+        except sqlite3.Error as e:
+            logger.warning(f"Persistent cache purge failed: {e}")
+            return 0
+    
+    def close(self) -> None:
+        if self._conn is not None:
+            with self._lock:
+                self._conn.close()
+            self._conn = None
+
+# Shared store; CACHE_DB_PATH can point it somewhere persistent across deploys
+persistent_cache = PersistentCache(os.getenv("CACHE_DB_PATH", "cache.db"))
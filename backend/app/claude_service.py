@@ -1,44 +1,126 @@
 import os
-from typing import Optional
-import anthropic
+import json
+import asyncio
+import logging
+import importlib.util
+from typing import List, Optional
 from dotenv import load_dotenv
 
 load_dotenv()
+logger = logging.getLogger(__name__)
+
+try:
+    import orjson
+
+    def prompt_json(data) -> str:
+        """Compact JSON for embedding data in prompts (no indent: fewer tokens)"""
+        try:
+            return orjson.dumps(data, default=str).decode()
+        except TypeError:
+            # e.g. integers wider than 64 bits, which orjson refuses
+            return json.dumps(data, default=str, separators=(",", ":"))
+except ImportError:
+    def prompt_json(data) -> str:
+        """Compact JSON for embedding data in prompts (no indent: fewer tokens)"""
+        return json.dumps(data, default=str, separators=(",", ":"))
 
 class ClaudeService:
-    def __init__(self):
+    def __init__(self, max_concurrency: int = 16, max_retries: int = 3):
         api_key = os.getenv("ANTHROPIC_API_KEY")
         if not api_key:
             raise ValueError("ANTHROPIC_API_KEY not found in environment variables")
-        # Simple initialization without proxies
-        self.client = anthropic.Anthropic(api_key=api_key)
-    
-    async def get_response(self, message: str, context: Optional[str] = None) -> str:
-        """Get response from Claude"""
+        # Imported here so processes without an API key never load the SDK or its HTTP stack
+        import anthropic
+        import httpx
+        self._anthropic = anthropic
+        # Async client so awaiting a response doesn't block the event loop
+        self.client = anthropic.AsyncAnthropic(api_key=api_key, http_client=self._build_http_client(anthropic, httpx))
+        # Cap in-flight requests to stay under the provider's rate limits
+        self._sem = asyncio.Semaphore(max_concurrency)
+        self.max_retries = max_retries
+
+    async def get_response(self, message: str, context: Optional[str] = None,
+                           temperature: Optional[float] = None,
+                           cacheable_prefix: Optional[str] = None) -> str:
+        """Get response from Claude; temperature defaults to the API's own default.
+
+        ``cacheable_prefix`` is sent ahead of the prompt as its own block and
+        marked for server-side prompt caching, so repeated calls sharing it
+        (e.g. the same schema) only pay full price for the tail.
+        """
         try:
             # Build the prompt
             prompt = message
             if context:
                 prompt = f"Context: {context}\n\nUser Question: {message}"
-            
-            # Call Claude API
-            response = self.client.messages.create(
-                model="claude-sonnet-4-20250514",
-                max_tokens=1000,
-                messages=[
-                    {"role": "user", "content": prompt}
+
+            content = prompt
+            if cacheable_prefix:
+                content = [
+                    {"type": "text", "text": cacheable_prefix, "cache_control": {"type": "ephemeral"}},
+                    {"type": "text", "text": prompt}
                 ]
-            )
-            
+
+            # Call Claude API
+            async with self._sem:
+                response = await self._create_with_retry(content, temperature)
+
             # Extract the text response
             return response.content[0].text
-            
+
         except Exception as e:
             return f"Error: {str(e)}"
 
+    async def get_responses(self, messages: List[str], context: Optional[str] = None) -> List[str]:
+        """Get responses for several independent prompts concurrently.
+
+        Requests share the client's connection pool and the concurrency cap;
+        results come back in the same order as ``messages``.
+        """
+        return await asyncio.gather(*(self.get_response(m, context) for m in messages))
+
+    @staticmethod
+    def _build_http_client(anthropic, httpx):
+        """Pooled HTTP client shared by every request this service makes.
+
+        HTTP/2 lets concurrent requests multiplex over one TLS connection;
+        it needs the optional h2 package, so fall back to HTTP/1.1 without it.
+        The SDK's own client class is used so it stays compatible with
+        whichever httpx flavour the installed SDK is built on.
+        """
+        return anthropic.DefaultAsyncHttpxClient(
+            http2=importlib.util.find_spec("h2") is not None,
+            limits=httpx.Limits(max_connections=128, max_keepalive_connections=64, keepalive_expiry=60.0),
+            timeout=anthropic.Timeout(60.0, connect=5.0)
+        )
+
+    async def close(self):
+        """Close pooled connections"""
+        await self.client.close()
+
+    async def _create_with_retry(self, prompt, temperature: Optional[float] = None):
+        """Call the messages API, backing off exponentially on rate limits and connection errors"""
+        kwargs = {} if temperature is None else {"temperature": temperature}
+        for attempt in range(self.max_retries):
+            try:
+                return await self.client.messages.create(
+                    model="claude-sonnet-4-20250514",
+                    max_tokens=1000,
+                    messages=[
+                        {"role": "user", "content": prompt}
+                    ],
+                    **kwargs
+                )
+            except (self._anthropic.RateLimitError, self._anthropic.APIConnectionError) as e:
+                if attempt == self.max_retries - 1:
+                    raise
+                delay = 2 ** attempt
+                logger.warning(f"Claude request failed ({type(e).__name__}), retrying in {delay}s")
+                await asyncio.sleep(delay)
+
 # Try to create instance
 try:
     claude_service = ClaudeService()
 except Exception as e:
     print(f"Could not initialize Claude service: {e}")
-    claude_service = None
\ No newline at end of file
+    claude_service = None
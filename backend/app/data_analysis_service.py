@@ -1,110 +1,337 @@
-import pandas as pd
-import matplotlib.pyplot as plt
-import seaborn as sns
+import warnings
+import numpy as np
+from PIL import Image
 import io
-import base64
-from typing import Dict, List, Optional
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+try:
+    # SIMD-accelerated drop-in replacement for the stdlib encoder
+    import pybase64 as base64
+except ImportError:
+    import base64
+from typing import Dict, List, Optional, Tuple
 import logging
 
 logger = logging.getLogger(__name__)
 
+try:
+    # SIMD-accelerated non-cryptographic hash for chart cache keys
+    import xxhash
+    
+    def _new_hasher():
+        return xxhash.xxh3_128()
+except ImportError:
+    def _new_hasher():
+        return hashlib.blake2b(digest_size=16)
+
+_DTYPES = {'b': np.bool_, 'i': np.int64, 'f': np.float64, 'O': object}
+
+def _scalar_kind(value) -> Optional[str]:
+    """NumPy dtype kind for a row value; None for a missing value"""
+    if value is None:
+        return None
+    value_type = type(value)
+    if value_type is bool:
+        return 'b'
+    if value_type is int:
+        return 'i'
+    if value_type is float:
+        return 'f'
+    return 'O'
+
+def _to_columnar(data: List[Dict]) -> Dict[str, np.ndarray]:
+    """Convert row dicts into one typed NumPy array per column.
+
+    The dtype is guessed from the first row and the array is filled in a
+    single pass, widening int -> float for missing values/floats and
+    falling back to object for anything mixed. Column order and missing
+    values follow pd.DataFrame(data).
+    """
+    n = len(data)
+    columns = list(dict.fromkeys(key for row in data for key in row))
+    columnar = {}
+    
+    for col in columns:
+        kind = _scalar_kind(data[0].get(col)) or 'f'
+        arr = np.empty(n, dtype=_DTYPES[kind])
+        seen_value = False
+        
+        for i, row in enumerate(data):
+            value = row.get(col)
+            value_kind = _scalar_kind(value)
+            if value_kind is not None:
+                seen_value = True
+            
+            if value_kind == kind or (kind == 'f' and value_kind == 'i'):
+                pass
+            elif (kind == 'i' and value_kind in (None, 'f')):
+                arr, kind = arr.astype(np.float64), 'f'
+            elif not (kind == 'f' and value_kind is None):
+                kind = 'O'
+                break
+            
+            try:
+                arr[i] = np.nan if value is None else value
+            except OverflowError:
+                # Integers wider than int64 stay as Python objects
+                kind = 'O'
+                break
+        
+        if kind == 'O' or not seen_value:
+            arr = np.empty(n, dtype=object)
+            for i, row in enumerate(data):
+                arr[i] = row.get(col)
+        columnar[col] = arr
+    
+    return columnar
+
+def _value_counts(values: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Distinct non-null values and their counts, most frequent first"""
+    if values.dtype.kind == 'f':
+        values = values[~np.isnan(values)]
+    elif values.dtype == object:
+        values = values[np.fromiter((v is not None for v in values), dtype=bool, count=len(values))]
+    
+    try:
+        uniques, counts = np.unique(values, return_counts=True)
+    except TypeError:
+        # Mixed types can't be sorted together; count their string forms
+        uniques, counts = np.unique(values.astype(str), return_counts=True)
+    
+    order = np.argsort(-counts, kind='stable')
+    return uniques[order], counts[order]
+
+_INT32 = np.iinfo(np.int32)
+
+def _downcast(values: np.ndarray) -> np.ndarray:
+    """Narrow int64 columns to int32 when every value fits.
+
+    The reductions in analyze_data are memory-bound, so halving the element
+    width halves the bytes they scan. Floats keep full width: float32 would
+    change the min/max/median values reported back to the client.
+    """
+    if values.dtype == np.int64 and values.size:
+        if _INT32.min <= values.min() and values.max() <= _INT32.max:
+            return values.astype(np.int32)
+    return values
+
+_CHART_TYPES = {"bar", "line", "scatter", "pie"}
+
 class DataAnalysisService:
     def __init__(self):
-        # Set matplotlib to use non-interactive backend
-        plt.switch_backend('Agg')
-        sns.set_theme()
+        # One figure is reused for every chart; figures aren't thread-safe.
+        # It is created on first use so workers that never plot skip the
+        # matplotlib/seaborn import cost.
+        self._fig = None
+        self._ax = None
+        self._render_lock = threading.Lock()
+        self._png_buffer = io.BytesIO()
+        
+        # LRU of already-encoded charts keyed by a hash of the request
+        self._chart_cache: "OrderedDict[bytes, Dict]" = OrderedDict()
+        self._chart_cache_lock = threading.Lock()
+        self.chart_cache_size = 128
         
     def create_visualization(self, data: List[Dict], chart_type: str, x_column: str, y_column: str = None) -> Dict:
         """Create a visualization from data"""
         try:
-            # Convert to DataFrame
-            df = pd.DataFrame(data)
-            
-            # Create figure
-            plt.figure(figsize=(10, 6))
-            
-            if chart_type == "bar":
-                if y_column:
-                    plt.bar(df[x_column], df[y_column])
-                    plt.xlabel(x_column)
-                    plt.ylabel(y_column)
-                else:
-                    df[x_column].value_counts().plot(kind='bar')
-                    plt.xlabel(x_column)
-                    plt.ylabel('Count')
-                    
-            elif chart_type == "line":
-                if y_column:
-                    plt.plot(df[x_column], df[y_column], marker='o')
-                    plt.xlabel(x_column)
-                    plt.ylabel(y_column)
-                else:
-                    return {"success": False, "error": "Line chart requires both x and y columns"}
-                    
-            elif chart_type == "scatter":
-                if y_column:
-                    plt.scatter(df[x_column], df[y_column])
-                    plt.xlabel(x_column)
-                    plt.ylabel(y_column)
-                else:
-                    return {"success": False, "error": "Scatter plot requires both x and y columns"}
-                    
-            elif chart_type == "pie":
-                if y_column:
-                    plt.pie(df[y_column], labels=df[x_column], autopct='%1.1f%%')
-                else:
-                    df[x_column].value_counts().plot(kind='pie', autopct='%1.1f%%')
-                    
-            else:
+            # Reject malformed requests before building arrays or touching matplotlib
+            if chart_type not in _CHART_TYPES:
                 return {"success": False, "error": f"Unsupported chart type: {chart_type}"}
+            if not y_column and chart_type == "line":
+                return {"success": False, "error": "Line chart requires both x and y columns"}
+            if not y_column and chart_type == "scatter":
+                return {"success": False, "error": "Scatter plot requires both x and y columns"}
+            if data:
+                for column in (x_column, y_column):
+                    if column and column not in data[0]:
+                        return {"success": False, "error": f"Column not found: {column}"}
+            
+            # Plot straight from typed column arrays; no DataFrame needed
+            columns = _to_columnar(data)
             
-            plt.title(f"{chart_type.capitalize()} Chart")
-            plt.tight_layout()
+            cache_key = self._chart_cache_key(columns, chart_type, x_column, y_column)
+            with self._chart_cache_lock:
+                cached = self._chart_cache.get(cache_key)
+                if cached is not None:
+                    self._chart_cache.move_to_end(cache_key)
+                    return dict(cached)
             
-            # Convert to base64
-            buffer = io.BytesIO()
-            plt.savefig(buffer, format='png', dpi=100)
-            buffer.seek(0)
-            image_base64 = base64.b64encode(buffer.read()).decode()
-            plt.close()
+            with self._render_lock:
+                self._ensure_figure()
+                
+                # Reset the shared axes instead of creating a new figure
+                ax = self._ax
+                ax.clear()
+                
+                try:
+                    if chart_type == "bar":
+                        if y_column:
+                            ax.bar(columns[x_column], columns[y_column])
+                            ax.set_xlabel(x_column)
+                            ax.set_ylabel(y_column)
+                        else:
+                            values, counts = _value_counts(columns[x_column])
+                            ax.bar([str(v) for v in values], counts)
+                            ax.tick_params(axis='x', labelrotation=90)
+                            ax.set_xlabel(x_column)
+                            ax.set_ylabel('Count')
+                        
+                    elif chart_type == "line":
+                        ax.plot(columns[x_column], columns[y_column], marker='o')
+                        ax.set_xlabel(x_column)
+                        ax.set_ylabel(y_column)
+                        
+                    elif chart_type == "scatter":
+                        ax.scatter(columns[x_column], columns[y_column])
+                        ax.set_xlabel(x_column)
+                        ax.set_ylabel(y_column)
+                        
+                    elif chart_type == "pie":
+                        if y_column:
+                            ax.pie(columns[y_column], labels=columns[x_column], autopct='%1.1f%%')
+                        else:
+                            values, counts = _value_counts(columns[x_column])
+                            ax.pie(counts, labels=[str(v) for v in values], autopct='%1.1f%%')
+                
+                    ax.set_title(f"{chart_type.capitalize()} Chart")
+                    self._fig.tight_layout()
+                
+                    # Render with Agg and encode the RGBA buffer with Pillow, using
+                    # fast PNG compression instead of savefig's default level
+                    canvas = self._fig.canvas
+                    del columns
+                    canvas.draw()
+                    image = Image.frombuffer('RGBA', canvas.get_width_height(), canvas.buffer_rgba(), 'raw', 'RGBA', 0, 1)
+                
+                    # Reuse one PNG buffer and encode straight from its memory
+                    buffer = self._png_buffer
+                    buffer.seek(0)
+                    buffer.truncate()
+                    image.save(buffer, format='PNG', compress_level=1)
+                    with buffer.getbuffer() as png_bytes:
+                        image_base64 = base64.b64encode(png_bytes).decode()
+                finally:
+                    # Drop this chart's artists so their data isn't kept alive
+                    # by the shared figure until the next render
+                    ax.clear()
             
-            return {
+            result = {
                 "success": True,
                 "image": f"data:image/png;base64,{image_base64}",
                 "chart_type": chart_type
             }
             
+            with self._chart_cache_lock:
+                self._chart_cache[cache_key] = result
+                while len(self._chart_cache) > self.chart_cache_size:
+                    self._chart_cache.popitem(last=False)
+            
+            return dict(result)
+            
         except Exception as e:
             logger.error(f"Visualization creation failed: {e}")
-            plt.close()
             return {"success": False, "error": str(e)}
     
+    @staticmethod
+    def _chart_cache_key(columns: Dict[str, np.ndarray], chart_type: str, x_column: str, y_column: Optional[str]) -> bytes:
+        """Cheap content hash identifying a chart request.
+
+        Typed columns are hashed from their raw bytes; object columns hold
+        pointers, so their values' reprs are hashed instead.
+        """
+        hasher = _new_hasher()
+        for name, arr in columns.items():
+            hasher.update(name.encode())
+            hasher.update(arr.dtype.str.encode())
+            if arr.dtype == object:
+                hasher.update("\x1f".join(map(repr, arr)).encode())
+            else:
+                hasher.update(arr.tobytes())
+        return hasher.digest() + json.dumps([chart_type, x_column, y_column]).encode()
+    
+    def _ensure_figure(self):
+        """Import matplotlib, apply the seaborn theme and create the shared figure once"""
+        if self._fig is not None:
+            return
+        
+        import matplotlib.pyplot as plt
+        import seaborn as sns
+        
+        # Set matplotlib to use non-interactive backend
+        plt.switch_backend('Agg')
+        sns.set_theme()
+        self._fig, self._ax = plt.subplots(figsize=(10, 6), dpi=100)
+    
+    def close(self):
+        """Release the shared figure"""
+        if self._fig is not None:
+            import matplotlib.pyplot as plt
+            plt.close(self._fig)
+            self._fig = self._ax = None
+    
     def analyze_data(self, data: List[Dict]) -> Dict:
         """Perform basic statistical analysis on data"""
         try:
-            df = pd.DataFrame(data)
+            columnar = _to_columnar(data)
+            columns = list(columnar)
             
-            # Get numeric columns
-            numeric_columns = df.select_dtypes(include=['float64', 'int64']).columns.tolist()
+            numeric_arrays = {col: _downcast(arr) for col, arr in columnar.items() if arr.dtype.kind in 'iuf'}
+            numeric_columns = list(numeric_arrays)
             
             analysis = {
-                "row_count": len(df),
-                "column_count": len(df.columns),
-                "columns": list(df.columns),
+                "row_count": len(data),
+                "column_count": len(columns),
+                "columns": columns,
                 "numeric_columns": numeric_columns,
                 "statistics": {}
             }
             
-            # Calculate statistics for numeric columns
-            for col in numeric_columns:
-                analysis["statistics"][col] = {
-                    "mean": float(df[col].mean()),
-                    "median": float(df[col].median()),
-                    "std": float(df[col].std()),
-                    "min": float(df[col].min()),
-                    "max": float(df[col].max()),
-                    "null_count": int(df[col].isnull().sum())
-                }
+            # Stack same-dtype columns into 2-D blocks so each statistic is one
+            # vectorized reduction per block instead of one call per column
+            blocks: Dict[np.dtype, List[str]] = {}
+            for col, arr in numeric_arrays.items():
+                blocks.setdefault(arr.dtype, []).append(col)
+            
+            # Calculate statistics for numeric columns, skipping NaN like pandas
+            statistics = {}
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", RuntimeWarning)
+                for dtype, block_columns in blocks.items():
+                    block = np.column_stack([numeric_arrays[col] for col in block_columns])
+                    if dtype.kind == 'f':
+                        null_counts = np.isnan(block).sum(axis=0)
+                    else:
+                        null_counts = np.zeros(len(block_columns), dtype=np.int64)
+                    
+                    # The nan* reductions copy and mask the block on every call;
+                    # a block without NaN gets the same answers from the plain ones
+                    if null_counts.any():
+                        means = np.nanmean(block, axis=0)
+                        medians = np.nanmedian(block, axis=0)
+                        stds = np.nanstd(block, axis=0, ddof=1)
+                        mins = np.nanmin(block, axis=0)
+                        maxs = np.nanmax(block, axis=0)
+                    else:
+                        means = block.mean(axis=0)
+                        medians = np.median(block, axis=0)
+                        stds = block.std(axis=0, ddof=1)
+                        mins = block.min(axis=0)
+                        maxs = block.max(axis=0)
+                    
+                    for i, col in enumerate(block_columns):
+                        statistics[col] = {
+                            "mean": float(means[i]),
+                            "median": float(medians[i]),
+                            "std": float(stds[i]),
+                            "min": float(mins[i]),
+                            "max": float(maxs[i]),
+                            "null_count": int(null_counts[i])
+                        }
+            
+            analysis["statistics"] = {col: statistics[col] for col in numeric_columns}
             
             return {"success": True, "analysis": analysis}
             
@@ -3,51 +3,425 @@ import json
 import re
 import time
 import hashlib
+import string
+import math
+import heapq
+import itertools
 from datetime import datetime, timedelta
-from typing import Dict, List, Optional, Tuple, Set
-import pandas as pd
+from typing import Dict, Iterable, List, Optional, Tuple, Set
 import asyncio
-from difflib import SequenceMatcher
+from collections import Counter, OrderedDict, defaultdict
+from functools import lru_cache
+from difflib import get_close_matches
 
-from app.claude_service import claude_service
+from app.claude_service import claude_service, prompt_json
 from app.fabric_service import fabric_service
 from app.semantic_model_service import semantic_model_service
 from app.knowledge_base_service import knowledge_base_service
+from app.data_analysis_service import data_analysis_service
+from app.cache_store import persistent_cache
 
 logger = logging.getLogger(__name__)
 
-class EnhancedMultiAgentService:
-    def __init__(self):
-        self.sql_schema_cache = None
-        self.model_info_cache = None
-        self.connection_type = None  # 'sql' or 'semantic_model'
-        
-        # Phase 2: Advanced caching system
-        self.schema_cache = {}
-        self.schema_metadata = {}
-        self.cache_stats = {
-            "hits": 0,
-            "misses": 0,
-            "refreshes": 0,
-            "last_cleanup": time.time()
-        }
-        
-        # Cache configuration
-        self.cache_config = {
-            "default_ttl": 3600,  # 1 hour
-            "max_cache_size": 50,  # Max cached schemas
-            "cleanup_interval": 1800,  # 30 minutes
-            "performance_boost_ttl": 7200,  # 2 hours for frequently used schemas
-        }
-        
-        # Query similarity cache
-        self.query_similarity_cache = {}
-        self.entity_extraction_cache = {}
+# Column-name categories for the DAX schema context (matched against lowercased names)
+_DAX_KEY_RE = re.compile(r"key|id")
+_DAX_DATE_RE = re.compile(r"date|time|year|month")
+_DAX_MEASURE_RE = re.compile(r"amount|total|sum|count|value")
+
+def _terms_re(*terms: str) -> re.Pattern:
+    """One compiled alternation matching any of the literal terms as a substring"""
+    return re.compile("|".join(map(re.escape, terms)))
+
+# Table-name heuristics (matched against lowercased names)
+_TABLE_ROLES = (
+    # Business entity tables get higher priority
+    ('business', 100, ('sales', 'customer', 'order', 'product', 'revenue')),
+    # Fact tables (for both SQL and Power BI)
+    ('fact', 80, ('fact', 'transaction', 'activity')),
+    # Dimension tables (a 'dim' prefix counts too)
+    ('dimension', 60, ('dimension', 'lookup')),
+    # Avoid system/temp tables
+    ('system', -50, ('temp', 'tmp', 'sys', 'log', 'audit')),
+)
+_TABLE_ROLE_WEIGHTS = {role: weight for role, weight, _ in _TABLE_ROLES}
+# One scan finds every role; the lookahead lets overlapping terms all match
+_TABLE_ROLE_RE = re.compile(
+    "(?=" + "|".join(f"(?P<{role}>{_terms_re(*terms).pattern})" for role, _, terms in _TABLE_ROLES) + ")"
+)
+_LARGE_TABLE_RE = _terms_re('fact', 'transaction', 'log', 'history')
+_MEDIUM_TABLE_RE = _terms_re('sales', 'order', 'customer')
+
+# Column grouping for the SQL schema context (lowercased names and types)
+_SYSTEM_COLUMN_NAMES = frozenset({'rowguid', 'timestamp'})
+_KEY_COLUMN_RE = _terms_re('id', 'key', 'guid')
+_DATE_COLUMN_RE = _terms_re('date', 'time', 'created', 'modified')
+_MEASURE_COLUMN_RE = _terms_re('amount', 'total', 'price', 'cost', 'revenue', 'sum')
+_CATEGORY_COLUMN_RE = _terms_re('name', 'description', 'category', 'type', 'status')
+_TEXT_TYPE_RE = _terms_re('varchar', 'nvarchar', 'text', 'string')
+_NUMBER_TYPE_RE = _terms_re('int', 'decimal', 'float', 'numeric', 'money')
+# Group labels, in the order they are listed in the schema context
+_COLUMN_GROUPS = ("🔑 Keys/IDs", "📅 Dates", "📈 Measures", "📝 Text", "🔢 Numbers", "🏷️ Categories")
+
+@lru_cache(maxsize=4096)
+def _column_group(col_name: str, col_type: str) -> str:
+    """Schema context group for a column; the same columns recur on every schema build"""
+    col_name_lower = col_name.lower()
+    col_type = col_type.lower()
+    
+    # Categorize by name patterns
+    if _KEY_COLUMN_RE.search(col_name_lower):
+        return "🔑 Keys/IDs"
+    elif _DATE_COLUMN_RE.search(col_name_lower):
+        return "📅 Dates"
+    elif _MEASURE_COLUMN_RE.search(col_name_lower):
+        return "📈 Measures"
+    elif _TEXT_TYPE_RE.search(col_type):
+        return "🏷️ Categories" if _CATEGORY_COLUMN_RE.search(col_name_lower) else "📝 Text"
+    elif _NUMBER_TYPE_RE.search(col_type):
+        return "🔢 Numbers"
+    return "📝 Text"  # Default fallback
+
+# Question analysis tags: each tag is set when any of its terms occurs in the
+# lowercased question. Within a field, earlier tags take priority.
+_QUESTION_TERMS = (
+    (('flag', 'requires_joins'), ('customer', 'product', 'order', 'between', 'and', 'with', 'from')),
+    (('flag', 'requires_aggregation'), ('total', 'sum', 'count', 'average', 'max', 'min', 'by')),
+    (('flag', 'requires_time_analysis'), ('year', 'month', 'quarter', 'daily', 'weekly', 'trend', 'over time')),
+    (('flag', 'requires_filtering'), ('where', 'filter', 'only', 'specific', 'particular', 'certain')),
+    (('aggregation_type', 'SUM'), ('total', 'sum')),
+    (('aggregation_type', 'COUNT'), ('count', 'how many')),
+    (('aggregation_type', 'AVERAGE'), ('average', 'mean')),
+    (('aggregation_type', 'MAX'), ('max', 'highest')),
+    (('aggregation_type', 'MIN'), ('min', 'lowest')),
+    (('time_dimension', 'YEAR'), ('year', 'yearly', 'annual')),
+    (('time_dimension', 'MONTH'), ('month', 'monthly')),
+    (('time_dimension', 'QUARTER'), ('quarter', 'quarterly')),
+    (('intent', 'TREND_ANALYSIS'), ('trend', 'over time', 'progression', 'growth', 'decline')),
+    (('intent', 'COMPARISON'), ('compare', 'versus', 'vs', 'difference', 'better', 'worse')),
+    (('intent', 'RANKING'), ('top', 'bottom', 'best', 'worst', 'highest', 'lowest', 'rank')),
+    (('intent', 'DISTRIBUTION'), ('breakdown', 'distribution', 'split', 'allocation')),
+    (('intent', 'PERFORMANCE'), ('performance', 'kpi', 'metric', 'achievement', 'target')),
+    (('intent', 'RELATIONSHIP'), ('relationship', 'correlation', 'related', 'connected')),
+    (('intent', 'ANOMALY'), ('unusual', 'strange', 'outlier', 'anomaly', 'exception')),
+    (('intent', 'FORECAST'), ('predict', 'forecast', 'future', 'projection', 'estimate')),
+)
+
+try:
+    # Aho-Corasick automaton: every tag found in one pass over the question
+    import ahocorasick
+    
+    _QUESTION_AUTOMATON = ahocorasick.Automaton()
+    _term_tags: Dict[str, List[Tuple[str, str]]] = {}
+    for _tag, _terms in _QUESTION_TERMS:
+        for _term in _terms:
+            _term_tags.setdefault(_term, []).append(_tag)
+    for _term, _tags in _term_tags.items():
+        _QUESTION_AUTOMATON.add_word(_term, tuple(_tags))
+    _QUESTION_AUTOMATON.make_automaton()
+    del _tag, _terms, _term, _tags, _term_tags
+    
+    def _scan_question_tags(question_lower: str) -> Set[Tuple[str, str]]:
+        return {tag for _, tags in _QUESTION_AUTOMATON.iter(question_lower) for tag in tags}
+except ImportError:
+    _QUESTION_TAG_RES = tuple((tag, _terms_re(*terms)) for tag, terms in _QUESTION_TERMS)
+    
+    def _scan_question_tags(question_lower: str) -> Set[Tuple[str, str]]:
+        return {tag for tag, pattern in _QUESTION_TAG_RES if pattern.search(question_lower)}
 
-        # Phase 2: Advanced prompt templates with context awareness
-        self.advanced_prompt_templates = {
-            "sql_generation": {
-                "base": """You are a Microsoft Fabric T-SQL expert with deep understanding of business data patterns.
+@lru_cache(maxsize=256)
+def _question_tags(question_lower: str) -> Dict:
+    """Highest-priority tag value per field, every flag that is set, and the
+    grouping terms ('grouping', a tuple).
+    
+    Questions are analyzed several times per request (once per candidate
+    template), hence the memo.
+    """
+    found = _scan_question_tags(question_lower)
+    tags = {}
+    for tag, _ in _QUESTION_TERMS:
+        if tag in found:
+            field, value = tag
+            if field == 'flag':
+                tags[value] = True
+            else:
+                tags.setdefault(field, value)
+    tags['grouping'] = tuple(match for pattern in _GROUP_RES for match in pattern.findall(question_lower))
+    return tags
+
+# Error categories in priority order, each with the phrases that identify it
+_ERROR_CATEGORIES = (
+    ("SCHEMA_ERROR", ("invalid column name", "invalid object name", "cannot be found", "not found")),
+    ("SYNTAX_ERROR", ("syntax error", "incorrect syntax", "expected", "unexpected")),
+    ("PERMISSION_ERROR", ("permission", "access", "denied", "unauthorized")),
+    ("TIMEOUT_ERROR", ("timeout", "cancelled", "aborted")),
+    ("CALCULATION_ERROR", ("division by zero", "arithmetic overflow", "conversion failed")),
+    ("DAX_ERROR", ("evaluate", "dax", "measure", "table expression")),
+)
+_ERROR_CATEGORY_RANK = {name: rank for rank, (name, _) in enumerate(_ERROR_CATEGORIES)}
+# Zero-width lookahead so phrases that overlap each other are all seen
+_ERROR_CATEGORY_RE = re.compile(
+    "(?=" + "|".join(
+        f"(?P<{name}>" + "|".join(map(re.escape, terms)) + ")" for name, terms in _ERROR_CATEGORIES
+    ) + ")",
+    re.IGNORECASE
+)
+
+class _CacheEntry:
+    """One schema cache record: the cached value plus its TTL/LRU bookkeeping"""
+    __slots__ = ('data', 'cached_at', 'last_accessed', 'access_count', 'ttl', 'size_bytes', 'tables', 'version')
+    
+    def __init__(self, data: Tuple[str, str], cached_at: float, ttl: float, tables: frozenset, version: int):
+        self.data = data
+        self.cached_at = cached_at
+        self.last_accessed = cached_at
+        self.access_count = 1
+        self.ttl = ttl
+        # Length of the cached strings: O(1) each, unlike formatting the tuple
+        self.size_bytes = sum(len(part) for part in data)
+        self.tables = tables
+        self.version = version
+    
+    @property
+    def expires_at(self) -> float:
+        # Monotonic clock: immune to wall-clock jumps
+        return self.cached_at + self.ttl
+
+class _QuestionAnalysis:
+    """What a question asks for; read by every prompt-building and optimization step"""
+    __slots__ = ('question_intent', 'complexity', 'requires_joins', 'requires_aggregation',
+                 'requires_time_analysis', 'requires_filtering', 'aggregation_type',
+                 'time_dimension', 'grouping_requirements')
+    
+    def __init__(self, question_intent: str, requires_joins: bool, requires_aggregation: bool,
+                 requires_time_analysis: bool, requires_filtering: bool, aggregation_type: Optional[str],
+                 time_dimension: Optional[str], grouping_requirements: List[str], complexity: str = 'simple'):
+        self.question_intent = question_intent
+        self.complexity = complexity
+        self.requires_joins = requires_joins
+        self.requires_aggregation = requires_aggregation
+        self.requires_time_analysis = requires_time_analysis
+        self.requires_filtering = requires_filtering
+        self.aggregation_type = aggregation_type
+        self.time_dimension = time_dimension
+        self.grouping_requirements = grouping_requirements
+
+def _compact_rows(data: List[Dict], limit: int = 10, max_cell: int = 80) -> str:
+    """Render rows as a tab-separated table: far fewer prompt tokens than indented JSON"""
+    rows = data[:limit]
+    columns = list(dict.fromkeys(key for row in rows for key in row))
+    
+    def cell(value) -> str:
+        if value is None:
+            return "NULL"
+        text = str(value).replace("\t", " ").replace("\n", " ")
+        return text if len(text) <= max_cell else text[:max_cell - 3] + "..."
+    
+    lines = ["\t".join(columns)]
+    lines.extend("\t".join(cell(row.get(column)) for column in columns) for row in rows)
+    return "\n".join(lines)
+
+def _render_segments(segments: Iterable[Tuple[str, Optional[str]]], values: Dict) -> str:
+    """Join (text, field) segments of a parsed format string, filling each
+    field from values; a missing field raises KeyError, as str.format does
+    """
+    parts = []
+    for literal, field_name in segments:
+        parts.append(literal)
+        if field_name is not None:
+            parts.append(str(values[field_name]))
+    return "".join(parts)
+
+def _join_within_budget(chunks: Iterable[str], budget: int) -> str:
+    """Concatenate chunks in order, stopping before the first that would exceed budget chars"""
+    taken, used = [], 0
+    for chunk in chunks:
+        if used + len(chunk) > budget:
+            break
+        taken.append(chunk)
+        used += len(chunk)
+    return "".join(taken)
+
+# Query cleanup patterns, applied to every generated query
+_CODE_BLOCK_RES = (
+    re.compile(r'```(?:sql|dax|tsql)?\s*(.*?)\s*```', re.DOTALL | re.IGNORECASE),
+    re.compile(r'```\s*(.*?)\s*```', re.DOTALL | re.IGNORECASE),
+)
+_LANG_PREFIX_RE = re.compile(r'^(sql|dax|t-sql|tsql):\s*', re.IGNORECASE)
+# A line break with the whitespace around it, including any blank lines
+_LINE_BREAK_RE = re.compile(r'[^\S\n]*\n\s*')
+_SELECT_PREFIX_RE = re.compile(r'^SELECT\s+', re.IGNORECASE)
+_ROW_LIMIT_RE = re.compile(r'TOP|LIMIT', re.IGNORECASE)
+_EVALUATE_RE = re.compile(r'EVALUATE', re.IGNORECASE)
+_TOPN_CALL_RE = re.compile(r'TOPN\(', re.IGNORECASE)
+_DAX_TABLE_FUNC_RE = re.compile(r'SUMMARIZE|FILTER|CALCULATE|TOPN', re.IGNORECASE)
+_LIMIT_RE = re.compile(r'\s+LIMIT\s+(\d+)', re.IGNORECASE)
+_ILIKE_RE = re.compile(r'\bILIKE\b', re.IGNORECASE)
+# SQL keywords that leak into DAX output, and what each is rewritten to
+_SQL_ARTIFACTS = {'select': '', 'from': '', 'where': 'FILTER('}
+_SQL_ARTIFACT_RE = re.compile(r'\b(SELECT|FROM|WHERE)\s+', re.IGNORECASE)
+# Whole words only, so identifiers like UpdatedAt or IsDeleted don't trip it
+_DANGEROUS_KEYWORD_RE = re.compile(r'\b(?:DROP|DELETE|TRUNCATE|ALTER|EXEC|EXECUTE|INSERT|UPDATE)\b', re.IGNORECASE)
+_TOP_BIG_RE = re.compile(r'TOP\s+(\d{4,})', re.IGNORECASE)
+_TABLE_EVAL_RE = re.compile(r'EVALUATE\s+([\'"]?\w+[\'"]?)\s*$', re.IGNORECASE)
+_GROUP_RES = (
+    re.compile(r'by (\w+)'),
+    re.compile(r'per (\w+)'),
+    re.compile(r'for each (\w+)'),
+    re.compile(r'(\w+) breakdown'),
+)
+
+# Error analysis and fix-up patterns
+_SCHEMA_TABLE_RE = re.compile(r'📊 (\w+):')
+_QUOTED_TABLE_RE = re.compile(r"'([^']+)':")
+_FIRST_SELECT_RE = re.compile(r'SELECT\s', re.IGNORECASE)
+_TOP_N_RE = re.compile(r'TOP\s+(\d+)', re.IGNORECASE)
+# Case-insensitive keyword probes, so checks don't have to uppercase a copy of the query
+_TOP_RE = re.compile(r'TOP', re.IGNORECASE)
+_TOP_CLAUSE_RE = re.compile(r'TOP ', re.IGNORECASE)
+_ORDER_BY_RE = re.compile(r'ORDER BY', re.IGNORECASE)
+_SUMMARIZE_RE = re.compile(r'SUMMARIZE', re.IGNORECASE)
+_QUALIFIED_COLUMN_RE = re.compile(r'(\w+\.\w+|\[\w+\]\.\[\w+\])')
+_QUERY_WORD_RE = re.compile(r'\b\w+\b')
+# Business terms checked for near-miss spellings in failed queries
+_COMMON_BUSINESS_TERMS = ('sales', 'customer', 'product', 'order', 'revenue', 'date', 'amount')
+
+try:
+    # Native Indel ratio: the same 2 * matches / total measure as difflib's, in C++
+    from rapidfuzz import fuzz, process
+    
+    def _closest_word(term: str, candidates: List[str]) -> Optional[str]:
+        """Candidate with the highest similarity ratio to term, if it reaches 0.8"""
+        match = process.extractOne(term, candidates, scorer=fuzz.ratio, score_cutoff=80)
+        return match[0] if match else None
+except ImportError:
+    def _closest_word(term: str, candidates: List[str]) -> Optional[str]:
+        """Candidate with the highest similarity ratio to term, if it reaches 0.8"""
+        matches = get_close_matches(term, candidates, n=1, cutoff=0.8)
+        return matches[0] if matches else None
+_ERROR_COLUMN_RE = re.compile(r"column name '([^']+)'", re.IGNORECASE)
+_ERROR_OBJECT_RE = re.compile(r"object name '([^']+)'", re.IGNORECASE)
+_ERROR_EXPECTED_RE = re.compile(r"expected '([^']+)'", re.IGNORECASE)
+_ERROR_UNEXPECTED_RE = re.compile(r"unexpected '([^']+)'", re.IGNORECASE)
+_SIMPLE_FIXES = {
+    "T-SQL": (
+        (re.compile(r'\bLIMIT\s+(\d+)', re.IGNORECASE), r'TOP \1'),  # Replace LIMIT with TOP
+        (re.compile(r'SELECT\s+(\*|\w+)', re.IGNORECASE), r'SELECT TOP 50 \1'),  # Add TOP if missing
+        (re.compile(r'\bILIKE\b', re.IGNORECASE), 'LIKE'),  # Replace ILIKE with LIKE
+    ),
+    "DAX": (
+        (re.compile(r'^(?!EVALUATE)', re.IGNORECASE), r'EVALUATE '),  # Add EVALUATE if missing
+        (re.compile(r'\bSELECT\b.*?\bFROM\b', re.IGNORECASE), ''),  # Remove SQL syntax
+        (re.compile(r'\bWHERE\b', re.IGNORECASE), 'FILTER('),  # Replace WHERE with FILTER
+    ),
+}
+
+_JSON_DECODER = json.JSONDecoder()
+_TRAILING_COMMA_RE = re.compile(r",\s*([}\]])")
+
+def _extract_json_object(text: str) -> Optional[Dict]:
+    """Return the first JSON object embedded in an LLM response.
+    
+    Each '{' is tried as a start point, so prose or code fences around the
+    object don't matter. A start point that doesn't parse is retried with
+    trailing commas (a common LLM slip) stripped before moving on, so a
+    repairable outer object wins over a valid nested one.
+    """
+    start = text.find('{')
+    while start >= 0:
+        tail = text[start:]
+        for candidate in (tail, _TRAILING_COMMA_RE.sub(r"\1", tail)):
+            try:
+                obj, _ = _JSON_DECODER.raw_decode(candidate)
+                if isinstance(obj, dict):
+                    return obj
+            except json.JSONDecodeError:
+                pass
+        start = text.find('{', start + 1)
+    return None
+
+# Splits identifiers and prose alike: "CustomerID" -> Customer, ID
+_WORD_RE = re.compile(r"[A-Z]+(?![a-z])|[A-Z]?[a-z]+|\d+")
+_SQL_BLOCK_RE = re.compile(r"(?m)^(?=📊 )")
+_DAX_BLOCK_RE = re.compile(r"(?=\n'[^\n]*':\n)")
+_DAX_MEASURES_MARKER = "\n📈 CALCULATED MEASURES:"
+
+def _search_tokens(text: str) -> List[str]:
+    """Lowercased word tokens with a crude plural strip, for relevance scoring"""
+    tokens = []
+    for word in _WORD_RE.findall(text):
+        word = word.lower()
+        if len(word) > 3 and word.endswith('s'):
+            word = word[:-1]
+        tokens.append(word)
+    return tokens
+
+def _bm25_scores(query: List[str], documents: List[List[str]], k1: float = 1.5, b: float = 0.75) -> List[float]:
+    """Okapi BM25 score of each tokenized document against the query tokens"""
+    if not documents:
+        return []
+    avg_length = sum(len(doc) for doc in documents) / len(documents) or 1
+    doc_freq = Counter(token for doc in documents for token in set(doc))
+    query_terms = set(query)
+    scores = []
+    for doc in documents:
+        term_freq = Counter(doc)
+        norm = k1 * (1 - b + b * len(doc) / avg_length)
+        score = 0.0
+        for term in query_terms:
+            tf = term_freq.get(term)
+            if tf:
+                idf = math.log(1 + (len(documents) - doc_freq[term] + 0.5) / (doc_freq[term] + 0.5))
+                score += idf * tf * (k1 + 1) / (tf + norm)
+        scores.append(score)
+    return scores
+
+# Error-fixing prompt sections by query language
+_SYNTAX_RULES = {
+    "T-SQL": """
+- Use TOP instead of LIMIT for row limiting
+- Use [square brackets] for names with spaces/special characters
+- Proper JOIN syntax: INNER/LEFT/RIGHT JOIN table ON condition
+- Use ISNULL() or COALESCE() for NULL handling
+- CAST() or CONVERT() for data type conversions
+- Proper quote usage: single quotes for strings, brackets for identifiers
+""",
+    "DAX": """
+- Must start with EVALUATE
+- Table references: 'Table Name' or TableName
+- Column references: 'Table Name'[Column Name]
+- Use DAX functions: FILTER, SUMMARIZE, CALCULATE, TOPN
+- NO SQL syntax: no SELECT, FROM, WHERE, JOIN
+- Use RELATED() for cross-table column access
+""",
+}
+_PERFORMANCE_HINTS = {
+    "T-SQL": """
+- Add WHERE clauses to filter data early
+- Use TOP to limit result sets
+- Avoid SELECT * in favor of specific columns
+- Use appropriate indexes (consider column usage)
+- Simplify complex subqueries
+""",
+    "DAX": """
+- Use TOPN() to limit results
+- Apply FILTER() early to reduce data volume
+- Use SUMMARIZECOLUMNS instead of SUMMARIZE when possible
+- Avoid complex calculated columns in large tables
+- Use measures instead of calculated columns where appropriate
+""",
+}
+
+# Business-context line for the question intents that get one
+_INTENT_BUSINESS_CONTEXT = {
+    'TREND_ANALYSIS': "This is a trend analysis query. Focus on time-based patterns and changes.",
+    'COMPARISON': "This is a comparison query. Ensure results can be easily compared.",
+    'RANKING': "This is a ranking query. Use ORDER BY and TOP/TOPN appropriately.",
+}
+
+# Prompt templates by task, then by question shape
+_ADVANCED_PROMPT_TEMPLATES = {
+    "sql_generation": {
+        "base": """You are a Microsoft Fabric T-SQL expert with deep understanding of business data patterns.
 
 CRITICAL REQUIREMENTS:
 1. Use ONLY Microsoft Fabric T-SQL syntax
@@ -79,7 +453,7 @@ Based on the schema and context above, generate a single, optimized T-SQL query
 
 Generate ONLY the T-SQL query (no explanations, no markdown):""",
 
-                "with_relationships": """You are a Microsoft Fabric T-SQL expert who understands data relationships and business logic.
+        "with_relationships": """You are a Microsoft Fabric T-SQL expert who understands data relationships and business logic.
 
 TABLE RELATIONSHIPS DETECTED:
 {relationship_hints}
@@ -99,7 +473,7 @@ Generate a T-SQL query that leverages the table relationships above. Consider:
 
 Generate ONLY the T-SQL query:""",
 
-                "aggregation_focused": """You are a T-SQL expert specializing in business aggregations and analytics.
+        "aggregation_focused": """You are a T-SQL expert specializing in business aggregations and analytics.
 
 AGGREGATION CONTEXT:
 - Question type: {aggregation_type}
@@ -121,10 +495,10 @@ Generate a T-SQL query optimized for aggregation that:
 - Uses TOP N to limit results appropriately
 
 Generate ONLY the T-SQL query:"""
-            },
+    },
 
-            "dax_generation": {
-                "base": """You are a Power BI DAX expert with deep understanding of semantic model design and business intelligence.
+    "dax_generation": {
+        "base": """You are a Power BI DAX expert with deep understanding of semantic model design and business intelligence.
 
 CRITICAL REQUIREMENTS:
 1. MUST start with EVALUATE
@@ -157,7 +531,7 @@ Based on the Power BI model structure above, generate a single DAX query that:
 
 Generate ONLY the DAX query (no explanations, no markdown):""",
 
-                "measure_focused": """You are a DAX expert specializing in calculated measures and advanced analytics.
+        "measure_focused": """You are a DAX expert specializing in calculated measures and advanced analytics.
 
 AVAILABLE MEASURES:
 {measures_context}
@@ -177,7 +551,7 @@ Generate a DAX query that leverages existing measures where possible. Consider:
 
 Generate ONLY the DAX query:""",
 
-                "relationship_aware": """You are a DAX expert who understands Power BI model relationships and context propagation.
+        "relationship_aware": """You are a DAX expert who understands Power BI model relationships and context propagation.
 
 RELATIONSHIP CONTEXT:
 {relationship_context}
@@ -196,10 +570,10 @@ Generate a DAX query that properly navigates relationships:
 - Handle bidirectional relationships appropriately
 
 Generate ONLY the DAX query:"""
-            },
+    },
 
-            "error_fixing": {
-                "schema_error": """You are a {query_language} debugging expert. Fix the schema-related errors in this query.
+    "error_fixing": {
+        "schema_error": """You are a {query_language} debugging expert. Fix the schema-related errors in this query.
 
 AVAILABLE SCHEMA:
 {schema_context}
@@ -221,7 +595,7 @@ The query references non-existent columns or tables. Fix by:
 
 Generate ONLY the corrected {query_language} query:""",
 
-                "syntax_error": """You are a {query_language} syntax expert. Fix the syntax errors in this query.
+        "syntax_error": """You are a {query_language} syntax expert. Fix the syntax errors in this query.
 
 FAILED QUERY:
 {failed_query}
@@ -240,7 +614,7 @@ Fix the syntax error by:
 
 Generate ONLY the corrected {query_language} query:""",
 
-                "performance_error": """You are a {query_language} performance expert. Optimize this query to resolve timeout issues.
+        "performance_error": """You are a {query_language} performance expert. Optimize this query to resolve timeout issues.
 
 FAILED QUERY:
 {failed_query}
@@ -258,9 +632,93 @@ Optimize the query by:
 4. Using more efficient functions
 
 Generate ONLY the optimized {query_language} query:"""
-            }
+    }
+}
+
+class EnhancedMultiAgentService:
+    def __init__(self):
+        self.sql_schema_cache = None
+        self.model_info_cache = None
+        self.metadata_refreshed_at = 0.0
+        self.connection_type = None  # 'sql' or 'semantic_model'
+        
+        # Phase 2: Advanced caching system
+        # cache_key -> _CacheEntry, kept in LRU order: hits move to the end,
+        # eviction pops the front
+        self.schema_cache: OrderedDict = OrderedDict()
+        # (expires_at, cache_key, version) min-heap, so cleanup only visits
+        # due entries; items for replaced, evicted or extended entries are
+        # skipped when popped
+        self._expiry_heap: List[Tuple[float, str, int]] = []
+        self._cache_versions = itertools.count()
+        # Periodic expiry sweep, run by start_cache_cleanup
+        self._cleanup_task: Optional[asyncio.Task] = None
+        self.cache_stats = {
+            "hits": 0,
+            "misses": 0,
+            "refreshes": 0,
+            "last_cleanup": time.time()
+        }
+        
+        # Cache configuration
+        self.cache_config = {
+            "default_ttl": 3600,  # 1 hour
+            "max_cache_size": 50,  # Max cached schemas
+            "cleanup_interval": 1800,  # 30 minutes
+            "performance_boost_ttl": 7200,  # 2 hours for frequently used schemas
+            "schema_list_ttl": 3600,  # formatted schema context built from the metadata
+            "metadata_ttl": 14400,  # discovered tables/columns; rediscovery is the expensive part
+            "llm_cache_size": 1024,  # memoized temperature-0 Claude responses
+            "llm_cache_ttl": 1800,  # 30 minutes
+            "cache_answers": True,  # answer prompts go through the LLM cache too (at temperature 0)
         }
         
+        # Prompt digest -> (response, expires_at), in LRU order
+        self._llm_cache: OrderedDict = OrderedDict()
+        # Generated/fixed query -> digest of the cached prompt it came from, so
+        # a query that fails to execute doesn't keep being served from cache
+        self._llm_query_sources: OrderedDict = OrderedDict()
+        
+        # Query similarity cache
+        self.query_similarity_cache = {}
+        self.entity_extraction_cache = {}
+        
+        # Bound concurrent query executions when candidates run speculatively
+        self._execution_sem = asyncio.Semaphore(8)
+        # Candidate executions still running, including abandoned losers
+        self._running_queries: Set[asyncio.Task] = set()
+        
+        # Knowledge base writes still in flight; held so they aren't garbage
+        # collected mid-write and can be flushed on shutdown
+        self._pending_writes: Set[asyncio.Task] = set()
+        
+        # Formatted per-table schema blocks, keyed by a hash of the table's
+        # structure; _table_block_keys maps (language, table) to its current key
+        self._table_block_cache: Dict[str, str] = {}
+        self._table_block_keys: Dict[Tuple[str, str], str] = {}
+        
+        # language -> (table signature, priority order) from the last computation
+        self._priority_cache: Dict[str, Tuple[Tuple, List[str]]] = {}
+        
+        # (template, schema_context, query_language) -> template with the
+        # per-schema placeholders already filled in, as (text, field) segments
+        self._partial_templates: Dict[Tuple[str, str, str], Tuple[Tuple[str, Optional[str]], ...]] = {}
+        
+        # Large schemas are cut down to the tables most relevant to the question
+        self.schema_token_budget = 6000  # estimated at ~4 characters per token
+        self.schema_pinned_tables = 3  # top-priority tables are always kept
+        # query_language -> (schema_context, blocks, block tokens, header, footer)
+        self._schema_split_cache: Dict[str, Tuple[str, List[str], List[List[str]], str, str]] = {}
+        
+        # A knowledge base hit at least this similar has its stored query
+        # executed directly instead of asking Claude for a new one
+        self.kb_reuse_threshold = 0.9
+        # Previous questions/queries quoted in prompts are cut off at this many chars
+        self.kb_context_budget = 4000
+        
+        # Language-specific query optimizer; anything that isn't T-SQL is DAX
+        self._optimizers = {"T-SQL": self._optimize_sql_advanced, "DAX": self._optimize_dax_advanced}
+
     def set_connection_type(self, connection_type: str):
         """Set whether we're using SQL or Semantic Model"""
         self.connection_type = connection_type
@@ -268,58 +726,69 @@ Generate ONLY the optimized {query_language} query:"""
     
     async def refresh_metadata(self):
         """Refresh schema/model metadata based on connection type"""
+        previous_tables = self._current_tables()
         if self.connection_type == "sql":
-            result = fabric_service.discover_schema()
+            # This service keeps its own longer-lived copy, so always rescan
+            result = fabric_service.discover_schema(refresh=True)
             if result.get("success"):
                 self.sql_schema_cache = result.get("tables", {})
+                self.metadata_refreshed_at = time.time()
         elif self.connection_type == "semantic_model":
             result = semantic_model_service.discover_model()
             if result.get("success"):
                 self.model_info_cache = result.get("model", {})
+                self.metadata_refreshed_at = time.time()
+        
+        if result.get("success"):
+            await self._invalidate_changed_tables(previous_tables, self._current_tables())
         return result
     
+    def _current_tables(self) -> Dict:
+        """Discovered tables for the active connection type"""
+        if self.connection_type == "sql":
+            return self.sql_schema_cache or {}
+        return (self.model_info_cache or {}).get("tables", {})
+    
+    def _metadata_expired(self) -> bool:
+        return time.time() - self.metadata_refreshed_at >= self.cache_config["metadata_ttl"]
+    
+    async def invalidate_table(self, table_name: str) -> None:
+        """Evict only the cached entries built from one table"""
+        language = "sql" if self.connection_type == "sql" else "dax"
+        block_key = self._table_block_keys.pop((language, table_name), None)
+        if block_key is not None:
+            self._table_block_cache.pop(block_key, None)
+        
+        schema_key = f"{self.connection_type}_schema_v2"
+        entry = self.schema_cache.get(schema_key)
+        if entry is not None and table_name in entry.tables:
+            await self._drop_cache_entry(schema_key)
+    
+    async def _invalidate_changed_tables(self, previous: Dict, current: Dict) -> None:
+        """Invalidate tables whose metadata changed between two discoveries"""
+        for table_name in previous.keys() | current.keys():
+            if previous.get(table_name) != current.get(table_name):
+                await self.invalidate_table(table_name)
+        
+        # A new table isn't in the cached schema context yet, so that entry
+        # has to be rebuilt to include it
+        if current.keys() - previous.keys():
+            await self._drop_cache_entry(f"{self.connection_type}_schema_v2")
+    
     async def manager_agent_with_knowledge(self, user_question: str, response_type: str = "text") -> Dict:
         """Enhanced manager that uses knowledge base and handles both SQL and DAX"""
-        # First, check knowledge base
-        similar_questions = knowledge_base_service.search_knowledge(user_question)
+        # The knowledge base lookup is a blocking DB round trip independent of
+        # the schema, so run it in a thread while the schema context is built
+        similar_questions, (schema_context, query_type) = await asyncio.gather(
+            asyncio.to_thread(knowledge_base_service.search_knowledge, user_question),
+            self._manager_schema_context()
+        )
         
         knowledge_context = ""
         if similar_questions:
-            knowledge_context = "\n\nPrevious similar questions and answers:\n"
-            for kb in similar_questions[:3]:
-                knowledge_context += f"Q: {kb['question']}\n"
-                if self.connection_type == "sql" and kb.get('sql_query'):
-                    knowledge_context += f"SQL: {kb['sql_query']}\n"
-                elif self.connection_type == "semantic_model" and kb.get('dax_query'):
-                    knowledge_context += f"DAX: {kb['dax_query']}\n"
-                knowledge_context += f"A: {kb['answer']}\n\n"
-        
-        # Build schema/model context
-        if self.connection_type == "sql":
-            if not self.sql_schema_cache:
-                await self.refresh_metadata()
-            
-            schema_context = "Available SQL tables and columns:\n"
-            for table_name, table_info in (self.sql_schema_cache or {}).items():
-                columns = [col["name"] for col in table_info["columns"]]
-                schema_context += f"\n{table_name}: {', '.join(columns)}"
-                
-            query_type = "SQL"
-            
-        else:  # semantic_model
-            if not self.model_info_cache:
-                await self.refresh_metadata()
-            
-            schema_context = "Available Power BI model structure:\n\nTables:\n"
-            for table_name, table_info in (self.model_info_cache or {}).get("tables", {}).items():
-                columns = [col["name"] for col in table_info["columns"]]
-                schema_context += f"\n{table_name}: {', '.join(columns)}"
-            
-            schema_context += "\n\nMeasures:\n"
-            for measure in (self.model_info_cache or {}).get("measures", []):
-                schema_context += f"\n{measure['name']}"
-                
-            query_type = "DAX"
+            knowledge_context = "\n\nPrevious similar questions and answers:\n" + _join_within_budget(
+                (self._format_knowledge_entry(kb) for kb in similar_questions), self.kb_context_budget
+            )
         
         # Create prompt for manager
         manager_prompt = f"""You are a data analyst manager. A user asked: "{user_question}"
@@ -335,6 +804,9 @@ Your task:
 1. Understand what data the user needs
 2. Create a {query_type} query to get the data
 3. If response_type is "visualization", plan what chart type would be best
+4. If the first result row alone answers the question, write an answer template
+   using {{column_name}} placeholders for that row's values ({{row_count}} is the
+   number of rows returned); otherwise leave it empty
 
 Respond in JSON format:
 {{
@@ -349,22 +821,60 @@ Respond in JSON format:
             "title": "chart title"
         }}
     }},
-    "explanation": "how this answers the question"
+    "explanation": "how this answers the question",
+    "answer_template": "e.g. Total revenue was {{TotalRevenue}}, or empty"
 }}"""
 
-        response = await claude_service.get_response(manager_prompt)
+        response = await self._cached_llm(manager_prompt, cacheable_through=schema_context)
         
-        try:
-            json_start = response.find('{')
-            json_end = response.rfind('}') + 1
-            if json_start >= 0 and json_end > json_start:
-                json_str = response[json_start:json_end]
-                return json.loads(json_str)
-        except:
-            logger.error(f"Failed to parse manager response: {response}")
+        plan = _extract_json_object(response)
+        if plan is not None:
+            if plan.get("query"):
+                self._remember_query_source(plan["query"], manager_prompt)
+            return plan
         
+        # Don't replay an unparseable plan for the next ask
+        await self._evict_llm_response(self._llm_key(manager_prompt))
+        logger.error(f"Failed to parse manager response: {response}")
         return {"error": "Failed to generate query plan"}
     
+    def _format_knowledge_entry(self, kb: Dict) -> str:
+        """One previous question/answer for the manager prompt"""
+        entry = f"Q: {kb['question']}\n"
+        if self.connection_type == "sql" and kb.get('sql_query'):
+            entry += f"SQL: {kb['sql_query']}\n"
+        elif self.connection_type == "semantic_model" and kb.get('dax_query'):
+            entry += f"DAX: {kb['dax_query']}\n"
+        return entry + f"A: {kb['answer']}\n\n"
+    
+    async def _manager_schema_context(self) -> Tuple[str, str]:
+        """Schema/model context for the manager prompt, with its query type"""
+        if self.connection_type == "sql":
+            if not self.sql_schema_cache:
+                await self.refresh_metadata()
+            
+            schema_context = "Available SQL tables and columns:\n"
+            for table_name, table_info in (self.sql_schema_cache or {}).items():
+                columns = [col["name"] for col in table_info["columns"]]
+                schema_context += f"\n{table_name}: {', '.join(columns)}"
+                
+            return schema_context, "SQL"
+        
+        # semantic_model
+        if not self.model_info_cache:
+            await self.refresh_metadata()
+        
+        schema_context = "Available Power BI model structure:\n\nTables:\n"
+        for table_name, table_info in (self.model_info_cache or {}).get("tables", {}).items():
+            columns = [col["name"] for col in table_info["columns"]]
+            schema_context += f"\n{table_name}: {', '.join(columns)}"
+        
+        schema_context += "\n\nMeasures:\n"
+        for measure in (self.model_info_cache or {}).get("measures", []):
+            schema_context += f"\n{measure['name']}"
+            
+        return schema_context, "DAX"
+    
     async def worker_agent_execute(self, task: Dict) -> Dict:
         """Execute SQL or DAX query based on connection type"""
         query = task.get("query")
@@ -417,32 +927,42 @@ Respond in JSON format:
                 
                 # Step 3: Generate text answer if needed
                 if response_type in ["text", "both"]:
-                    answer_prompt = f"""The user asked: "{user_question}"
+                    # Small results can fill the manager's template locally,
+                    # saving a second Claude round trip
+                    text_answer = None
+                    if response_type == "text" and len(data) <= 10:
+                        text_answer = self._render_answer_template(plan.get("answer_template"), data)
+                    
+                    if text_answer is None:
+                        answer_prompt = f"""The user asked: "{user_question}"
 
 Query executed: {plan.get('query')}
 Returned {len(data)} rows.
 
-Data: {json.dumps(data[:10], indent=2)}
+Data (tab-separated, first {min(len(data), 10)} rows):
+{_compact_rows(data, limit=10)}
 
 Provide a clear, natural language answer."""
 
-                    text_answer = await claude_service.get_response(answer_prompt)
+                        text_answer = await self._cached_llm(answer_prompt)
                     response["answer"] = text_answer
                 
                 # Step 4: Generate visualization if needed
                 if response_type in ["visualization", "both"] and plan.get("visualization", {}).get("needed"):
                     if data:
-                        df = pd.DataFrame(data)
                         viz_config = plan["visualization"]["config"]
                         chart_type = plan["visualization"]["chart_type"]
                         
-                        image_base64 = semantic_model_service.create_visualization(
-                            df, chart_type, viz_config
+                        # Rows go straight to typed column arrays; no DataFrame.
+                        # Rendering is CPU-bound, so keep it off the event loop.
+                        chart = await asyncio.to_thread(
+                            data_analysis_service.create_visualization,
+                            data, chart_type, viz_config.get("x_column"), viz_config.get("y_column")
                         )
                         
-                        if image_base64:
+                        if chart.get("success"):
                             response["visualization"] = {
-                                "image": image_base64,
+                                "image": chart["image"],
                                 "type": chart_type,
                                 "config": viz_config
                             }
@@ -462,10 +982,11 @@ Provide a clear, natural language answer."""
                     }
                 }
                 
-                knowledge_base_service.add_knowledge(knowledge_entry)
+                self._save_knowledge_in_background(knowledge_entry)
                 
                 return response
             else:
+                await self._forget_query_source(plan["query"])
                 return {
                     "answer": f"Query execution failed: {execution_result.get('error')}",
                     "query": plan.get("query"),
@@ -477,6 +998,90 @@ Provide a clear, natural language answer."""
                 "success": False
             }
     
+    async def _cached_llm(self, prompt: str, cacheable_through: Optional[str] = None) -> str:
+        """Deterministic (temperature 0) Claude call, memoized by prompt hash.
+        
+        When ``cacheable_through`` (normally the schema context) occurs in the
+        prompt, everything up to its end is sent as a prompt-cached prefix:
+        across retries and questions only the tail after the schema changes.
+        """
+        key = self._llm_key(prompt)
+        now = time.time()
+        cached = self._llm_cache.get(key)
+        if cached is not None and cached[1] > now:
+            self._llm_cache.move_to_end(key)
+            return cached[0]
+        
+        # A previous process may have already paid for this prompt
+        stored = await asyncio.to_thread(persistent_cache.get, f"llm:{key}")
+        if stored is not None:
+            self._remember_llm_response(key, stored["response"], stored["expires_at"])
+            return stored["response"]
+        
+        prefix, tail = None, prompt
+        cut = prompt.find(cacheable_through) if cacheable_through else -1
+        if cut >= 0 and cut + len(cacheable_through) < len(prompt):
+            cut += len(cacheable_through)
+            prefix, tail = prompt[:cut], prompt[cut:]
+        
+        response = await claude_service.get_response(tail, temperature=0, cacheable_prefix=prefix)
+        
+        # get_response reports failures as text; never cache those
+        if not response.startswith("Error:"):
+            ttl = self.cache_config["llm_cache_ttl"]
+            self._remember_llm_response(key, response, now + ttl)
+            await asyncio.to_thread(
+                persistent_cache.set, f"llm:{key}", {"response": response, "expires_at": now + ttl}, ttl
+            )
+        
+        return response
+    
+    @staticmethod
+    def _llm_key(prompt: str) -> str:
+        return hashlib.blake2b(prompt.encode(), digest_size=16).hexdigest()
+    
+    def _remember_query_source(self, query: str, prompt: str) -> None:
+        """Note which cached prompt produced a query, for _forget_query_source"""
+        self._llm_query_sources[query] = self._llm_key(prompt)
+        self._llm_query_sources.move_to_end(query)
+        while len(self._llm_query_sources) > self.cache_config["llm_cache_size"]:
+            self._llm_query_sources.popitem(last=False)
+    
+    async def _forget_query_source(self, query: str) -> None:
+        """Evict the cached LLM response a rejected query came from, in memory and on disk"""
+        key = self._llm_query_sources.pop(query, None)
+        if key is not None:
+            await self._evict_llm_response(key)
+    
+    async def _evict_llm_response(self, key: str) -> None:
+        """Drop one memoized LLM response, in memory and on disk"""
+        self._llm_cache.pop(key, None)
+        await asyncio.to_thread(persistent_cache.delete, f"llm:{key}")
+    
+    def _remember_llm_response(self, key: str, response: str, expires_at: float) -> None:
+        self._llm_cache[key] = (response, expires_at)
+        self._llm_cache.move_to_end(key)
+        while len(self._llm_cache) > self.cache_config["llm_cache_size"]:
+            self._llm_cache.popitem(last=False)
+    
+    def _render_answer_template(self, template: Optional[str], data: List[Dict]) -> Optional[str]:
+        """Fill an answer template from the first result row.
+        
+        Returns None when there is no template or any placeholder can't be
+        resolved, so the caller falls back to asking Claude.
+        """
+        if not template or not isinstance(template, str) or not data:
+            return None
+        
+        values = {**data[0], "row_count": len(data)}
+        try:
+            for _, field_name, _, _ in string.Formatter().parse(template):
+                if field_name is not None and field_name not in values:
+                    return None
+            return template.format_map(values)
+        except (ValueError, TypeError, KeyError, IndexError):
+            return None
+    
     async def answer_with_self_correction(self, question: str, context_history: List[str] = []) -> Dict:
         """
         Phase 1: Complete AI workflow with self-correction loop in backend.
@@ -490,22 +1095,33 @@ Provide a clear, natural language answer."""
         try:
             # Step 1: Context Preparation
             thinking_steps.append("🔍 Analyzing question and preparing context...")
-            schema_context, query_language = await self._get_schema_and_query_language()
+            # Step 2 (knowledge base lookup) doesn't depend on the schema, so
+            # its blocking DB round trip overlaps the schema fetch
+            (schema_context, query_language), similar_queries = await asyncio.gather(
+                self._get_schema_and_query_language(),
+                asyncio.to_thread(knowledge_base_service.search_knowledge, question, self.connection_type)
+            )
+            schema_context = self._fit_schema_to_budget(schema_context, question, query_language)
             thinking_steps.append(f"✅ Schema loaded: {query_language} ({len(schema_context)} chars)")
             
             # Step 2: Check Knowledge Base for Similar Questions
             thinking_steps.append("💡 Checking knowledge base for similar questions...")
-            similar_queries = knowledge_base_service.search_knowledge(question, self.connection_type)
             if similar_queries:
                 thinking_steps.append(f"📚 Found {len(similar_queries)} similar previous queries")
             else:
                 thinking_steps.append("📚 No similar queries found - generating fresh approach")
             
             # Step 3: Initial Query Generation
-            thinking_steps.append(f"🧠 Generating optimized {query_language} query...")
-            current_query = await self._generate_intelligent_query(
-                question, schema_context, query_language, context_history, similar_queries
-            )
+            reused_query = self._reusable_kb_query(similar_queries, query_language)
+            if reused_query:
+                thinking_steps.append("♻️ Reusing the query from a near-identical previous question")
+                candidates = [reused_query]
+            else:
+                thinking_steps.append(f"🧠 Generating optimized {query_language} query...")
+                candidates = await self._generate_candidate_queries(
+                    question, schema_context, query_language, context_history, similar_queries
+                )
+            current_query = candidates[0]
             thinking_steps.append(f"📝 Generated {len(current_query)} character query")
             
             # Step 4: Execution with Smart Retry Loop
@@ -513,16 +1129,23 @@ Provide a clear, natural language answer."""
             for attempt in range(max_attempts):
                 thinking_steps.append(f"⚡ Executing query (attempt {attempt + 1}/{max_attempts})...")
                 
-                execution_result = await self._execute_with_validation(current_query)
+                if attempt == 0 and len(candidates) > 1:
+                    # Race the alternative candidates; the first success wins
+                    thinking_steps.append(f"🧪 Trying {len(candidates)} candidate queries in parallel...")
+                    outcomes = await self._execute_first_success(candidates)
+                else:
+                    outcomes = [(current_query, await self._execute_with_validation(current_query))]
                 
-                query_attempts.append({
-                    "query": current_query,
-                    "success": execution_result["success"],
-                    "error": execution_result.get("error"),
-                    "attempt": attempt + 1,
-                    "duration": execution_result.get("duration", 0),
-                    "row_count": execution_result.get("row_count", 0)
-                })
+                for executed_query, execution_result in outcomes:
+                    query_attempts.append({
+                        "query": executed_query,
+                        "success": execution_result["success"],
+                        "error": execution_result.get("error"),
+                        "attempt": attempt + 1,
+                        "duration": execution_result.get("duration", 0),
+                        "row_count": execution_result.get("row_count", 0)
+                    })
+                current_query, execution_result = outcomes[-1]
                 
                 if execution_result["success"]:
                     thinking_steps.append(f"✅ Success! Found {execution_result.get('row_count', 0)} rows in {execution_result.get('duration', 0):.2f}s")
@@ -590,9 +1213,6 @@ Provide a clear, natural language answer."""
         """Enhanced schema retrieval with intelligent caching and performance optimization"""
         cache_key = f"{self.connection_type}_schema_v2"
         
-        # Check if we need cleanup first
-        await self._cleanup_expired_cache()
-        
         # Try to get from cache
         cached_result = await self._get_from_cache(cache_key)
         if cached_result:
@@ -611,7 +1231,10 @@ Provide a clear, natural language answer."""
                 schema_context, query_language = await self._fetch_and_optimize_dax_schema()
             
             # Cache the result with metadata
-            await self._store_in_cache(cache_key, (schema_context, query_language))
+            await self._store_in_cache(
+                cache_key, (schema_context, query_language),
+                tables=self._current_tables().keys(), ttl=self.cache_config["schema_list_ttl"]
+            )
             
             return schema_context, query_language
             
@@ -623,11 +1246,64 @@ Provide a clear, natural language answer."""
             else:
                 return "Model unavailable - using fallback mode", "DAX"
 
+    def _fit_schema_to_budget(self, schema_context: str, question: str, query_language: str) -> str:
+        """Trim an oversized schema context to the tables most relevant to the question.
+        
+        Table blocks are ranked with BM25 over their table and column names.
+        The highest-priority tables are always kept, and the kept blocks stay
+        in priority order. Contexts within budget are returned unchanged.
+        """
+        max_chars = self.schema_token_budget * 4
+        if len(schema_context) <= max_chars:
+            return schema_context
+        
+        split = self._schema_split_cache.get(query_language)
+        if split is None or split[0] != schema_context:
+            header, blocks, footer = self._split_schema_blocks(schema_context, query_language)
+            split = (schema_context, blocks, [_search_tokens(block) for block in blocks], header, footer)
+            self._schema_split_cache[query_language] = split
+        _, blocks, block_tokens, header, footer = split
+        if not blocks:
+            return schema_context
+        
+        scores = _bm25_scores(_search_tokens(question), block_tokens)
+        pinned = range(min(self.schema_pinned_tables, len(blocks)))
+        ranked = sorted(range(len(pinned), len(blocks)), key=lambda i: scores[i], reverse=True)
+        
+        # Pinned tables go in whatever the budget; the rest fill what remains
+        selected = list(pinned)
+        budget = max_chars - len(header) - len(footer) - sum(len(blocks[i]) for i in selected)
+        for i in ranked:
+            if budget < len(blocks[i]) and selected:
+                continue
+            selected.append(i)
+            budget -= len(blocks[i])
+        
+        omitted = len(blocks) - len(selected)
+        parts = [header]
+        parts.extend(blocks[i] for i in sorted(selected))
+        if omitted:
+            parts.append(f"\n({omitted} less relevant tables omitted)\n")
+        parts.append(footer)
+        return "".join(parts)
+    
+    @staticmethod
+    def _split_schema_blocks(schema_context: str, query_language: str) -> Tuple[str, List[str], str]:
+        """Split a generated schema context into (header, per-table blocks, footer)"""
+        if query_language == "DAX":
+            marker = schema_context.find(_DAX_MEASURES_MARKER)
+            body, footer = (schema_context, "") if marker < 0 else (schema_context[:marker], schema_context[marker:])
+            pieces = _DAX_BLOCK_RE.split(body)
+        else:
+            footer = ""
+            pieces = _SQL_BLOCK_RE.split(schema_context)
+        return pieces[0], pieces[1:], footer
+    
     async def _fetch_and_optimize_sql_schema(self) -> Tuple[str, str]:
         """Fetch and optimize SQL schema with intelligent prioritization"""
         
         # Refresh metadata if needed
-        if not self.sql_schema_cache:
+        if not self.sql_schema_cache or self._metadata_expired():
             result = await self.refresh_metadata()
             if not result.get("success"):
                 raise Exception("Failed to refresh SQL metadata")
@@ -637,36 +1313,48 @@ Provide a clear, natural language answer."""
         # Intelligent schema optimization
         optimized_schema = self._optimize_sql_schema_for_ai(schema)
         
-        schema_context = "Available Microsoft Fabric tables and columns:\n\n"
+        parts = ["Available Microsoft Fabric tables and columns:\n\n"]
         
         # Prioritize tables by importance and usage patterns
-        table_priority = self._calculate_table_priority(schema, "sql")
+        table_priority = self._cached_table_priority(schema, "sql")
         
         for table_name in table_priority:
             table_info = optimized_schema.get(table_name, {})
             columns = table_info.get('columns', [])
-            
-            # Create enhanced table description
-            schema_context += f"📊 {table_name}:\n"
-            
-            # Group columns by type for better AI understanding
-            column_groups = self._group_columns_by_type(columns)
-            
-            for group_name, group_columns in column_groups.items():
-                if group_columns:
-                    schema_context += f"  {group_name}: {', '.join(group_columns)}\n"
-            
-            # Add table metadata if available
-            row_estimate = table_info.get('estimated_rows', 'Unknown')
-            schema_context += f"  Estimated rows: {row_estimate}\n\n"
+            signature = (
+                tuple((col['name'], col.get('type', '')) for col in columns),
+                table_info.get('estimated_rows', 'Unknown')
+            )
+            parts.append(self._cached_table_block(
+                "sql", table_name, signature,
+                lambda: self._format_sql_table_block(table_name, table_info)
+            ))
+        
+        return "".join(parts), "T-SQL"
+    
+    def _format_sql_table_block(self, table_name: str, table_info: Dict) -> str:
+        """Format one table's section of the SQL schema context"""
+        # Create enhanced table description
+        parts = [f"📊 {table_name}:\n"]
+        
+        # Group columns by type for better AI understanding
+        column_groups = self._group_columns_by_type(table_info.get('columns', []))
+        
+        for group_name, group_columns in column_groups.items():
+            if group_columns:
+                parts.append(f"  {group_name}: {', '.join(group_columns)}\n")
+        
+        # Add table metadata if available
+        row_estimate = table_info.get('estimated_rows', 'Unknown')
+        parts.append(f"  Estimated rows: {row_estimate}\n\n")
         
-        return schema_context, "T-SQL"
+        return "".join(parts)
     
     async def _fetch_and_optimize_dax_schema(self) -> Tuple[str, str]:
         """Fetch and optimize Power BI schema with relationship awareness"""
         
         # Refresh metadata if needed
-        if not self.model_info_cache:
+        if not self.model_info_cache or self._metadata_expired():
             result = await self.refresh_metadata()
             if not result.get("success"):
                 raise Exception("Failed to refresh Power BI metadata")
@@ -674,45 +1362,82 @@ Provide a clear, natural language answer."""
         schema = self.model_info_cache or {}
         
         # Enhanced Power BI schema formatting
-        schema_context = "Available Power BI semantic model:\n\n"
+        parts = ["Available Power BI semantic model:\n\n"]
         
         # Tables with intelligent prioritization
         tables = schema.get("tables", {})
-        table_priority = self._calculate_table_priority(tables, "dax")
+        table_priority = self._cached_table_priority(tables, "dax")
         
-        schema_context += "📊 TABLES:\n"
+        parts.append("📊 TABLES:\n")
         for table_name in table_priority:
-            table_info = tables.get(table_name, {})
-            columns = table_info.get('columns', [])
-            
-            schema_context += f"\n'{table_name}':\n"
-            
-            # Categorize columns for better AI understanding
-            key_columns = [col['name'] for col in columns if 'key' in col['name'].lower() or 'id' in col['name'].lower()]
-            date_columns = [col['name'] for col in columns if any(date_term in col['name'].lower() for date_term in ['date', 'time', 'year', 'month'])]
-            measure_columns = [col['name'] for col in columns if any(measure_term in col['name'].lower() for measure_term in ['amount', 'total', 'sum', 'count', 'value'])]
-            other_columns = [col['name'] for col in columns if col['name'] not in key_columns + date_columns + measure_columns]
-            
-            if key_columns:
-                schema_context += f"  🔑 Keys: {', '.join(key_columns[:5])}\n"
-            if date_columns:
-                schema_context += f"  📅 Dates: {', '.join(date_columns[:5])}\n"
-            if measure_columns:
-                schema_context += f"  📈 Measures: {', '.join(measure_columns[:8])}\n"
-            if other_columns:
-                schema_context += f"  📝 Other: {', '.join(other_columns[:8])}\n"
+            columns = tables.get(table_name, {}).get('columns', [])
+            signature = tuple(col['name'] for col in columns)
+            parts.append(self._cached_table_block(
+                "dax", table_name, signature,
+                lambda: self._format_dax_table_block(table_name, columns)
+            ))
     
         # Add measures
         measures = schema.get("measures", [])
         if measures:
-            schema_context += "\n📈 CALCULATED MEASURES:\n"
+            parts.append("\n📈 CALCULATED MEASURES:\n")
             for measure in measures[:15]:  # Top 15 measures
-                schema_context += f"  • {measure['name']}\n"
+                parts.append(f"  • {measure['name']}\n")
                 
             if len(measures) > 15:
-                schema_context += f"  ... and {len(measures) - 15} more measures\n"
+                parts.append(f"  ... and {len(measures) - 15} more measures\n")
         
-        return schema_context, "DAX"
+        return "".join(parts), "DAX"
+    
+    def _format_dax_table_block(self, table_name: str, columns: List[Dict]) -> str:
+        """Format one table's section of the DAX schema context"""
+        parts = [f"\n'{table_name}':\n"]
+        
+        # Categorize columns for better AI understanding; a column can land in
+        # several categories, and in "other" only if it matched none.
+        # (np.char masks were measured ~1.5x slower than this loop even at
+        # 500 columns, and blocks are cached per table anyway.)
+        key_columns, date_columns, measure_columns, other_columns = [], [], [], []
+        for col in columns:
+            name = col['name']
+            name_lower = name.lower()
+            matched = False
+            if _DAX_KEY_RE.search(name_lower):
+                key_columns.append(name)
+                matched = True
+            if _DAX_DATE_RE.search(name_lower):
+                date_columns.append(name)
+                matched = True
+            if _DAX_MEASURE_RE.search(name_lower):
+                measure_columns.append(name)
+                matched = True
+            if not matched:
+                other_columns.append(name)
+        
+        if key_columns:
+            parts.append(f"  🔑 Keys: {', '.join(key_columns[:5])}\n")
+        if date_columns:
+            parts.append(f"  📅 Dates: {', '.join(date_columns[:5])}\n")
+        if measure_columns:
+            parts.append(f"  📈 Measures: {', '.join(measure_columns[:8])}\n")
+        if other_columns:
+            parts.append(f"  📝 Other: {', '.join(other_columns[:8])}\n")
+        
+        return "".join(parts)
+    
+    def _cached_table_block(self, language: str, table_name: str, signature: Tuple, build) -> str:
+        """Return a table's formatted schema block, building it only when its structure changed"""
+        digest = hashlib.blake2b(repr((language, table_name, signature)).encode(), digest_size=8).hexdigest()
+        block = self._table_block_cache.get(digest)
+        if block is None:
+            block = build()
+            # Evict only this table's previous block
+            stale = self._table_block_keys.get((language, table_name))
+            if stale is not None:
+                self._table_block_cache.pop(stale, None)
+            self._table_block_cache[digest] = block
+            self._table_block_keys[(language, table_name)] = digest
+        return block
     
     def _optimize_sql_schema_for_ai(self, schema: Dict) -> Dict:
         """Optimize SQL schema information for AI consumption"""
@@ -726,9 +1451,9 @@ Provide a clear, natural language answer."""
             
             # Filter out system columns
             filtered_columns = [
-                col for col in columns 
-                if not col['name'].lower().startswith('__') 
-                and col['name'].lower() not in ['rowguid', 'timestamp']
+                col for col in columns
+                if not (name_lower := col['name'].lower()).startswith('__')
+                and name_lower not in _SYSTEM_COLUMN_NAMES
             ]
             
             optimized[table_name] = {
@@ -740,93 +1465,80 @@ Provide a clear, natural language answer."""
         
         return optimized
     
+    def _cached_table_priority(self, schema: Dict, connection_type: str) -> List[str]:
+        """Table priority order, recomputed only when its inputs change.
+        
+        The score depends on the table name and which column-count band it
+        falls in, and ties keep schema order, so those make up the key.
+        """
+        signature = tuple(
+            (table_name, (len(table_info.get('columns', [])) > 5) + (len(table_info.get('columns', [])) > 10))
+            for table_name, table_info in schema.items()
+        )
+        cached = self._priority_cache.get(connection_type)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+        
+        table_priority = self._calculate_table_priority(schema, connection_type)
+        self._priority_cache[connection_type] = (signature, table_priority)
+        return table_priority
+    
     def _calculate_table_priority(self, schema: Dict, connection_type: str) -> List[str]:
         """Calculate table priority based on naming patterns and usage"""
         tables = list(schema.keys())
         
         # Priority scoring
-        priority_scores = {}
+        priority_scores = {
+            table_name: self._table_priority_score(table_name, len(table_info.get('columns', ())))
+            for table_name, table_info in schema.items()
+        }
         
-        for table_name in tables:
-            score = 0
-            table_lower = table_name.lower()
-            
-            # Business entity tables get higher priority
-            if any(entity in table_lower for entity in ['sales', 'customer', 'order', 'product', 'revenue']):
-                score += 100
-            
-            # Fact tables (for both SQL and Power BI)
-            if any(fact_term in table_lower for fact_term in ['fact', 'transaction', 'activity']):
-                score += 80
-            
-            # Dimension tables
-            if table_lower.startswith('dim') or any(dim_term in table_lower for dim_term in ['dimension', 'lookup']):
-                score += 60
-            
-            # Avoid system/temp tables
-            if any(sys_term in table_lower for sys_term in ['temp', 'tmp', 'sys', 'log', 'audit']):
-                score -= 50
-            
-            # Table size consideration (more columns = potentially more important)
-            if connection_type == 'sql':
-                column_count = len(schema[table_name].get('columns', []))
-            else:
-                column_count = len(schema[table_name].get('columns', []))
-            
-            if column_count > 10:
-                score += 20
-            elif column_count > 5:
-                score += 10
-            
-            priority_scores[table_name] = score
+        # Sort by priority score (highest first). Every caller lists all
+        # tables (the budget trim happens later, on the rendered blocks), so
+        # a full stable sort is needed rather than a top-k selection.
+        return sorted(tables, key=priority_scores.__getitem__, reverse=True)
+    
+    @staticmethod
+    @lru_cache(maxsize=512)
+    def _table_priority_score(table_name: str, column_count: int) -> int:
+        """Priority score for one table; pure in its arguments, so memoized"""
+        table_lower = table_name.lower()
+        
+        # Naming patterns: each role found adds its weight once
+        roles = {match.lastgroup for match in _TABLE_ROLE_RE.finditer(table_lower) if match.lastgroup}
+        if table_lower.startswith('dim'):
+            roles.add('dimension')
+        score = sum(_TABLE_ROLE_WEIGHTS[role] for role in roles)
+        
+        # Table size consideration (more columns = potentially more important)
+        if column_count > 10:
+            score += 20
+        elif column_count > 5:
+            score += 10
         
-        # Sort by priority score (highest first)
-        return sorted(tables, key=lambda t: priority_scores[t], reverse=True)
+        return score
     
     def _group_columns_by_type(self, columns: List[Dict]) -> Dict[str, List[str]]:
         """Group columns by logical types for better AI understanding"""
-        groups = {
-            "🔑 Keys/IDs": [],
-            "📅 Dates": [],
-            "📈 Measures": [],
-            "📝 Text": [],
-            "🔢 Numbers": [],
-            "🏷️ Categories": []
-        }
+        groups = {group: [] for group in _COLUMN_GROUPS}
         
         for col in columns:
             col_name = col['name']
-            col_type = col.get('type', '').lower()
-            col_name_lower = col_name.lower()
-            
-            # Categorize by name patterns
-            if any(key_term in col_name_lower for key_term in ['id', 'key', 'guid']):
-                groups["🔑 Keys/IDs"].append(col_name)
-            elif any(date_term in col_name_lower for date_term in ['date', 'time', 'created', 'modified']):
-                groups["📅 Dates"].append(col_name)
-            elif any(measure_term in col_name_lower for measure_term in ['amount', 'total', 'price', 'cost', 'revenue', 'sum']):
-                groups["📈 Measures"].append(col_name)
-            elif any(text_type in col_type for text_type in ['varchar', 'nvarchar', 'text', 'string']):
-                if any(cat_term in col_name_lower for cat_term in ['name', 'description', 'category', 'type', 'status']):
-                    groups["🏷️ Categories"].append(col_name)
-                else:
-                    groups["📝 Text"].append(col_name)
-            elif any(num_type in col_type for num_type in ['int', 'decimal', 'float', 'numeric', 'money']):
-                groups["🔢 Numbers"].append(col_name)
-            else:
-                groups["📝 Text"].append(col_name)  # Default fallback
+            groups[_column_group(col_name, col.get('type', ''))].append(col_name)
         
         # Remove empty groups and limit items per group
         return {k: v[:8] for k, v in groups.items() if v}
     
-    def _estimate_table_size(self, table_name: str, column_count: int) -> str:
+    @staticmethod
+    @lru_cache(maxsize=512)
+    def _estimate_table_size(table_name: str, column_count: int) -> str:
         """Estimate table size based on naming patterns and column count"""
         table_lower = table_name.lower()
         
         # Heuristic-based estimation
-        if any(large_term in table_lower for large_term in ['fact', 'transaction', 'log', 'history']):
+        if _LARGE_TABLE_RE.search(table_lower):
             return "Large (1M+ rows)"
-        elif any(medium_term in table_lower for medium_term in ['sales', 'order', 'customer']):
+        elif _MEDIUM_TABLE_RE.search(table_lower):
             return "Medium (10K-1M rows)"
         elif column_count > 15:
             return "Medium (10K-1M rows)"
@@ -835,95 +1547,128 @@ Provide a clear, natural language answer."""
     
     async def _get_from_cache(self, cache_key: str) -> Optional[Tuple[str, str]]:
         """Get data from cache with TTL checking"""
-        if cache_key not in self.schema_cache:
-            return None
-        
-        cached_data = self.schema_cache[cache_key]
-        metadata = self.schema_metadata.get(cache_key, {})
+        entry = self.schema_cache.get(cache_key)
+        if entry is None:
+            # Fall back to the on-disk copy left by a previous process
+            stored = await asyncio.to_thread(persistent_cache.get, self._persistent_key(cache_key))
+            if stored is None:
+                return None
+            await self._store_in_cache(
+                cache_key, tuple(stored["data"]), tables=stored["tables"],
+                ttl=max(1, stored["expires_at"] - time.time()), persist=False
+            )
+            entry = self.schema_cache[cache_key]
         
-        current_time = time.time()
-        cache_time = metadata.get('cached_at', 0)
-        ttl = metadata.get('ttl', self.cache_config['default_ttl'])
+        current_time = time.monotonic()
         
         # Check if cache is still valid
-        if current_time - cache_time < ttl:
+        if current_time - entry.cached_at < entry.ttl:
             # Update access time for LRU
-            metadata['last_accessed'] = current_time
-            metadata['access_count'] = metadata.get('access_count', 0) + 1
+            self.schema_cache.move_to_end(cache_key)
+            entry.last_accessed = current_time
+            entry.access_count += 1
             
             # Extend TTL for frequently accessed schemas
-            if metadata['access_count'] > 5:
-                metadata['ttl'] = self.cache_config['performance_boost_ttl']
+            if entry.access_count > 5 and entry.ttl != self.cache_config['performance_boost_ttl']:
+                entry.ttl = self.cache_config['performance_boost_ttl']
+                heapq.heappush(self._expiry_heap, (entry.expires_at, cache_key, entry.version))
             
-            return cached_data
+            return entry.data
         else:
             # Cache expired
             del self.schema_cache[cache_key]
-            del self.schema_metadata[cache_key]
             return None
     
-    async def _store_in_cache(self, cache_key: str, data: Tuple[str, str]) -> None:
-        """Store data in cache with metadata"""
-        current_time = time.time()
-        
-        # Check cache size limit
-        if len(self.schema_cache) >= self.cache_config['max_cache_size']:
-            await self._evict_least_used()
-        
-        self.schema_cache[cache_key] = data
-        self.schema_metadata[cache_key] = {
-            'cached_at': current_time,
-            'last_accessed': current_time,
-            'access_count': 1,
-            'ttl': self.cache_config['default_ttl'],
-            'size_bytes': len(str(data))
-        }
+    async def _store_in_cache(self, cache_key: str, data: Tuple[str, str],
+                              tables=(), ttl: Optional[int] = None, persist: bool = True) -> None:
+        """Store data in cache with metadata; ``tables`` lists the tables it was built from"""
+        current_time = time.monotonic()
+        ttl = ttl or self.cache_config['default_ttl']
+        tables = frozenset(tables)
+        
+        # Check cache size limit; the least recently used entry is at the front
+        if cache_key not in self.schema_cache:
+            while self.schema_cache and len(self.schema_cache) >= self.cache_config['max_cache_size']:
+                lru_key, _ = self.schema_cache.popitem(last=False)
+                logger.info(f"🗑️ Evicted cache entry: {lru_key}")
+        
+        entry = _CacheEntry(data, current_time, ttl, tables, next(self._cache_versions))
+        self.schema_cache[cache_key] = entry
+        self.schema_cache.move_to_end(cache_key)
+        heapq.heappush(self._expiry_heap, (entry.expires_at, cache_key, entry.version))
+        
+        if persist:
+            await asyncio.to_thread(
+                persistent_cache.set,
+                self._persistent_key(cache_key),
+                {"data": list(data), "tables": sorted(tables), "expires_at": time.time() + ttl},
+                ttl
+            )
         
         self.cache_stats["refreshes"] += 1
         logger.info(f"📦 Cached schema for {cache_key}")
     
-    async def _evict_least_used(self) -> None:
-        """Evict least recently used cache entries"""
-        if not self.schema_metadata:
-            return
-        
-        # Find least recently accessed
-        lru_key = min(
-            self.schema_metadata.keys(),
-            key=lambda k: self.schema_metadata[k]['last_accessed']
-        )
-        
-        del self.schema_cache[lru_key]
-        del self.schema_metadata[lru_key]
-        
-        logger.info(f"🗑️ Evicted cache entry: {lru_key}")
+    def _persistent_key(self, cache_key: str) -> str:
+        """On-disk key, scoped to the connected source so a restart against
+        a different server or dataset can't pick up another schema"""
+        if self.connection_type == "sql":
+            scope = f"{fabric_service.server}/{fabric_service.database}"
+        else:
+            scope = f"{semantic_model_service.xmla_endpoint}/{semantic_model_service.dataset_name}"
+        return f"schema:{scope}:{cache_key}"
+    
+    async def _drop_cache_entry(self, cache_key: str) -> None:
+        """Remove one cache entry if present"""
+        # In memory first, so nothing reads the entry while the on-disk delete runs
+        if self.schema_cache.pop(cache_key, None) is not None:
+            logger.info(f"🗑️ Invalidated cache entry: {cache_key}")
+        await asyncio.to_thread(persistent_cache.delete, self._persistent_key(cache_key))
     
     async def _cleanup_expired_cache(self) -> None:
         """Clean up expired cache entries"""
-        current_time = time.time()
-        
-        # Only run cleanup every 30 minutes
-        if current_time - self.cache_stats["last_cleanup"] < self.cache_config["cleanup_interval"]:
-            return
+        current_time = time.monotonic()
         
         expired_keys = []
-        for cache_key, metadata in self.schema_metadata.items():
-            cache_time = metadata.get('cached_at', 0)
-            ttl = metadata.get('ttl', self.cache_config['default_ttl'])
-            
-            if current_time - cache_time >= ttl:
-                expired_keys.append(cache_key)
-        
-        # Remove expired entries
-        for key in expired_keys:
-            del self.schema_cache[key]
-            del self.schema_metadata[key]
+        heap = self._expiry_heap
+        while heap and heap[0][0] <= current_time:
+            _, cache_key, version = heapq.heappop(heap)
+            entry = self.schema_cache.get(cache_key)
+            # Stale item: the entry was replaced, removed or had its TTL extended
+            if entry is None or entry.version != version or entry.expires_at > current_time:
+                continue
+            del self.schema_cache[cache_key]
+            expired_keys.append(cache_key)
         
-        self.cache_stats["last_cleanup"] = current_time
+        self.cache_stats["last_cleanup"] = time.time()
+        await asyncio.to_thread(persistent_cache.purge_expired)
         
         if expired_keys:
             logger.info(f"🧹 Cleaned up {len(expired_keys)} expired cache entries")
     
+    async def _cleanup_cache_forever(self) -> None:
+        """Run cache cleanup every cleanup_interval, off the request path"""
+        while True:
+            await asyncio.sleep(self.cache_config["cleanup_interval"])
+            try:
+                await self._cleanup_expired_cache()
+            except Exception as e:
+                logger.error(f"Background cache cleanup failed: {str(e)}")
+    
+    def start_cache_cleanup(self) -> None:
+        """Start the background cleanup on the running loop (idempotent)"""
+        if self._cleanup_task is None or self._cleanup_task.done():
+            self._cleanup_task = asyncio.get_running_loop().create_task(self._cleanup_cache_forever())
+    
+    async def stop_cache_cleanup(self) -> None:
+        """Cancel the background cleanup"""
+        task, self._cleanup_task = self._cleanup_task, None
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+    
     def get_cache_stats(self) -> Dict:
         """Get cache performance statistics"""
         total_requests = self.cache_stats["hits"] + self.cache_stats["misses"]
@@ -939,42 +1684,31 @@ Provide a clear, natural language answer."""
             "last_cleanup": datetime.fromtimestamp(self.cache_stats["last_cleanup"]).isoformat()
         }
 
-    def _categorize_error(self, error_message: str) -> str:
+    @staticmethod
+    @lru_cache(maxsize=512)
+    def _categorize_error(error_message: str) -> str:
         """Categorize errors for targeted fixing strategies"""
         if not error_message:
             return "UNKNOWN_ERROR"
-            
-        error_lower = error_message.lower()
-        
-        # Schema-related errors
-        if any(term in error_lower for term in ["invalid column name", "invalid object name", "cannot be found", "not found"]):
-            return "SCHEMA_ERROR"
         
-        # Syntax errors
-        elif any(term in error_lower for term in ["syntax error", "incorrect syntax", "expected", "unexpected"]):
-            return "SYNTAX_ERROR"
-        
-        # Permission errors
-        elif any(term in error_lower for term in ["permission", "access", "denied", "unauthorized"]):
-            return "PERMISSION_ERROR"
-        
-        # Timeout errors
-        elif any(term in error_lower for term in ["timeout", "cancelled", "aborted"]):
-            return "TIMEOUT_ERROR"
-        
-        # Calculation errors
-        elif any(term in error_lower for term in ["division by zero", "arithmetic overflow", "conversion failed"]):
-            return "CALCULATION_ERROR"
-        
-        # DAX-specific errors
-        elif any(term in error_lower for term in ["evaluate", "dax", "measure", "table expression"]):
-            return "DAX_ERROR"
-        
-        else:
-            return "GENERAL_ERROR"
+        # One scan over the message; the earliest-listed category seen wins
+        best = len(_ERROR_CATEGORIES)
+        for match in _ERROR_CATEGORY_RE.finditer(error_message):
+            best = min(best, _ERROR_CATEGORY_RANK[match.lastgroup])
+            if best == 0:
+                break
+        return _ERROR_CATEGORIES[best][0] if best < len(_ERROR_CATEGORIES) else "GENERAL_ERROR"
 
     async def _execute_with_validation(self, query: str) -> Dict:
         """Execute query with validation and performance monitoring"""
+        result = await self._validate_and_execute(query)
+        if not result.get("success"):
+            # Asking again must generate afresh rather than replay this query
+            await self._forget_query_source(query)
+        return result
+    
+    async def _validate_and_execute(self, query: str) -> Dict:
+        """Safety check, then run the query off the event loop, timed"""
         try:
             # Pre-execution validation
             validation_result = self._validate_query_safety(query)
@@ -984,15 +1718,15 @@ Provide a clear, natural language answer."""
                     "error": f"Query validation failed: {validation_result['reason']}"
                 }
             
-            # Execute with timing
-            start_time = time.time()
+            # Execute with timing; the drivers block, so run them off the event loop
+            start_time = time.monotonic()
             
             if self.connection_type == "sql":
-                result = fabric_service.execute_query(query, limit=1000)
+                result = await asyncio.to_thread(fabric_service.execute_query, query, limit=1000)
             else:
-                result = semantic_model_service.execute_dax_query(query)
+                result = await asyncio.to_thread(semantic_model_service.execute_dax_query, query)
             
-            duration = time.time() - start_time
+            duration = time.monotonic() - start_time
             
             if result.get("success"):
                 result["duration"] = duration
@@ -1012,24 +1746,32 @@ Provide a clear, natural language answer."""
 
     def _validate_query_safety(self, query: str) -> Dict:
         """Validate query for safety and performance concerns"""
+        return self._query_safety(query, self.connection_type)
+    
+    @staticmethod
+    @lru_cache(maxsize=512)
+    def _query_safety(query: str, connection_type: str) -> Dict:
+        """Safety verdict for a query; retries often re-validate the same text.
+        
+        The result is shared between calls, so callers must not mutate it.
+        """
         if not query or not query.strip():
             return {"safe": False, "reason": "Empty query"}
         
         query_upper = query.upper()
         
         # Check for dangerous operations
-        dangerous_keywords = ["DROP", "DELETE", "TRUNCATE", "ALTER", "EXEC", "EXECUTE", "INSERT", "UPDATE"]
-        for keyword in dangerous_keywords:
-            if keyword in query_upper and "CREATE" not in query_upper:  # Allow CREATE statements
-                return {"safe": False, "reason": f"Dangerous operation detected: {keyword}"}
+        dangerous = _DANGEROUS_KEYWORD_RE.search(query)
+        if dangerous and "CREATE" not in query_upper:  # Allow CREATE statements
+            return {"safe": False, "reason": f"Dangerous operation detected: {dangerous.group().upper()}"}
         
         # Performance concerns for SQL
-        if self.connection_type == "sql":
+        if connection_type == "sql":
             if "SELECT *" in query_upper and "TOP" not in query_upper and "LIMIT" not in query_upper:
                 return {"safe": False, "reason": "SELECT * without TOP/LIMIT clause can cause performance issues"}
         
         # Basic DAX validation
-        if self.connection_type == "semantic_model":
+        if connection_type == "semantic_model":
             if not query_upper.startswith("EVALUATE"):
                 return {"safe": False, "reason": "DAX queries must start with EVALUATE"}
         
@@ -1053,15 +1795,101 @@ Provide a clear, natural language answer."""
                 }
             }
             
-            knowledge_base_service.add_knowledge(knowledge_entry)
-            logger.info(f"Added successful query to knowledge base: {question[:50]}...")
+            self._save_knowledge_in_background(knowledge_entry)
+            logger.info(f"Queued successful query for knowledge base: {question[:50]}...")
             
         except Exception as e:
             logger.warning(f"Failed to update knowledge base: {e}")
             # Don't fail the main operation if knowledge base update fails
     
+    def _save_knowledge_in_background(self, knowledge_entry: Dict) -> None:
+        """Write to the knowledge base off the response's critical path"""
+        task = asyncio.create_task(asyncio.to_thread(knowledge_base_service.add_knowledge, knowledge_entry))
+        self._pending_writes.add(task)
+        task.add_done_callback(self._knowledge_write_done)
+    
+    def _knowledge_write_done(self, task: asyncio.Task) -> None:
+        self._pending_writes.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning(f"Failed to update knowledge base: {task.exception()}")
+    
+    async def flush_pending_writes(self) -> None:
+        """Wait for queued knowledge base writes to finish"""
+        if self._pending_writes:
+            await asyncio.gather(*self._pending_writes, return_exceptions=True)
+    
+    async def _generate_candidate_queries(self, question: str, schema_context: str, query_language: str,
+                                          context_history: List[str], similar_queries: List[Dict]) -> List[str]:
+        """Generate the primary query plus a base-template alternative concurrently"""
+        question_analysis = self._analyze_question_complexity(question)
+        template_keys = [self._select_prompt_template(question_analysis, query_language)]
+        
+        # A specialized template can miss; the base prompt gives a genuinely
+        # different candidate. Identical prompts would only duplicate work.
+        if template_keys[0] != "base":
+            template_keys.append("base")
+        
+        queries = await asyncio.gather(*(
+            self._generate_intelligent_query(
+                question, schema_context, query_language, context_history, similar_queries, template_key=key
+            )
+            for key in template_keys
+        ))
+        return list(dict.fromkeys(queries))
+    
+    def _reusable_kb_query(self, similar_queries: List[Dict], query_language: str) -> Optional[str]:
+        """Stored query of the best knowledge base hit, if it is similar enough to reuse"""
+        if not similar_queries:
+            return None
+        
+        # Exact hash matches come back without a similarity score
+        best = max(similar_queries, key=lambda kb: kb.get('similarity', 1.0))
+        if best.get('similarity', 1.0) <= self.kb_reuse_threshold:
+            return None
+        
+        query = best.get('dax_query' if query_language == "DAX" else 'sql_query')
+        return query.strip() if query and query.strip() else None
+    
+    def _finish_execution(self, execution: asyncio.Task) -> None:
+        """Return a finished candidate execution's permit"""
+        self._running_queries.discard(execution)
+        self._execution_sem.release()
+    
+    async def _execute_first_success(self, queries: List[str]) -> List[Tuple[str, Dict]]:
+        """Execute candidate queries concurrently, returning at the first success.
+        
+        Returns the (query, result) pairs that finished, in completion order;
+        when any candidate succeeded it is the last pair. Losing queries are
+        abandoned, not cancelled: a query already running in a worker thread
+        can't be stopped, so it runs to completion in the background, keeping
+        its execution permit (and pooled connection) until it does.
+        """
+        async def run(query: str) -> Tuple[str, Dict]:
+            await self._execution_sem.acquire()
+            execution = asyncio.ensure_future(self._execute_with_validation(query))
+            self._running_queries.add(execution)
+            execution.add_done_callback(self._finish_execution)
+            # Cancelling this wrapper abandons the execution without releasing its permit early
+            return query, await asyncio.shield(execution)
+        
+        pending = {asyncio.create_task(run(query)) for query in queries}
+        finished = []
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                outcomes = sorted((task.result() for task in done), key=lambda outcome: outcome[1]["success"])
+                finished.extend(outcomes)
+                if finished[-1][1]["success"]:
+                    break
+        finally:
+            for task in pending:
+                task.cancel()
+        
+        return finished
+    
     async def _generate_intelligent_query(self, question: str, schema_context: str, query_language: str, 
-                                          context_history: List[str], similar_queries: List[Dict]) -> str:
+                                          context_history: List[str], similar_queries: List[Dict],
+                                          template_key: Optional[str] = None) -> str:
         """Enhanced query generation with advanced context awareness"""
         
         try:
@@ -1074,20 +1902,22 @@ Provide a clear, natural language answer."""
             )
             
             # Select appropriate prompt template
-            template_key = self._select_prompt_template(question_analysis, query_language)
+            if template_key is None:
+                template_key = self._select_prompt_template(question_analysis, query_language)
             template_lang_key = "dax_generation" if query_language == "DAX" else "sql_generation"
-            template = self.advanced_prompt_templates[template_lang_key][template_key]
+            template = _ADVANCED_PROMPT_TEMPLATES[template_lang_key][template_key]
             
             # Build the complete prompt
             prompt = self._build_contextual_prompt(
                 template, question, schema_context, context_sections, question_analysis, query_language
             )
             
-            response = await claude_service.get_response(prompt)
+            response = await self._cached_llm(prompt, cacheable_through=schema_context)
             cleaned_query = self._clean_query_response(response, query_language)
             
             # Apply advanced query optimization
             optimized_query = self._apply_advanced_optimization(cleaned_query, query_language, question_analysis)
+            self._remember_query_source(optimized_query, prompt)
             
             logger.info(f"Generated {query_language} query ({len(optimized_query)} chars) using template '{template_key}'")
             return optimized_query
@@ -1105,9 +1935,9 @@ Provide a clear, natural language answer."""
         error_analysis = self._analyze_error_details(error, error_type, failed_query)
         
         # Select appropriate fixing template
-        fix_template = self.advanced_prompt_templates["error_fixing"].get(
+        fix_template = _ADVANCED_PROMPT_TEMPLATES["error_fixing"].get(
             error_type.lower() + "_error", 
-            self.advanced_prompt_templates["error_fixing"]["syntax_error"]
+            _ADVANCED_PROMPT_TEMPLATES["error_fixing"]["syntax_error"]
         )
         
         # Build fixing context
@@ -1123,11 +1953,12 @@ Provide a clear, natural language answer."""
         )
         
         try:
-            response = await claude_service.get_response(prompt)
+            response = await self._cached_llm(prompt, cacheable_through=schema_context)
             fixed_query = self._clean_query_response(response, query_language)
             
             # Apply post-fix optimizations
             optimized_fix = self._apply_post_fix_optimizations(fixed_query, error_type, query_language)
+            self._remember_query_source(optimized_fix, prompt)
             
             logger.info(f"Applied enhanced {error_type} fix: {len(optimized_fix)} chars")
             return optimized_fix
@@ -1147,12 +1978,8 @@ Provide a clear, natural language answer."""
         # Remove markdown code blocks
         if '```' in cleaned:
             # Extract content from code blocks
-            patterns = [
-                r'```(?:sql|dax|tsql)?\s*(.*?)\s*```',
-                r'```\s*(.*?)\s*```'
-            ]
-            for pattern in patterns:
-                match = re.search(pattern, cleaned, re.DOTALL | re.IGNORECASE)
+            for pattern in _CODE_BLOCK_RES:
+                match = pattern.search(cleaned)
                 if match:
                     cleaned = match.group(1).strip()
                     break
@@ -1164,11 +1991,10 @@ Provide a clear, natural language answer."""
         cleaned = cleaned.replace('`', '')
         
         # Remove language prefixes
-        cleaned = re.sub(r'^(sql|dax|t-sql|tsql):\s*', '', cleaned, flags=re.IGNORECASE)
+        cleaned = _LANG_PREFIX_RE.sub('', cleaned)
         
-        # Clean up whitespace
-        lines = [line.strip() for line in cleaned.split('\n') if line.strip()]
-        cleaned = '\n'.join(lines)
+        # Clean up whitespace: strip every line and drop blank ones
+        cleaned = _LINE_BREAK_RE.sub('\n', cleaned).strip()
         
         # Apply language-specific cleaning
         if query_language == "T-SQL":
@@ -1181,32 +2007,30 @@ Provide a clear, natural language answer."""
     def _clean_sql_query(self, query: str) -> str:
         """Apply SQL-specific cleaning"""
         # Ensure TOP clause is present for SELECT statements
-        if query.upper().startswith('SELECT') and 'TOP' not in query.upper() and 'LIMIT' not in query.upper():
-            query = re.sub(r'^SELECT\s+', 'SELECT TOP 100 ', query, flags=re.IGNORECASE)
+        if not _ROW_LIMIT_RE.search(query):
+            query = _SELECT_PREFIX_RE.sub('SELECT TOP 100 ', query)
         
         # Replace LIMIT with TOP
-        query = re.sub(r'\s+LIMIT\s+(\d+)', r' TOP \1', query, flags=re.IGNORECASE)
+        query = _LIMIT_RE.sub(r' TOP \1', query)
         
         # Fix common SQL patterns
-        query = re.sub(r'\bILIKE\b', 'LIKE', query, flags=re.IGNORECASE)
+        query = _ILIKE_RE.sub('LIKE', query)
         
         return query.strip()
 
     def _clean_dax_query(self, query: str) -> str:
         """Apply DAX-specific cleaning"""
         # Ensure EVALUATE is present
-        if not query.upper().startswith('EVALUATE'):
+        if not _EVALUATE_RE.match(query):
             # Check if it looks like a table expression
-            if any(func in query.upper() for func in ['SUMMARIZE', 'FILTER', 'CALCULATE', 'TOPN']):
+            if _DAX_TABLE_FUNC_RE.search(query):
                 query = 'EVALUATE\n' + query
             elif query and not query.startswith('{'):
                 # Likely a table name
                 query = f'EVALUATE {query}'
         
         # Remove any SQL artifacts
-        query = re.sub(r'\bSELECT\s+', '', query, flags=re.IGNORECASE)
-        query = re.sub(r'\bFROM\s+', '', query, flags=re.IGNORECASE)
-        query = re.sub(r'\bWHERE\s+', 'FILTER(', query, flags=re.IGNORECASE)
+        query = _SQL_ARTIFACT_RE.sub(lambda m: _SQL_ARTIFACTS[m.group(1).lower()], query)
         
         return query.strip()
 
@@ -1214,156 +2038,86 @@ Provide a clear, natural language answer."""
         """Apply final optimizations to the query"""
         if query_language == "T-SQL":
             # Ensure reasonable TOP limit
-            if 'TOP' in query.upper():
-                query = re.sub(r'TOP\s+(\d{4,})', 'TOP 1000', query, flags=re.IGNORECASE)
+            query = _TOP_BIG_RE.sub('TOP 1000', query)
         
         elif query_language == "DAX":
             # Add TOPN wrapper if query might return too many rows
-            if 'TOPN(' not in query.upper() and 'EVALUATE' in query.upper():
+            if not _TOPN_CALL_RE.search(query) and _EVALUATE_RE.search(query):
                 # Only wrap simple table evaluations
-                table_pattern = r'EVALUATE\s+([\'"]?\w+[\'"]?)\s*$'
-                if re.match(table_pattern, query.strip(), re.IGNORECASE):
-                    table_match = re.match(table_pattern, query.strip(), re.IGNORECASE)
-                    if table_match:
-                        table_name = table_match.group(1)
-                        query = f'EVALUATE\nTOPN(100, {table_name})'
+                table_match = _TABLE_EVAL_RE.match(query.strip())
+                if table_match:
+                    table_name = table_match.group(1)
+                    query = f'EVALUATE\nTOPN(100, {table_name})'
         
         return query
 
     # --- New Advanced Prompt Engineering Methods ---
-    def _analyze_question_complexity(self, question: str) -> Dict:
+    def _analyze_question_complexity(self, question: str) -> _QuestionAnalysis:
         """Analyze question complexity and requirements"""
         
         question_lower = question.lower()
         
-        analysis = {
-            'complexity': 'simple',
-            'requires_joins': False,
-            'requires_aggregation': False,
-            'requires_time_analysis': False,
-            'requires_filtering': False,
-            'aggregation_type': None,
-            'time_dimension': None,
-            'grouping_requirements': [],
-            'business_entities': [],
-            'operations': [],
-            'question_intent': self._classify_detailed_intent(question_lower)
-        }
-        
-        # Detect complexity indicators
-        complexity_indicators = {
-            'joins': ['customer', 'product', 'order', 'between', 'and', 'with', 'from'],
-            'aggregation': ['total', 'sum', 'count', 'average', 'max', 'min', 'by'],
-            'time': ['year', 'month', 'quarter', 'daily', 'weekly', 'trend', 'over time'],
-            'filtering': ['where', 'filter', 'only', 'specific', 'particular', 'certain']
-        }
-        
-        # Check for complexity indicators
-        for category, indicators in complexity_indicators.items():
-            if any(indicator in question_lower for indicator in indicators):
-                if category == 'joins':
-                    analysis['requires_joins'] = True
-                elif category == 'aggregation':
-                    analysis['requires_aggregation'] = True
-                elif category == 'time':
-                    analysis['requires_time_analysis'] = True
-                elif category == 'filtering':
-                    analysis['requires_filtering'] = True
-        
-        # Determine aggregation type
-        if 'total' in question_lower or 'sum' in question_lower:
-            analysis['aggregation_type'] = 'SUM'
-        elif 'count' in question_lower or 'how many' in question_lower:
-            analysis['aggregation_type'] = 'COUNT'
-        elif 'average' in question_lower or 'mean' in question_lower:
-            analysis['aggregation_type'] = 'AVERAGE'
-        elif 'max' in question_lower or 'highest' in question_lower:
-            analysis['aggregation_type'] = 'MAX'
-        elif 'min' in question_lower or 'lowest' in question_lower:
-            analysis['aggregation_type'] = 'MIN'
-        
-        # Determine time dimension
-        if any(time_word in question_lower for time_word in ['year', 'yearly', 'annual']):
-            analysis['time_dimension'] = 'YEAR'
-        elif any(time_word in question_lower for time_word in ['month', 'monthly']):
-            analysis['time_dimension'] = 'MONTH'
-        elif any(time_word in question_lower for time_word in ['quarter', 'quarterly']):
-            analysis['time_dimension'] = 'QUARTER'
-        
-        # Determine grouping requirements
-        group_patterns = [
-            r'by (\w+)',
-            r'per (\w+)',
-            r'for each (\w+)',
-            r'(\w+) breakdown'
-        ]
-        
-        for pattern in group_patterns:
-            matches = re.findall(pattern, question_lower)
-            analysis['grouping_requirements'].extend(matches)
+        # Complexity indicators, aggregation type, time dimension and
+        # grouping requirements, all from one memoized pass
+        tags = _question_tags(question_lower)
+        analysis = _QuestionAnalysis(
+            question_intent=self._classify_detailed_intent(question_lower),
+            requires_joins=tags.get('requires_joins', False),
+            requires_aggregation=tags.get('requires_aggregation', False),
+            requires_time_analysis=tags.get('requires_time_analysis', False),
+            requires_filtering=tags.get('requires_filtering', False),
+            aggregation_type=tags.get('aggregation_type'),
+            time_dimension=tags.get('time_dimension'),
+            grouping_requirements=list(tags['grouping'])
+        )
         
         # Calculate overall complexity
         complexity_score = 0
-        if analysis['requires_joins']: complexity_score += 2
-        if analysis['requires_aggregation']: complexity_score += 1
-        if analysis['requires_time_analysis']: complexity_score += 1
-        if analysis['requires_filtering']: complexity_score += 1
-        if len(analysis['grouping_requirements']) > 1: complexity_score += 1
+        if analysis.requires_joins: complexity_score += 2
+        if analysis.requires_aggregation: complexity_score += 1
+        if analysis.requires_time_analysis: complexity_score += 1
+        if analysis.requires_filtering: complexity_score += 1
+        if len(analysis.grouping_requirements) > 1: complexity_score += 1
         
         if complexity_score >= 4:
-            analysis['complexity'] = 'complex'
+            analysis.complexity = 'complex'
         elif complexity_score >= 2:
-            analysis['complexity'] = 'moderate'
+            analysis.complexity = 'moderate'
         else:
-            analysis['complexity'] = 'simple'
+            analysis.complexity = 'simple'
         
         return analysis
 
     def _classify_detailed_intent(self, question: str) -> str:
         """Classify detailed intent beyond basic categories"""
         
-        intent_patterns = {
-            'TREND_ANALYSIS': ['trend', 'over time', 'progression', 'growth', 'decline'],
-            'COMPARISON': ['compare', 'versus', 'vs', 'difference', 'better', 'worse'],
-            'RANKING': ['top', 'bottom', 'best', 'worst', 'highest', 'lowest', 'rank'],
-            'DISTRIBUTION': ['breakdown', 'distribution', 'split', 'allocation'],
-            'PERFORMANCE': ['performance', 'kpi', 'metric', 'achievement', 'target'],
-            'RELATIONSHIP': ['relationship', 'correlation', 'related', 'connected'],
-            'ANOMALY': ['unusual', 'strange', 'outlier', 'anomaly', 'exception'],
-            'FORECAST': ['predict', 'forecast', 'future', 'projection', 'estimate']
-        }
-        
-        for intent, patterns in intent_patterns.items():
-            if any(pattern in question for pattern in patterns):
-                return intent
-        
-        return 'GENERAL_INQUIRY'
+        return _question_tags(question).get('intent', 'GENERAL_INQUIRY')
 
-    def _select_prompt_template(self, question_analysis: Dict, query_language: str) -> str:
+    def _select_prompt_template(self, question_analysis: _QuestionAnalysis, query_language: str) -> str:
         """Select the most appropriate prompt template"""
         
         language_key = "dax" if query_language == "DAX" else "sql"
         
         # For DAX, check for measure-focused queries
         if language_key == "dax":
-            if question_analysis['requires_aggregation'] and question_analysis['aggregation_type']:
+            if question_analysis.requires_aggregation and question_analysis.aggregation_type:
                 return "measure_focused"
-            elif question_analysis['requires_joins'] or question_analysis['complexity'] == 'complex':
+            elif question_analysis.requires_joins or question_analysis.complexity == 'complex':
                 return "relationship_aware"
             else:
                 return "base"
         
         # For SQL, check for relationship requirements
         else:
-            if question_analysis['requires_joins'] or len(question_analysis['grouping_requirements']) > 1:
+            if question_analysis.requires_joins or len(question_analysis.grouping_requirements) > 1:
                 return "with_relationships"
-            elif question_analysis['requires_aggregation']:
+            elif question_analysis.requires_aggregation:
                 return "aggregation_focused"
             else:
                 return "base"
 
     def _build_comprehensive_context(self, question: str, context_history: List[str], 
-                                     similar_queries: List[Dict], question_analysis: Dict) -> Dict:
+                                     similar_queries: List[Dict], question_analysis: _QuestionAnalysis) -> Dict:
         """Build comprehensive context for prompt generation"""
         
         context = {}
@@ -1383,38 +2137,27 @@ This appears to be a follow-up question. Consider the previous context when gene
         if similar_queries:
             context['similar_queries_context'] = """
 SIMILAR SUCCESSFUL QUERIES FOR REFERENCE:
-"""
-            for sq in similar_queries[:2]:
-                context['similar_queries_context'] += f"""
+""" + _join_within_budget((f"""
 Previous Q: {sq['question']}
 Query: {sq.get('sql_query') or sq.get('dax_query', 'N/A')}
 Success Rate: {sq.get('success_count', 1)} times
-"""
+""" for sq in similar_queries), self.kb_context_budget)
         else:
             context['similar_queries_context'] = ""
         
         # Business context based on question analysis
-        business_context_parts = []
-        
-        if question_analysis['question_intent'] == 'TREND_ANALYSIS':
-            business_context_parts.append("This is a trend analysis query. Focus on time-based patterns and changes.")
-        elif question_analysis['question_intent'] == 'COMPARISON':
-            business_context_parts.append("This is a comparison query. Ensure results can be easily compared.")
-        elif question_analysis['question_intent'] == 'RANKING':
-            business_context_parts.append("This is a ranking query. Use ORDER BY and TOP/TOPN appropriately.")
-        
-        if question_analysis['requires_aggregation']:
-            business_context_parts.append(f"Aggregation required: {question_analysis['aggregation_type'] or 'Multiple types'}")
-        
-        if question_analysis['time_dimension']:
-            business_context_parts.append(f"Time dimension: {question_analysis['time_dimension']}")
-        
-        context['business_context'] = "\n".join(business_context_parts) if business_context_parts else "General data retrieval query."
+        business_context = "\n".join(filter(None, (
+            _INTENT_BUSINESS_CONTEXT.get(question_analysis.question_intent),
+            f"Aggregation required: {question_analysis.aggregation_type or 'Multiple types'}"
+            if question_analysis.requires_aggregation else None,
+            f"Time dimension: {question_analysis.time_dimension}" if question_analysis.time_dimension else None
+        )))
+        context['business_context'] = business_context or "General data retrieval query."
         
         return context
 
     def _build_contextual_prompt(self, template: str, question: str, schema_context: str, 
-                                 context_sections: Dict, question_analysis: Dict, query_language: str) -> str:
+                                 context_sections: Dict, question_analysis: _QuestionAnalysis, query_language: str) -> str:
         """Build the complete contextual prompt"""
         
         # Prepare template variables
@@ -1430,55 +2173,94 @@ Success Rate: {sq.get('success_count', 1)} times
         
         # Add analysis-specific variables
         template_vars.update({
-            'aggregation_type': question_analysis.get('aggregation_type', 'None'),
-            'time_dimension': question_analysis.get('time_dimension', 'None'),
-            'grouping_requirements': ', '.join(question_analysis.get('grouping_requirements', [])) or 'None'
+            'aggregation_type': question_analysis.aggregation_type,
+            'time_dimension': question_analysis.time_dimension,
+            'grouping_requirements': ', '.join(question_analysis.grouping_requirements) or 'None'
         })
         
         # Add relationship hints for SQL
-        if query_language == "T-SQL" and question_analysis['requires_joins']:
+        if query_language == "T-SQL" and question_analysis.requires_joins:
             template_vars['relationship_hints'] = self._generate_relationship_hints(schema_context, question_analysis)
         
-        # Add measures context for DAX
-        if query_language == "DAX":
-            template_vars['measures_context'] = self._extract_measures_context(schema_context)
-            template_vars['relationship_context'] = "Leverage model relationships for cross-table analysis"
-        
+        # Schema-dependent fields (including the DAX measures context) are
+        # pre-bound once per schema; only per-question fields are filled here
         try:
-            return template.format(**template_vars)
+            return _render_segments(self._partial_template(template, schema_context, query_language), template_vars)
         except KeyError as e:
             logger.warning(f"Template variable missing: {e}. Using base template.")
-            # Fallback to base template with available variables
+            # Fallback to base template with available variables: rendering
+            # only looks up the base template's own fields, so extra
+            # variables need no filtering
             base_template_key = "dax_generation" if query_language == "DAX" else "sql_generation"
-            base_template = self.advanced_prompt_templates[base_template_key]["base"]
-            
-            # Filter only keys that exist in the base template to avoid another KeyError
-            valid_vars = {k: v for k, v in template_vars.items() if f"{{{k}}}" in base_template}
-            return base_template.format(**valid_vars)
+            base_segments = self._partial_template(
+                _ADVANCED_PROMPT_TEMPLATES[base_template_key]["base"], schema_context, query_language
+            )
+            return _render_segments(base_segments, template_vars)
 
-    def _generate_relationship_hints(self, schema_context: str, question_analysis: Dict) -> str:
+    def _partial_template(self, template: str, schema_context: str,
+                          query_language: str) -> Tuple[Tuple[str, Optional[str]], ...]:
+        """Template with its schema-dependent placeholders filled in, split
+        into (text, field) segments for _render_segments.
+        
+        The embedded schema makes the text long, so it is parsed once here
+        rather than rescanned by str.format for every question.
+        """
+        key = (template, schema_context, query_language)
+        partial = self._partial_templates.get(key)
+        if partial is None:
+            fixed = {'schema_context': schema_context, 'query_language': query_language}
+            if query_language == "DAX":
+                fixed['measures_context'] = self._extract_measures_context(schema_context)
+                fixed['relationship_context'] = "Leverage model relationships for cross-table analysis"
+            
+            text = template
+            for name, value in fixed.items():
+                text = text.replace(f"{{{name}}}", value.replace("{", "{{").replace("}", "}}"))
+            partial = tuple((literal, field_name) for literal, field_name, _, _ in string.Formatter().parse(text))
+            
+            # Schemas change rarely; a full reset keeps this bounded
+            if len(self._partial_templates) >= 64:
+                self._partial_templates.clear()
+            self._partial_templates[key] = partial
+        return partial
+    
+    def _generate_relationship_hints(self, schema_context: str, question_analysis: _QuestionAnalysis) -> str:
         """Generate hints about potential table relationships"""
         
+        hints = list(self._schema_relationship_hints(schema_context))
+        
+        # Add grouping-based hints
+        for group_req in question_analysis.grouping_requirements:
+            hints.append(f"• Consider grouping by {group_req} - look for related dimension table")
+        
+        return "\n".join(hints) if hints else "• Analyze schema for ID/Key columns to determine relationships"
+
+    @staticmethod
+    @lru_cache(maxsize=128)
+    def _schema_relationship_hints(schema_context: str) -> Tuple[str, ...]:
+        """Relationship hints implied by the schema's table names.
+        
+        Only the schema matters here, and it's the same across a session, so
+        the scan of the schema text is memoized.
+        """
         # Extract table names from schema
-        table_names = re.findall(r'📊 (\w+):', schema_context)
+        table_names = _SCHEMA_TABLE_RE.findall(schema_context)
         
         hints = []
         
         # Common relationship patterns
-        if any('customer' in table.lower() for table in table_names) and any('order' in table.lower() for table in table_names):
+        tables_lower = [table.lower() for table in table_names]
+        has_orders = any('order' in table for table in tables_lower)
+        if has_orders and any('customer' in table for table in tables_lower):
             hints.append("• Customer-Order relationship likely via CustomerID")
         
-        if any('product' in table.lower() for table in table_names) and any('order' in table.lower() for table in table_names):
+        if has_orders and any('product' in table for table in tables_lower):
             hints.append("• Product-Order relationship likely via ProductID")
         
-        if any('sales' in table.lower() for table in table_names):
+        if any('sales' in table for table in tables_lower):
             hints.append("• Sales table likely central fact table with foreign keys")
         
-        # Add grouping-based hints
-        for group_req in question_analysis.get('grouping_requirements', []):
-            hints.append(f"• Consider grouping by {group_req} - look for related dimension table")
-        
-        return "\n".join(hints) if hints else "• Analyze schema for ID/Key columns to determine relationships"
+        return tuple(hints)
 
     def _extract_measures_context(self, schema_context: str) -> str:
         """Extract measures context for DAX queries"""
@@ -1489,51 +2271,54 @@ Success Rate: {sq.get('success_count', 1)} times
         else:
             return "No pre-calculated measures found. Create aggregations using DAX functions."
 
-    def _apply_advanced_optimization(self, query: str, query_language: str, question_analysis: Dict) -> str:
+    def _apply_advanced_optimization(self, query: str, query_language: str, question_analysis: _QuestionAnalysis) -> str:
         """Apply advanced optimizations based on question analysis"""
         
-        if query_language == "T-SQL":
-            return self._optimize_sql_advanced(query, question_analysis)
-        else:
-            return self._optimize_dax_advanced(query, question_analysis)
+        optimize = self._optimizers.get(query_language, self._optimize_dax_advanced)
+        return optimize(query, question_analysis)
 
-    def _optimize_sql_advanced(self, query: str, question_analysis: Dict) -> str:
+    def _optimize_sql_advanced(self, query: str, question_analysis: _QuestionAnalysis) -> str:
         """Advanced SQL optimization"""
         
         optimized = query
+        has_top = _TOP_RE.search(query) is not None
         
         # Ensure appropriate TOP limit based on complexity
-        if 'TOP ' not in optimized.upper():
-             optimized = re.sub(r'SELECT\s', 'SELECT TOP 100 ', optimized, flags=re.IGNORECASE, count=1)
+        if not _TOP_CLAUSE_RE.search(query):
+            optimized, added = _FIRST_SELECT_RE.subn('SELECT TOP 100 ', optimized, count=1)
+            has_top = has_top or added > 0
 
-        if question_analysis['complexity'] == 'complex':
-            optimized = re.sub(r'TOP\s+\d+', 'TOP 50', optimized, flags=re.IGNORECASE)
-        elif question_analysis['complexity'] == 'moderate':
-            optimized = re.sub(r'TOP\s+\d+', 'TOP 100', optimized, flags=re.IGNORECASE)
+        # Nothing to resize without a TOP
+        if has_top:
+            if question_analysis.complexity == 'complex':
+                optimized = _TOP_N_RE.sub('TOP 50', optimized)
+            elif question_analysis.complexity == 'moderate':
+                optimized = _TOP_N_RE.sub('TOP 100', optimized)
         
         # Add ORDER BY if ranking is required
-        if question_analysis['question_intent'] == 'RANKING' and 'ORDER BY' not in optimized.upper():
-            if question_analysis['aggregation_type'] in ['SUM', 'COUNT', 'MAX']:
+        if question_analysis.question_intent == 'RANKING' and not _ORDER_BY_RE.search(optimized):
+            if question_analysis.aggregation_type in ['SUM', 'COUNT', 'MAX']:
                 # Add a generic ORDER BY for aggregated results
                 optimized += "\nORDER BY 2 DESC"  # Order by second column (usually the aggregated value)
         
         return optimized
 
-    def _optimize_dax_advanced(self, query: str, question_analysis: Dict) -> str:
+    def _optimize_dax_advanced(self, query: str, question_analysis: _QuestionAnalysis) -> str:
         """Advanced DAX optimization"""
         
         optimized = query
         
         # Add TOPN for complex queries to prevent large result sets
-        if question_analysis['complexity'] == 'complex' and 'TOPN(' not in optimized.upper():
+        if question_analysis.complexity == 'complex' and not _TOPN_CALL_RE.search(optimized):
             # Wrap simple table evaluations with TOPN
-            if optimized.strip().startswith('EVALUATE') and '\n' not in optimized.strip()[8:].strip():
-                table_ref = optimized.strip()[8:].strip()
+            stripped = optimized.strip()
+            table_ref = stripped[8:].strip()
+            if stripped.startswith('EVALUATE') and '\n' not in table_ref:
                 optimized = f"EVALUATE\nTOPN(50, {table_ref})"
         
         # Optimize for ranking queries
-        if question_analysis['question_intent'] == 'RANKING':
-            if 'TOPN(' not in optimized.upper() and 'SUMMARIZE' in optimized.upper():
+        if question_analysis.question_intent == 'RANKING':
+            if not _TOPN_CALL_RE.search(optimized) and _SUMMARIZE_RE.search(optimized):
                 # Wrap with TOPN if it's a summarization for ranking
                 lines = optimized.split('\n')
                 evaluate_content = '\n'.join(lines[1:]) if lines[0].strip().upper() == 'EVALUATE' else optimized
@@ -1549,8 +2334,8 @@ Success Rate: {sq.get('success_count', 1)} times
         
         if error_type == "SCHEMA_ERROR":
             # Extract specific column/table names mentioned in error
-            column_matches = re.findall(r"column name '([^']+)'", error, re.IGNORECASE)
-            table_matches = re.findall(r"object name '([^']+)'", error, re.IGNORECASE)
+            column_matches = _ERROR_COLUMN_RE.findall(error)
+            table_matches = _ERROR_OBJECT_RE.findall(error)
             
             if column_matches:
                 analysis.append(f"Problematic columns: {', '.join(column_matches)}")
@@ -1558,22 +2343,30 @@ Success Rate: {sq.get('success_count', 1)} times
                 analysis.append(f"Problematic tables: {', '.join(table_matches)}")
             
             # Check for common typos
-            query_words = re.findall(r'\b\w+\b', failed_query.lower())
-            common_business_terms = ['sales', 'customer', 'product', 'order', 'revenue', 'date', 'amount']
+            query_words = set(_QUERY_WORD_RE.findall(failed_query.lower()))
+            words_by_length = defaultdict(list)
+            for word in query_words:
+                words_by_length[len(word)].append(word)
             
-            for term in common_business_terms:
-                similar_words = [word for word in query_words if self._is_similar_word(word, term)]
-                if similar_words:
-                    analysis.append(f"Possible typo: '{similar_words[0]}' might be '{term}'")
+            for term in _COMMON_BUSINESS_TERMS:
+                if term in query_words:
+                    continue  # Spelled correctly
+                # A 0.8 similarity ratio is out of reach outside 2/3..3/2 of the term's length
+                candidates = [word
+                              for length in range(-(-2 * len(term) // 3), 3 * len(term) // 2 + 1)
+                              for word in words_by_length.get(length, ())]
+                similar_word = _closest_word(term, candidates)
+                if similar_word:
+                    analysis.append(f"Possible typo: '{similar_word}' might be '{term}'")
         
         elif error_type == "SYNTAX_ERROR":
             if "expected" in error_lower:
-                expected_matches = re.findall(r"expected '([^']+)'", error, re.IGNORECASE)
+                expected_matches = _ERROR_EXPECTED_RE.findall(error)
                 if expected_matches:
                     analysis.append(f"Missing or incorrect: {', '.join(expected_matches)}")
             
             if "unexpected" in error_lower:
-                unexpected_matches = re.findall(r"unexpected '([^']+)'", error, re.IGNORECASE)
+                unexpected_matches = _ERROR_UNEXPECTED_RE.findall(error)
                 if unexpected_matches:
                     analysis.append(f"Unexpected tokens: {', '.join(unexpected_matches)}")
         
@@ -1588,51 +2381,22 @@ Success Rate: {sq.get('success_count', 1)} times
     def _build_error_fixing_context(self, error_type: str, query_language: str, error_analysis: str) -> Dict:
         """Build context for error fixing"""
         
-        context = {}
+        # Anything that isn't T-SQL is DAX
+        language = query_language if query_language in _SYNTAX_RULES else "DAX"
+        context = {"syntax_rules": _SYNTAX_RULES[language]}
         
-        if query_language == "T-SQL":
-            context["syntax_rules"] = """
-- Use TOP instead of LIMIT for row limiting
-- Use [square brackets] for names with spaces/special characters
-- Proper JOIN syntax: INNER/LEFT/RIGHT JOIN table ON condition
-- Use ISNULL() or COALESCE() for NULL handling
-- CAST() or CONVERT() for data type conversions
-- Proper quote usage: single quotes for strings, brackets for identifiers
-"""
-            
-            if error_type == "PERFORMANCE_ERROR":
-                context["optimization_hints"] = """
-- Add WHERE clauses to filter data early
-- Use TOP to limit result sets
-- Avoid SELECT * in favor of specific columns
-- Use appropriate indexes (consider column usage)
-- Simplify complex subqueries
-"""
-        
-        else:  # DAX
-            context["syntax_rules"] = """
-- Must start with EVALUATE
-- Table references: 'Table Name' or TableName
-- Column references: 'Table Name'[Column Name]
-- Use DAX functions: FILTER, SUMMARIZE, CALCULATE, TOPN
-- NO SQL syntax: no SELECT, FROM, WHERE, JOIN
-- Use RELATED() for cross-table column access
-"""
-            
-            if error_type == "PERFORMANCE_ERROR":
-                context["optimization_hints"] = """
-- Use TOPN() to limit results
-- Apply FILTER() early to reduce data volume
-- Use SUMMARIZECOLUMNS instead of SUMMARIZE when possible
-- Avoid complex calculated columns in large tables
-- Use measures instead of calculated columns where appropriate
-"""
+        if error_type == "PERFORMANCE_ERROR":
+            context["optimization_hints"] = _PERFORMANCE_HINTS[language]
         
         return context
 
     def _apply_post_fix_optimizations(self, fixed_query: str, error_type: str, query_language: str) -> str:
         """Apply optimizations after fixing errors"""
         
+        # Only these error types have follow-up optimizations
+        if error_type not in ("TIMEOUT_ERROR", "SCHEMA_ERROR"):
+            return fixed_query
+        
         optimized = fixed_query
         
         # Apply error-type specific optimizations
@@ -1640,49 +2404,27 @@ Success Rate: {sq.get('success_count', 1)} times
             # More aggressive optimization for timeout issues
             if query_language == "T-SQL":
                 # Reduce TOP limit more aggressively
-                optimized = re.sub(r'TOP\s+(\d+)', lambda m: f'TOP {min(int(m.group(1)), 25)}', optimized, flags=re.IGNORECASE)
+                optimized = _TOP_N_RE.sub(lambda m: f'TOP {min(int(m.group(1)), 25)}', optimized)
             else:  # DAX
                 # Wrap with smaller TOPN
-                if 'TOPN(' not in optimized.upper():
-                    if optimized.strip().startswith('EVALUATE'):
-                        content = optimized[8:].strip()
-                        optimized = f'EVALUATE\nTOPN(25, {content})'
+                if optimized.strip().startswith('EVALUATE') and not _TOPN_CALL_RE.search(optimized):
+                    content = optimized[8:].strip()
+                    optimized = f'EVALUATE\nTOPN(25, {content})'
         
         elif error_type == "SCHEMA_ERROR":
             # Add defensive programming
             if query_language == "T-SQL":
                 # Ensure all potential NULL columns are handled
-                optimized = re.sub(r'(\w+\.\w+|\[\w+\]\.\[\w+\])', r'ISNULL(\1, \'\')', optimized, count=3)
+                optimized = _QUALIFIED_COLUMN_RE.sub(r'ISNULL(\1, \'\')', optimized, count=3)
         
         return optimized
 
-    def _is_similar_word(self, word1: str, word2: str, threshold: float = 0.8) -> bool:
-        """Check if two words are similar (for typo detection)"""
-        if len(word1) < 3 or len(word2) < 3:
-            return False
-        
-        similarity = SequenceMatcher(None, word1, word2).ratio()
-        return similarity >= threshold
-
     async def _apply_simple_fix(self, failed_query: str, error: str, query_language: str) -> str:
         """Fallback simple fix when advanced fixing fails"""
         
-        simple_fixes = {
-            "T-SQL": [
-                (r'\bLIMIT\s+(\d+)', r'TOP \1'),  # Replace LIMIT with TOP
-                (r'SELECT\s+(\*|\w+)', r'SELECT TOP 50 \1'),  # Add TOP if missing
-                (r'\bILIKE\b', 'LIKE'),  # Replace ILIKE with LIKE
-            ],
-            "DAX": [
-                (r'^(?!EVALUATE)', r'EVALUATE '),  # Add EVALUATE if missing
-                (r'\bSELECT\b.*?\bFROM\b', ''),  # Remove SQL syntax
-                (r'\bWHERE\b', 'FILTER('),  # Replace WHERE with FILTER
-            ]
-        }
-        
         fixed = failed_query
-        for pattern, replacement in simple_fixes.get(query_language, []):
-            fixed = re.sub(pattern, replacement, fixed, flags=re.IGNORECASE)
+        for pattern, replacement in _SIMPLE_FIXES.get(query_language, ()):
+            fixed = pattern.sub(replacement, fixed)
         
         return fixed
 
@@ -1691,7 +2433,7 @@ Success Rate: {sq.get('success_count', 1)} times
         
         if query_language == "T-SQL":
             # Extract first table name from schema
-            table_match = re.search(r'📊 (\w+):', schema_context)
+            table_match = _SCHEMA_TABLE_RE.search(schema_context)
             if table_match:
                 table_name = table_match.group(1)
                 return f"SELECT TOP 10 * FROM [{table_name}]"
@@ -1700,7 +2442,7 @@ Success Rate: {sq.get('success_count', 1)} times
         
         else:  # DAX
             # Extract first table name from schema
-            table_match = re.search(r"'([^']+)':", schema_context)
+            table_match = _QUOTED_TABLE_RE.search(schema_context)
             if table_match:
                 table_name = table_match.group(1)
                 return f"EVALUATE\nTOPN(10, '{table_name}')"
@@ -1729,7 +2471,7 @@ RESULTS SUMMARY:
 - Columns: {', '.join(data_summary['columns'])}
 
 SAMPLE DATA:
-{json.dumps(data_summary['sample_data'], indent=2, default=str)}
+{prompt_json(data_summary['sample_data'])}
 
 Please provide a clear, concise answer that:
 1. Directly addresses the user's question
@@ -1741,7 +2483,11 @@ Please provide a clear, concise answer that:
 Keep the answer conversational and informative."""
 
         try:
-            response = await claude_service.get_response(prompt)
+            # Same question over the same rows gives the same prompt, so it can be served from cache
+            if self.cache_config["cache_answers"]:
+                response = await self._cached_llm(prompt)
+            else:
+                response = await claude_service.get_response(prompt)
             return response.strip()
         except Exception as e:
             logger.error(f"Failed to generate contextual answer: {e}")
@@ -1749,9 +2495,9 @@ Keep the answer conversational and informative."""
             if data_summary['row_count'] == 0:
                 return f"I couldn't find any data matching your question '{question}'. This might mean the data doesn't exist in the current dataset or the criteria were too specific."
             elif data_summary['row_count'] == 1:
-                return f"I found one result for your question. Here's what the data shows: {json.dumps(data_summary['sample_data'][0], default=str)}"
+                return f"I found one result for your question. Here's what the data shows: {prompt_json(data_summary['sample_data'][0])}"
             else:
-                return f"I found {data_summary['row_count']} results for your question. The data includes columns: {', '.join(data_summary['columns'])}. Here are the first few results: {json.dumps(data_summary['sample_data'], default=str)}"
+                return f"I found {data_summary['row_count']} results for your question. The data includes columns: {', '.join(data_summary['columns'])}. Here are the first few results: {prompt_json(data_summary['sample_data'])}"
 
 # Singleton
 enhanced_multi_agent_service = EnhancedMultiAgentService()
\ No newline at end of file
@@ -1,25 +1,125 @@
 import os
+import re
+import json
+import queue
+import itertools
 import pyodbc
-import pandas as pd
-from typing import Dict, List, Optional
+from contextlib import contextmanager
+from decimal import Decimal
+from functools import lru_cache
+from typing import Dict, Iterator, List, Optional, Tuple
 import logging
 import struct
+import time
 from dotenv import load_dotenv
 from app.auth_service import auth_service
 
 load_dotenv()
 logger = logging.getLogger(__name__)
 
+_ROW_LIMIT_RE = re.compile(r'\b(?:TOP|LIMIT)\b', re.IGNORECASE)
+_SELECT_RE = re.compile(r'\bSELECT\b', re.IGNORECASE)
+
+def _json_default(value):
+    """Dates and times as ISO 8601, anything else unknown as its str()"""
+    isoformat = getattr(value, "isoformat", None)
+    return isoformat() if isoformat else str(value)
+
+try:
+    import orjson
+
+    def _json_bytes(value) -> bytes:
+        return orjson.dumps(value, default=_json_default)
+except ImportError:
+    def _json_bytes(value) -> bytes:
+        return json.dumps(value, default=_json_default, separators=(",", ":")).encode()
+
+# ODBC pre-connect attribute carrying an Azure AD access token
+SQL_COPT_SS_ACCESS_TOKEN = 1256
+
+@lru_cache(maxsize=4)
+def _token_struct(token: str) -> bytes:
+    """Access token packed the way the ODBC driver expects it; tokens live for an hour"""
+    token_bytes = token.encode('utf-16-le')
+    return struct.pack(f'<I{len(token_bytes)}s', len(token_bytes), token_bytes)
+
 class FabricService:
     def __init__(self):
         self.server = None
         self.database = None
-        self.connection = None
+        # Idle ((server, database), connection) pairs, so only the first call
+        # pays for the ODBC/TLS handshake and login
+        self._pool: queue.Queue = queue.Queue(maxsize=8)
+        # ((server, database), discovered at on the monotonic clock, result)
+        # of the last successful discover_schema
+        self._schema_cache: Optional[Tuple[Tuple[str, str], float, Dict]] = None
+        self.schema_ttl = 300  # 5 minutes
         
     def configure(self, server: str, database: str):
         """Configure Fabric connection parameters"""
         self.server = server
         self.database = database
+        self._close_pooled()
+    
+    @contextmanager
+    def _connection(self):
+        """Pooled connection for a with block, or None if one can't be made.
+        
+        The connection goes back to the pool when the block finishes; if the
+        block raises it may be broken, so it is closed instead.
+        """
+        target = (self.server, self.database)
+        conn = self._acquire(target)
+        if conn is None:
+            yield None
+            return
+        try:
+            yield conn
+        except BaseException:
+            self._close_quietly(conn)
+            raise
+        self._release(target, conn)
+    
+    def _acquire(self, target) -> Optional[pyodbc.Connection]:
+        """An idle connection to target that still answers, else a new one"""
+        while True:
+            try:
+                pooled_target, conn = self._pool.get_nowait()
+            except queue.Empty:
+                return self._connect_with_token()
+            if pooled_target != target:
+                self._close_quietly(conn)
+                continue
+            try:
+                conn.cursor().execute("SELECT 1").fetchone()
+                return conn
+            except pyodbc.Error:
+                self._close_quietly(conn)
+    
+    def _release(self, target, conn: pyodbc.Connection):
+        """Return a connection to the pool, closing it if the pool is full"""
+        try:
+            # End the implicit transaction so the next user doesn't inherit its snapshot
+            conn.rollback()
+            self._pool.put_nowait((target, conn))
+        except (pyodbc.Error, queue.Full):
+            self._close_quietly(conn)
+    
+    def _close_pooled(self):
+        """Close every idle connection"""
+        while True:
+            try:
+                _, conn = self._pool.get_nowait()
+            except queue.Empty:
+                return
+            self._close_quietly(conn)
+    
+    @staticmethod
+    def _close_quietly(conn: pyodbc.Connection):
+        try:
+            conn.close()
+        except pyodbc.Error:
+            pass
     
     def _connect_with_token(self) -> Optional[pyodbc.Connection]:
         """Create connection using OAuth2 token with attrs_before"""
@@ -47,17 +147,10 @@ class FabricService:
                 f"Connection Timeout=30;"
             )
             
-            # SQL_COPT_SS_ACCESS_TOKEN constant
-            SQL_COPT_SS_ACCESS_TOKEN = 1256
-            
-            # Convert token to bytes
-            token_bytes = token.encode('utf-16-le')
-            token_struct = struct.pack(f'<I{len(token_bytes)}s', len(token_bytes), token_bytes)
-            
             # Connect with token
             conn = pyodbc.connect(
                 connection_string,
-                attrs_before={SQL_COPT_SS_ACCESS_TOKEN: token_struct}
+                attrs_before={SQL_COPT_SS_ACCESS_TOKEN: _token_struct(token)}
             )
             
             logger.info("Successfully connected to Fabric database")
@@ -72,100 +165,95 @@ class FabricService:
         try:
             logger.info(f"Testing connection to {self.server}/{self.database}")
             
-            conn = self._connect_with_token()
-            if not conn:
-                logger.error("_connect_with_token returned None")
-                return {"success": False, "error": "Failed to establish connection - check logs for details"}
-            
-            logger.info("Connection established, running test query")
-            cursor = conn.cursor()
-            
-            # Test query
-            cursor.execute("SELECT DB_NAME() as db_name, @@VERSION as version")
-            result = cursor.fetchone()
-            
-            logger.info(f"Test query successful - Database: {result[0]}")
-            
-            conn.close()
-            
-            return {
-                "success": True,
-                "message": "Connection successful",
-                "server": self.server,
-                "database": result[0],
-                "version": result[1][:100] + "..." if len(result[1]) > 100 else result[1]
-            }
+            with self._connection() as conn:
+                if not conn:
+                    logger.error("No connection available")
+                    return {"success": False, "error": "Failed to establish connection - check logs for details"}
+                
+                logger.info("Connection established, running test query")
+                cursor = conn.cursor()
+                
+                # Test query
+                cursor.execute("SELECT DB_NAME() as db_name, @@VERSION as version")
+                result = cursor.fetchone()
+                
+                logger.info(f"Test query successful - Database: {result[0]}")
+                
+                return {
+                    "success": True,
+                    "message": "Connection successful",
+                    "server": self.server,
+                    "database": result[0],
+                    "version": result[1][:100] + "..." if len(result[1]) > 100 else result[1]
+                }
         except Exception as e:
             logger.error(f"Connection test failed with error: {type(e).__name__}: {e}")
             return {"success": False, "error": f"{type(e).__name__}: {str(e)}"}
     
-    def discover_schema(self) -> Dict:
-        """Discover tables and columns in the database"""
+    def discover_schema(self, refresh: bool = False) -> Dict:
+        """Discover tables and columns in the database.
+        
+        Results are reused for schema_ttl seconds; refresh=True always rescans.
+        """
+        target = (self.server, self.database)
+        cached = self._schema_cache
+        if not refresh and cached and cached[0] == target and time.monotonic() - cached[1] < self.schema_ttl:
+            return cached[2]
+        
         try:
-            conn = self._connect_with_token()
-            if not conn:
-                return {"success": False, "error": "Failed to establish connection"}
-            
-            cursor = conn.cursor()
-            
-            # Get all tables
-            tables_query = """
-            SELECT 
-                TABLE_SCHEMA,
-                TABLE_NAME,
-                TABLE_TYPE
-            FROM INFORMATION_SCHEMA.TABLES
-            WHERE TABLE_TYPE IN ('BASE TABLE', 'VIEW')
-            ORDER BY TABLE_SCHEMA, TABLE_NAME
-            """
-            
-            cursor.execute(tables_query)
-            tables = cursor.fetchall()
-            
-            schema_info = {}
-            
-            for table in tables:
-                schema_name = table[0]
-                table_name = table[1]
-                full_table_name = f"{schema_name}.{table_name}"
+            with self._connection() as conn:
+                if not conn:
+                    return {"success": False, "error": "Failed to establish connection"}
                 
-                # Get columns for this table
+                cursor = conn.cursor()
+                
+                # Columns of every table and view in one round trip, grouped per table below
                 columns_query = """
                 SELECT 
-                    COLUMN_NAME,
-                    DATA_TYPE,
-                    IS_NULLABLE,
-                    CHARACTER_MAXIMUM_LENGTH
-                FROM INFORMATION_SCHEMA.COLUMNS
-                WHERE TABLE_SCHEMA = ? AND TABLE_NAME = ?
-                ORDER BY ORDINAL_POSITION
+                    c.TABLE_SCHEMA,
+                    c.TABLE_NAME,
+                    c.COLUMN_NAME,
+                    c.DATA_TYPE,
+                    c.IS_NULLABLE,
+                    c.CHARACTER_MAXIMUM_LENGTH
+                FROM INFORMATION_SCHEMA.COLUMNS c
+                JOIN INFORMATION_SCHEMA.TABLES t
+                    ON t.TABLE_SCHEMA = c.TABLE_SCHEMA AND t.TABLE_NAME = c.TABLE_NAME
+                WHERE t.TABLE_TYPE IN ('BASE TABLE', 'VIEW')
+                ORDER BY c.TABLE_SCHEMA, c.TABLE_NAME, c.ORDINAL_POSITION
                 """
                 
-                cursor.execute(columns_query, (schema_name, table_name))
-                columns = cursor.fetchall()
+                cursor.execute(columns_query)
+                rows = cursor.fetchall()
+                
+                schema_info = {}
                 
-                schema_info[full_table_name] = {
-                    "schema": schema_name,
-                    "table": table_name,
-                    "columns": [
-                        {
-                            "name": col[0],
-                            "type": col[1],
-                            "nullable": col[2] == "YES",
-                            "max_length": col[3]
-                        }
-                        for col in columns
-                    ]
+                for (schema_name, table_name), table_rows in itertools.groupby(rows, key=lambda row: (row[0], row[1])):
+                    full_table_name = f"{schema_name}.{table_name}"
+                    columns = [row[2:] for row in table_rows]
+                    
+                    schema_info[full_table_name] = {
+                        "schema": schema_name,
+                        "table": table_name,
+                        "columns": [
+                            {
+                                "name": col[0],
+                                "type": col[1],
+                                "nullable": col[2] == "YES",
+                                "max_length": col[3]
+                            }
+                            for col in columns
+                        ]
+                    }
+                
+                result = {
+                    "success": True,
+                    "tables": schema_info,
+                    "table_count": len(schema_info)
                 }
-            
-            conn.close()
-            
-            return {
-                "success": True,
-                "tables": schema_info,
-                "table_count": len(schema_info)
-            }
-            
+                self._schema_cache = (target, time.monotonic(), result)
+                return result
+                
         except Exception as e:
             logger.error(f"Schema discovery failed: {e}")
             return {"success": False, "error": str(e)}
@@ -173,36 +261,92 @@ class FabricService:
     def execute_query(self, query: str, limit: int = 100) -> Dict:
         """Execute a SQL query and return results"""
         try:
-            conn = self._connect_with_token()
-            if not conn:
-                return {"success": False, "error": "Failed to establish connection"}
-            
-            # Add limit if not present
-            query_lower = query.lower()
-            if "select" in query_lower and "limit" not in query_lower and "top" not in query_lower:
-                # For SQL Server/Fabric, use TOP
-                query = query.replace("SELECT", f"SELECT TOP {limit}", 1)
-                query = query.replace("select", f"SELECT TOP {limit}", 1)
-            
-            # Execute query
-            df = pd.read_sql(query, conn)
-            conn.close()
-            
-            # Convert to JSON-serializable format
-            result = {
-                "success": True,
-                "columns": list(df.columns),
-                "data": df.to_dict('records'),
-                "row_count": len(df),
-                "preview": df.head(10).to_dict('records')
-            }
-            
-            return result
-            
+            with self._connection() as conn:
+                if not conn:
+                    return {"success": False, "error": "Failed to establish connection"}
+                
+                # Execute query; rows go straight into records, no DataFrame in between
+                cursor = conn.cursor()
+                cursor.execute(self._with_row_limit(query, limit))
+                columns, decimal_columns = self._result_columns(cursor)
+                data = self._records(columns, decimal_columns, cursor.fetchall())
+                
+                # Convert to JSON-serializable format
+                result = {
+                    "success": True,
+                    "columns": columns,
+                    "data": data,
+                    "row_count": len(data),
+                    "preview": data[:10]
+                }
+                
+                return result
+                
         except Exception as e:
             logger.error(f"Query execution failed: {e}")
             return {"success": False, "error": str(e)}
     
+    def stream_query(self, query: str, limit: int = 100, batch_size: int = 1000) -> Tuple[Optional[str], Iterator[bytes]]:
+        """Execute a SQL query and return (error, chunks).
+        
+        On success error is None and chunks yields, batch by batch, the JSON
+        document of execute_query's result, so large results are never held
+        in memory at once. The query runs before this returns, so connection
+        and SQL errors come back as error rather than mid-stream.
+        """
+        chunks = self._query_json_chunks(query, limit, batch_size)
+        try:
+            first = next(chunks)
+        except Exception as e:
+            logger.error(f"Query execution failed: {e}")
+            return str(e), iter(())
+        return None, itertools.chain((first,), chunks)
+    
+    def _query_json_chunks(self, query: str, limit: int, batch_size: int) -> Iterator[bytes]:
+        with self._connection() as conn:
+            if not conn:
+                raise ConnectionError("Failed to establish connection")
+            
+            cursor = conn.cursor()
+            cursor.execute(self._with_row_limit(query, limit))
+            columns, decimal_columns = self._result_columns(cursor)
+            records = self._records(columns, decimal_columns, cursor.fetchmany(batch_size))
+            yield (b'{"success":true,"columns":' + _json_bytes(columns)
+                   + b',"preview":' + _json_bytes(records[:10]) + b',"data":[')
+            
+            row_count = 0
+            while records:
+                yield (b"," if row_count else b"") + b",".join(_json_bytes(record) for record in records)
+                row_count += len(records)
+                records = self._records(columns, decimal_columns, cursor.fetchmany(batch_size))
+            yield b'],"row_count":' + str(row_count).encode() + b'}'
+    
+    @staticmethod
+    def _with_row_limit(query: str, limit: int) -> str:
+        """Add a TOP clause to the first SELECT if the query has no row limit"""
+        if _ROW_LIMIT_RE.search(query):
+            return query
+        # For SQL Server/Fabric, use TOP
+        return _SELECT_RE.sub(f"SELECT TOP {limit}", query, count=1)
+    
+    @staticmethod
+    def _result_columns(cursor) -> Tuple[List[str], List[str]]:
+        """Column names of the current result set, and those holding DECIMAL/NUMERIC values"""
+        columns = [column[0] for column in cursor.description]
+        decimal_columns = [column[0] for column in cursor.description if column[1] is Decimal]
+        return columns, decimal_columns
+    
+    @staticmethod
+    def _records(columns: List[str], decimal_columns: List[str], rows) -> List[Dict]:
+        """Rows as dicts; Decimals become floats, as pandas' read_sql used to return them"""
+        data = [dict(zip(columns, row)) for row in rows]
+        if decimal_columns:
+            for record in data:
+                for name in decimal_columns:
+                    if record[name] is not None:
+                        record[name] = float(record[name])
+        return data
+    
     def get_sample_data(self, table_name: str, limit: int = 5) -> Dict:
         """Get sample data from a table"""
         query = f"SELECT TOP {limit} * FROM {table_name}"
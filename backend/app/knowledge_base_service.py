@@ -3,90 +3,242 @@ import json
 from typing import Dict, List, Optional, Any, Set, Tuple
 from datetime import datetime
 import pyodbc
-from difflib import SequenceMatcher
 import hashlib
 import re
 import time
 import math
-from collections import Counter
+from collections import Counter, defaultdict
+from functools import lru_cache
 
 from app.fabric_service import fabric_service
 
 logger = logging.getLogger(__name__)
 
+# Words dropped when normalizing a question for hashing and fuzzy search
+_QUESTION_STOP_WORDS = frozenset({
+    'the', 'a', 'an', 'and', 'or', 'but', 'in', 'on', 'at', 'to', 'for',
+    'of', 'with', 'by', 'from', 'up', 'about', 'into', 'through', 'during',
+    'how', 'what', 'when', 'where', 'which', 'who', 'whom', 'this', 'that',
+    'these', 'those', 'am', 'is', 'are', 'was', 'were', 'be', 'been', 'being',
+    'have', 'has', 'had', 'do', 'does', 'did', 'will', 'would', 'should',
+    'could', 'may', 'might', 'must', 'can', 'shall', 'me', 'my', 'give'
+})
+# Same list minus the question words, which carry intent for feature matching
+_TOKEN_STOP_WORDS = _QUESTION_STOP_WORDS - {'how', 'what', 'when', 'where', 'which', 'who', 'whom'}
+_WORD_RE = re.compile(r'\b\w+\b')
+# Common business phrase patterns. Scanned one by one rather than as a single
+# alternation: phrases overlap ("total sales" / "sales by month")
+_PHRASE_PATTERNS = tuple(re.compile(pattern, re.IGNORECASE) for pattern in (
+    r'sales by \w+',
+    r'total \w+',
+    r'top \d+ \w+',
+    r'average \w+',
+    r'count of \w+',
+    r'\w+ by month',
+    r'\w+ by year',
+    r'\w+ by category',
+    r'last \w+ \w+',
+    r'current \w+',
+    r'\w+ trends?',
+    r'\w+ performance',
+    r'\w+ analysis'
+))
+
+def _index_keywords(groups: Dict[str, Set[str]]) -> Dict[str, Tuple[str, ...]]:
+    """Map each keyword to the feature buckets it belongs to (some words are in several)"""
+    index: Dict[str, Tuple[str, ...]] = {}
+    for bucket, keywords in groups.items():
+        for keyword in keywords:
+            index[keyword] = index.get(keyword, ()) + (bucket,)
+    return index
+
+_KEYWORD_FEATURES = _index_keywords({
+    # Business entities
+    'entities': {
+        'sales', 'revenue', 'profit', 'income', 'cost', 'expense', 'margin',
+        'customer', 'client', 'user', 'account', 'contact',
+        'product', 'item', 'sku', 'inventory', 'stock',
+        'order', 'transaction', 'purchase', 'payment', 'invoice',
+        'region', 'territory', 'country', 'state', 'city', 'location',
+        'category', 'type', 'group', 'segment', 'division',
+        'employee', 'staff', 'person', 'team', 'department'
+    },
+
+    # Operations and actions
+    'operations': {
+        'show', 'display', 'list', 'get', 'find', 'search', 'lookup',
+        'count', 'sum', 'total', 'average', 'mean', 'max', 'min',
+        'compare', 'analyze', 'calculate', 'compute', 'measure',
+        'filter', 'where', 'having', 'group', 'sort', 'order'
+    },
+
+    # Time references
+    'time_references': {
+        'today', 'yesterday', 'tomorrow', 'week', 'month', 'year', 'quarter',
+        'daily', 'weekly', 'monthly', 'yearly', 'annual', 'quarterly',
+        'current', 'last', 'previous', 'next', 'recent', 'latest',
+        'january', 'february', 'march', 'april', 'may', 'june',
+        'july', 'august', 'september', 'october', 'november', 'december',
+        '2023', '2024', '2025'
+    },
+
+    # Aggregation terms
+    'aggregation_terms': {
+        'total', 'sum', 'count', 'average', 'mean', 'median', 'mode',
+        'max', 'maximum', 'min', 'minimum', 'highest', 'lowest',
+        'top', 'bottom', 'best', 'worst', 'most', 'least'
+    },
+
+    # Comparison terms
+    'comparison_terms': {
+        'greater', 'less', 'more', 'fewer', 'above', 'below', 'over', 'under',
+        'between', 'within', 'outside', 'equals', 'different', 'same',
+        'versus', 'vs', 'compared', 'against', 'than'
+    }
+})
+_NON_WORD_RE = re.compile(r'[^\w]')
+# Weighted combination of similarity scores
+_SIMILARITY_WEIGHTS = {
+    'intent': 0.25,      # Intent is very important
+    'entities': 0.25,    # Business entities are crucial
+    'operations': 0.20,  # Operations matter for understanding
+    'text': 0.15,        # Text similarity is still relevant
+    'structure': 0.10,   # Question structure helps
+    'phrases': 0.05      # Key phrases provide context
+}
+# Some intents are related; keyed both ways round
+_RELATED_INTENTS = {
+    ('RETRIEVE', 'FILTER'): 0.7,
+    ('COUNT', 'SUM'): 0.6,
+    ('TOP', 'BOTTOM'): 0.5,
+    ('AVERAGE', 'SUM'): 0.6,
+    ('COMPARE', 'TREND'): 0.5
+}
+_RELATED_INTENTS.update({(i2, i1): score for (i1, i2), score in list(_RELATED_INTENTS.items())})
+# Most rows the term index hands to SQL as an id list; past this the LIKE filters are cheaper
+_MAX_INDEXED_IDS = 500
+
+try:
+    import orjson
+
+    def _load_metadata(raw: Optional[str]) -> Dict:
+        """Parse a stored metadata column"""
+        if not raw:
+            return {}
+        try:
+            return orjson.loads(raw)
+        except orjson.JSONDecodeError:
+            # json.dumps writes NaN/Infinity for float metadata, which orjson refuses
+            return json.loads(raw)
+except ImportError:
+    def _load_metadata(raw: Optional[str]) -> Dict:
+        """Parse a stored metadata column"""
+        return json.loads(raw or "{}")
+
+try:
+    # Native normalized Indel ratio: difflib's 2 * matches / total, with matches from an exact LCS
+    from rapidfuzz import fuzz, process
+
+    def _text_similarity(text1: str, text2: str) -> float:
+        """Similarity between two normalized questions, from 0.0 to 1.0"""
+        return fuzz.ratio(text1, text2) / 100
+
+    def _best_matches(query: str, choices: Dict[Any, str], threshold: float,
+                      limit: int) -> List[Tuple[Any, float]]:
+        """(key, similarity) for the choices scoring at least threshold, best first"""
+        matches = process.extract(query, choices, scorer=fuzz.ratio,
+                                  score_cutoff=threshold * 100, limit=limit)
+        return [(key, score / 100) for _, score, key in matches]
+except ImportError:
+    from difflib import SequenceMatcher
+
+    def _text_similarity(text1: str, text2: str) -> float:
+        """Similarity between two normalized questions, from 0.0 to 1.0"""
+        return SequenceMatcher(None, text1, text2).ratio()
+
+    def _best_matches(query: str, choices: Dict[Any, str], threshold: float,
+                      limit: int) -> List[Tuple[Any, float]]:
+        """(key, similarity) for the choices scoring at least threshold, best first"""
+        scored = [(key, _text_similarity(query, text)) for key, text in choices.items() if text]
+        matches = [match for match in scored if match[1] >= threshold]
+        matches.sort(key=lambda match: match[1], reverse=True)
+        return matches[:limit]
+
 class KnowledgeBaseService:
     def __init__(self):
         self.table_name = "dbo.ChatKnowledgeBase"
         self.cache = {}  # In-memory cache
         self.cache_ttl = 3600  # 1 hour
+        # Trigram index over question_normalized + context, standing in for LIKE '%term%' scans:
+        # (built at, {id: (category, text)}, {trigram: ids}); rebuilt after inserts/deletes
+        self._term_index: Optional[Tuple[float, Dict[Any, Tuple[str, str]], Dict[str, Set[Any]]]] = None
         
     def _get_connection(self):
-        """Get connection to knowledge base (using same Fabric connection)"""
-        return fabric_service._connect_with_token()
+        """Connection to knowledge base for a with block (from the Fabric connection pool)"""
+        return fabric_service._connection()
     
     def initialize_knowledge_base(self) -> Dict:
         """Create knowledge base table if it doesn't exist"""
         try:
-            conn = self._get_connection()
-            if not conn:
-                return {"success": False, "error": "No database connection"}
+            with self._get_connection() as conn:
+                if not conn:
+                    return {"success": False, "error": "No database connection"}
+                    
+                cursor = conn.cursor()
                 
-            cursor = conn.cursor()
-            
-            # Drop existing table if schema needs update
-            drop_sql = f"""
-            IF EXISTS (SELECT * FROM sys.tables WHERE name = 'ChatKnowledgeBase')
-            BEGIN
-                -- Check if columns match expected schema
-                IF NOT EXISTS (
-                    SELECT * FROM sys.columns 
-                    WHERE object_id = OBJECT_ID('{self.table_name}') 
-                    AND name = 'query_hash'
-                )
+                # Drop existing table if schema needs update
+                drop_sql = f"""
+                IF EXISTS (SELECT * FROM sys.tables WHERE name = 'ChatKnowledgeBase')
                 BEGIN
-                    DROP TABLE {self.table_name}
+                    -- Check if columns match expected schema
+                    IF NOT EXISTS (
+                        SELECT * FROM sys.columns 
+                        WHERE object_id = OBJECT_ID('{self.table_name}') 
+                        AND name = 'query_hash'
+                    )
+                    BEGIN
+                        DROP TABLE {self.table_name}
+                    END
                 END
-            END
-            """
-            cursor.execute(drop_sql)
-            
-            # Create table with enhanced schema
-            create_table_sql = f"""
-            IF NOT EXISTS (SELECT * FROM sys.tables WHERE name = 'ChatKnowledgeBase')
-            CREATE TABLE {self.table_name} (
-                id INT IDENTITY(1,1) PRIMARY KEY,
-                category NVARCHAR(100),
-                question NVARCHAR(MAX),
-                question_normalized NVARCHAR(MAX),
-                query_hash NVARCHAR(64),
-                context NVARCHAR(MAX),
-                sql_query NVARCHAR(MAX),
-                dax_query NVARCHAR(MAX),
-                answer NVARCHAR(MAX),
-                response_type NVARCHAR(50),
-                metadata NVARCHAR(MAX),
-                success_count INT DEFAULT 1,
-                failure_count INT DEFAULT 0,
-                last_used DATETIME DEFAULT GETDATE(),
-                created_at DATETIME DEFAULT GETDATE(),
-                updated_at DATETIME DEFAULT GETDATE(),
-                INDEX idx_query_hash (query_hash),
-                INDEX idx_category (category),
-                INDEX idx_last_used (last_used)
-            )
-            """
-            
-            cursor.execute(create_table_sql)
-            conn.commit()
-            
-            # Create similarity function if not exists
-            self._create_similarity_function(cursor)
-            
-            conn.close()
-            
-            logger.info("Knowledge base table initialized successfully")
-            return {"success": True, "message": "Knowledge base initialized"}
-            
+                """
+                cursor.execute(drop_sql)
+                
+                # Create table with enhanced schema
+                create_table_sql = f"""
+                IF NOT EXISTS (SELECT * FROM sys.tables WHERE name = 'ChatKnowledgeBase')
+                CREATE TABLE {self.table_name} (
+                    id INT IDENTITY(1,1) PRIMARY KEY,
+                    category NVARCHAR(100),
+                    question NVARCHAR(MAX),
+                    question_normalized NVARCHAR(MAX),
+                    query_hash NVARCHAR(64),
+                    context NVARCHAR(MAX),
+                    sql_query NVARCHAR(MAX),
+                    dax_query NVARCHAR(MAX),
+                    answer NVARCHAR(MAX),
+                    response_type NVARCHAR(50),
+                    metadata NVARCHAR(MAX),
+                    success_count INT DEFAULT 1,
+                    failure_count INT DEFAULT 0,
+                    last_used DATETIME DEFAULT GETDATE(),
+                    created_at DATETIME DEFAULT GETDATE(),
+                    updated_at DATETIME DEFAULT GETDATE(),
+                    INDEX idx_query_hash (query_hash),
+                    INDEX idx_category (category),
+                    INDEX idx_last_used (last_used)
+                )
+                """
+                
+                cursor.execute(create_table_sql)
+                conn.commit()
+                
+                # Create similarity function if not exists
+                self._create_similarity_function(cursor)
+                self._term_index = None
+                
+                logger.info("Knowledge base table initialized successfully")
+                return {"success": True, "message": "Knowledge base initialized"}
+                
         except Exception as e:
             logger.error(f"Failed to initialize knowledge base: {e}")
             return {"success": False, "error": str(e)}
@@ -100,124 +252,110 @@ class KnowledgeBaseService:
         except:
             pass
     
-    def _normalize_question(self, question: str) -> str:
+    @staticmethod
+    @lru_cache(maxsize=4096)
+    def _normalize_question(question: str) -> str:
         """Normalize question for better matching"""
-        # Convert to lowercase
-        normalized = question.lower().strip()
-        
-        # Remove common words
-        stop_words = {
-            'the', 'a', 'an', 'and', 'or', 'but', 'in', 'on', 'at', 'to', 'for',
-            'of', 'with', 'by', 'from', 'up', 'about', 'into', 'through', 'during',
-            'how', 'what', 'when', 'where', 'which', 'who', 'whom', 'this', 'that',
-            'these', 'those', 'am', 'is', 'are', 'was', 'were', 'be', 'been', 'being',
-            'have', 'has', 'had', 'do', 'does', 'did', 'will', 'would', 'should',
-            'could', 'may', 'might', 'must', 'can', 'shall', 'me', 'my', 'give'
-        }
-        
-        words = normalized.split()
-        words = [w for w in words if w not in stop_words]
-        
-        # Sort words to handle different word orders
-        words.sort()
-        
-        return ' '.join(words)
+        # Lowercase, remove common words, and sort to handle different word orders.
+        # Split on whitespace only: punctuation stays, so hashes of stored rows still match
+        return ' '.join(sorted(w for w in question.lower().split() if w not in _QUESTION_STOP_WORDS))
     
-    def _calculate_hash(self, question: str, category: str) -> str:
+    @staticmethod
+    @lru_cache(maxsize=4096)
+    def _calculate_hash(question: str, category: str) -> str:
         """Calculate hash for question + category"""
-        normalized = self._normalize_question(question)
+        # Stays SHA-256: query_hash is persisted, so another algorithm would orphan stored rows
+        normalized = KnowledgeBaseService._normalize_question(question)
         combined = f"{category}:{normalized}"
         return hashlib.sha256(combined.encode()).hexdigest()
     
     def add_knowledge(self, knowledge: Dict) -> Dict:
         """Add new knowledge entry with deduplication"""
         try:
-            conn = self._get_connection()
-            if not conn:
-                return {"success": False, "error": "No database connection"}
-                
-            cursor = conn.cursor()
-            
-            # Normalize and hash
-            question = knowledge.get("question", "")
-            category = knowledge.get("category", "general")
-            normalized = self._normalize_question(question)
-            query_hash = self._calculate_hash(question, category)
-            
-            # Check if similar entry exists
-            check_sql = f"""
-            SELECT id, success_count, failure_count
-            FROM {self.table_name}
-            WHERE query_hash = ? AND category = ?
-            """
-            
-            cursor.execute(check_sql, (query_hash, category))
-            existing = cursor.fetchone()
-            
-            if existing:
-                # Update existing entry
-                update_sql = f"""
-                UPDATE {self.table_name}
-                SET answer = ?,
-                    sql_query = ?,
-                    dax_query = ?,
-                    metadata = ?,
-                    success_count = success_count + 1,
-                    last_used = GETDATE(),
-                    updated_at = GETDATE()
-                WHERE id = ?
-                """
-                
-                cursor.execute(update_sql, (
-                    knowledge.get("answer"),
-                    knowledge.get("sql_query"),
-                    knowledge.get("dax_query"),
-                    json.dumps(knowledge.get("metadata", {})),
-                    existing[0]
-                ))
-                
-                conn.commit()
-                conn.close()
-                
-                logger.info(f"Updated existing knowledge entry: {existing[0]}")
-                return {"success": True, "id": existing[0], "action": "updated"}
-            
-            else:
-                # Insert new entry
-                insert_sql = f"""
-                INSERT INTO {self.table_name} 
-                (category, question, question_normalized, query_hash, context, 
-                 sql_query, dax_query, answer, response_type, metadata)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                """
-                
-                cursor.execute(insert_sql, (
-                    category,
-                    question,
-                    normalized,
-                    query_hash,
-                    knowledge.get("context"),
-                    knowledge.get("sql_query"),
-                    knowledge.get("dax_query"),
-                    knowledge.get("answer"),
-                    knowledge.get("response_type", "text"),
-                    json.dumps(knowledge.get("metadata", {}))
-                ))
-                
+            with self._get_connection() as conn:
+                if not conn:
+                    return {"success": False, "error": "No database connection"}
+                    
+                cursor = conn.cursor()
+                knowledge_id, action = self._upsert_knowledge(cursor, knowledge)
                 conn.commit()
-                knowledge_id = cursor.lastrowid
-                conn.close()
-                
-                # Clear cache
-                self.cache.clear()
-                
-                logger.info(f"Added new knowledge entry: {knowledge_id}")
-                return {"success": True, "id": knowledge_id, "action": "created"}
                 
+                if action == "created":
+                    # Clear cache
+                    self.cache.clear()
+                    self._index_new_row(knowledge_id, knowledge)
+                    logger.info(f"Added new knowledge entry: {knowledge_id}")
+                else:
+                    logger.info(f"Updated existing knowledge entry: {knowledge_id}")
+                return {"success": True, "id": knowledge_id, "action": action}
+                    
         except Exception as e:
             logger.error(f"Failed to add knowledge: {e}")
             return {"success": False, "error": str(e)}
     
+    def _upsert_knowledge(self, cursor, knowledge: Dict) -> Tuple[Any, str]:
+        """Insert an entry, or update the one with the same hash; returns (id, action)"""
+        # Normalize and hash
+        question = knowledge.get("question", "")
+        category = knowledge.get("category", "general")
+        normalized = self._normalize_question(question)
+        query_hash = self._calculate_hash(question, category)
+        
+        # Check if similar entry exists
+        check_sql = f"""
+        SELECT id, success_count, failure_count
+        FROM {self.table_name}
+        WHERE query_hash = ? AND category = ?
+        """
+        
+        cursor.execute(check_sql, (query_hash, category))
+        existing = cursor.fetchone()
+        
+        if existing:
+            # Update existing entry
+            update_sql = f"""
+            UPDATE {self.table_name}
+            SET answer = ?,
+                sql_query = ?,
+                dax_query = ?,
+                metadata = ?,
+                success_count = success_count + 1,
+                last_used = GETDATE(),
+                updated_at = GETDATE()
+            WHERE id = ?
+            """
+            
+            cursor.execute(update_sql, (
+                knowledge.get("answer"),
+                knowledge.get("sql_query"),
+                knowledge.get("dax_query"),
+                json.dumps(knowledge.get("metadata", {})),
+                existing[0]
+            ))
+            return existing[0], "updated"
+        
+        # Insert new entry
+        insert_sql = f"""
+        INSERT INTO {self.table_name} 
+        (category, question, question_normalized, query_hash, context, 
+         sql_query, dax_query, answer, response_type, metadata)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """
+        
+        cursor.execute(insert_sql, (
+            category,
+            question,
+            normalized,
+            query_hash,
+            knowledge.get("context"),
+            knowledge.get("sql_query"),
+            knowledge.get("dax_query"),
+            knowledge.get("answer"),
+            knowledge.get("response_type", "text"),
+            json.dumps(knowledge.get("metadata", {}))
+        ))
+        return cursor.lastrowid, "created"
+    
     def search_knowledge(self, query: str, category: Optional[str] = None, 
                          threshold: float = 0.7) -> List[Dict]:
         """Search knowledge base with similarity matching"""
@@ -229,103 +367,162 @@ class KnowledgeBaseService:
                 if datetime.now().timestamp() - cached['timestamp'] < self.cache_ttl:
                     return cached['results']
             
-            conn = self._get_connection()
-            if not conn:
-                return []
+            with self._get_connection() as conn:
+                if not conn:
+                    return []
+                    
+                cursor = conn.cursor()
                 
-            cursor = conn.cursor()
-            
-            # Normalize query
-            normalized_query = self._normalize_question(query)
-            
-            # First try exact hash match
-            query_hash = self._calculate_hash(query, category or "general")
-            
-            exact_sql = f"""
-            SELECT TOP 1
-                id, category, question, context, sql_query, dax_query, 
-                answer, response_type, metadata, success_count, created_at
-            FROM {self.table_name}
-            WHERE query_hash = ?
-            """
-            
-            params = [query_hash]
-            if category:
-                exact_sql += " AND category = ?"
-                params.append(category)
-            
-            cursor.execute(exact_sql, params)
-            exact_match = cursor.fetchone()
-            
-            if exact_match:
-                # Update last used
-                update_sql = f"UPDATE {self.table_name} SET last_used = GETDATE() WHERE id = ?"
-                cursor.execute(update_sql, (exact_match[0],))
-                conn.commit()
+                # Normalize query
+                normalized_query = self._normalize_question(query)
                 
-                results = [self._row_to_dict(exact_match)]
-            else:
-                # Fuzzy search
-                search_sql = f"""
-                SELECT TOP 10
+                # First try exact hash match
+                query_hash = self._calculate_hash(query, category or "general")
+                
+                exact_sql = f"""
+                SELECT TOP 1
                     id, category, question, context, sql_query, dax_query, 
-                    answer, response_type, metadata, success_count, created_at,
-                    question_normalized
+                    answer, response_type, metadata, success_count, created_at
                 FROM {self.table_name}
-                WHERE 1=1
+                WHERE query_hash = ?
                 """
                 
-                params = []
-                
+                params = [query_hash]
                 if category:
-                    search_sql += " AND category = ?"
+                    exact_sql += " AND category = ?"
                     params.append(category)
                 
-                # Add text search conditions
-                search_terms = normalized_query.split()
-                for term in search_terms[:5]:  # Limit to first 5 terms
-                    search_sql += " AND (question_normalized LIKE ? OR context LIKE ?)"
-                    params.extend([f"%{term}%", f"%{term}%"])
-                
-                search_sql += " ORDER BY success_count DESC, last_used DESC"
+                cursor.execute(exact_sql, params)
+                exact_match = cursor.fetchone()
                 
-                cursor.execute(search_sql, params)
-                
-                # Calculate similarity scores
-                results = []
-                for row in cursor.fetchall():
-                    # Calculate similarity
-                    similarity = self._calculate_similarity(
-                        normalized_query,
-                        row[11]  # question_normalized
-                    )
+                if exact_match:
+                    # Update last used
+                    update_sql = f"UPDATE {self.table_name} SET last_used = GETDATE() WHERE id = ?"
+                    cursor.execute(update_sql, (exact_match[0],))
+                    conn.commit()
+                    
+                    results = [self._row_to_dict(exact_match)]
+                else:
+                    # Fuzzy search
+                    search_sql = f"""
+                    SELECT TOP 10
+                        id, category, question, context, sql_query, dax_query, 
+                        answer, response_type, metadata, success_count, created_at,
+                        question_normalized
+                    FROM {self.table_name}
+                    WHERE 1=1
+                    """
+                    
+                    params = []
+                    
+                    if category:
+                        search_sql += " AND category = ?"
+                        params.append(category)
+                    
+                    # Add text search conditions
+                    search_terms = normalized_query.split()[:5]  # Limit to first 5 terms
+                    term_sql, term_params = self._term_filter(cursor, search_terms, category)
+                    search_sql += term_sql
+                    params.extend(term_params)
+                    
+                    search_sql += " ORDER BY success_count DESC, last_used DESC"
                     
-                    if similarity >= threshold:
-                        result = self._row_to_dict(row[:11])  # Exclude normalized column
+                    cursor.execute(search_sql, params)
+                    
+                    # Score every candidate against question_normalized in one call, top 5 matches
+                    rows = {row[0]: row for row in cursor.fetchall()}
+                    results = []
+                    for row_id, similarity in _best_matches(
+                            normalized_query, {row_id: row[11] for row_id, row in rows.items()},
+                            threshold, limit=5):
+                        result = self._row_to_dict(rows[row_id][:11])  # Exclude normalized column
                         result['similarity'] = similarity
                         results.append(result)
                 
-                # Sort by similarity
-                results.sort(key=lambda x: x['similarity'], reverse=True)
-                results = results[:5]  # Top 5 matches
-            
-            conn.close()
-            
-            # Cache results
-            self.cache[cache_key] = {
-                'results': results,
-                'timestamp': datetime.now().timestamp()
-            }
-            
-            return results
-            
+                # Cache results
+                self.cache[cache_key] = {
+                    'results': results,
+                    'timestamp': datetime.now().timestamp()
+                }
+                
+                return results
+                
         except Exception as e:
             logger.error(f"Knowledge search failed: {e}")
             return []
             
+    def _term_filter(self, cursor, terms: List[str], category: Optional[str]) -> Tuple[str, List]:
+        """SQL condition (and its params) keeping rows whose question_normalized or context contains every term"""
+        ids = self._matching_ids(cursor, terms, category) if terms else None
+        if ids is None:
+            # Nothing to look up, or too many matches to list: let the database filter
+            return (" AND (question_normalized LIKE ? OR context LIKE ?)" * len(terms),
+                    [f"%{term}%" for term in terms for _ in range(2)])
+        if not ids:
+            return " AND 1=0", []
+        return f" AND id IN ({', '.join('?' * len(ids))})", ids
+    
+    def _matching_ids(self, cursor, terms: List[str], category: Optional[str]) -> Optional[List]:
+        """Ids of rows containing every term, from the trigram index; None past _MAX_INDEXED_IDS"""
+        if self._term_index is None or time.time() - self._term_index[0] >= self.cache_ttl:
+            self._term_index = self._build_term_index(cursor)
+        _, texts, trigrams = self._term_index
+        
+        # Rows holding every trigram of every term, then checked for the terms themselves
+        candidates = None
+        for term in terms:
+            for i in range(len(term) - 2):
+                postings = trigrams.get(term[i:i + 3], set())
+                candidates = postings if candidates is None else candidates & postings
+        if candidates is None:  # Every term is shorter than a trigram
+            candidates = list(texts)  # Snapshot: inserts can land from another thread
+        
+        category = category.lower() if category else None  # The collation is case-insensitive
+        ids = [row_id for row_id in candidates
+               if (not category or texts[row_id][0] == category)
+               and all(term in texts[row_id][1] for term in terms)]
+        return ids if len(ids) <= _MAX_INDEXED_IDS else None
+    
+    def _build_term_index(self, cursor) -> Tuple[float, Dict[Any, Tuple[str, str]], Dict[str, Set[Any]]]:
+        """Load question_normalized and context for every row and index them by trigram"""
+        cursor.execute(f"SELECT id, category, question_normalized, context FROM {self.table_name}")
+        texts = {}
+        trigrams = defaultdict(set)
+        for row_id, category, normalized, context in cursor.fetchall():
+            category, text = self._index_entry(category, normalized, context)
+            texts[row_id] = (category, text)
+            for i in range(len(text) - 2):
+                trigrams[text[i:i + 3]].add(row_id)
+        return time.time(), texts, dict(trigrams)
+    
+    def _index_new_row(self, row_id, knowledge: Dict) -> None:
+        """Add a just-inserted row to the term index instead of reloading the table"""
+        if self._term_index is None:
+            return  # Built on the next search anyway
+        if row_id is None:
+            self._term_index = None  # Can't index a row without its id
+            return
+        _, texts, trigrams = self._term_index
+        category, text = self._index_entry(
+            knowledge.get("category", "general"),
+            self._normalize_question(knowledge.get("question", "")),
+            knowledge.get("context")
+        )
+        # Text first, so a search seeing the id in a posting can look it up. Postings
+        # are replaced, not mutated: searches on other threads may be iterating them
+        texts[row_id] = (category, text)
+        for trigram in {text[i:i + 3] for i in range(len(text) - 2)}:
+            trigrams[trigram] = trigrams.get(trigram, set()) | {row_id}
+    
+    @staticmethod
+    def _index_entry(category: Optional[str], normalized: Optional[str], context: Optional[str]) -> Tuple[str, str]:
+        """(category, searchable text) for one row, lower-cased like the case-insensitive collation"""
+        # Search terms never contain whitespace, so none can match across the join
+        return (category or '').lower(), f"{normalized or ''}\n{context or ''}".lower()
+    
     def _calculate_similarity(self, text1: str, text2: str) -> float:
         """Calculate similarity between two texts"""
-        return SequenceMatcher(None, text1, text2).ratio()
+        return _text_similarity(text1, text2)
 
     def _row_to_dict(self, row: tuple) -> Dict:
         """Convert database row to dictionary"""
@@ -338,7 +535,7 @@ class KnowledgeBaseService:
             "dax_query": row[5],
             "answer": row[6],
             "response_type": row[7],
-            "metadata": json.loads(row[8] or "{}"),
+            "metadata": _load_metadata(row[8]),
             "success_count": row[9],
             "created_at": row[10].isoformat() if row[10] else None
         }
@@ -346,36 +543,35 @@ class KnowledgeBaseService:
     def update_knowledge_feedback(self, knowledge_id: int, success: bool) -> Dict:
         """Update success/failure count based on user feedback"""
         try:
-            conn = self._get_connection()
-            if not conn:
-                return {"success": False, "error": "No database connection"}
-            
-            cursor = conn.cursor()
-            
-            if success:
-                update_sql = f"""
-                UPDATE {self.table_name}
-                SET success_count = success_count + 1,
-                    last_used = GETDATE()
-                WHERE id = ?
-                """
-            else:
-                update_sql = f"""
-                UPDATE {self.table_name}
-                SET failure_count = failure_count + 1,
-                    last_used = GETDATE()
-                WHERE id = ?
-                """
-            
-            cursor.execute(update_sql, (knowledge_id,))
-            conn.commit()
-            conn.close()
-            
-            # Clear cache
-            self.cache.clear()
-            
-            return {"success": True}
-            
+            with self._get_connection() as conn:
+                if not conn:
+                    return {"success": False, "error": "No database connection"}
+                
+                cursor = conn.cursor()
+                
+                if success:
+                    update_sql = f"""
+                    UPDATE {self.table_name}
+                    SET success_count = success_count + 1,
+                        last_used = GETDATE()
+                    WHERE id = ?
+                    """
+                else:
+                    update_sql = f"""
+                    UPDATE {self.table_name}
+                    SET failure_count = failure_count + 1,
+                        last_used = GETDATE()
+                    WHERE id = ?
+                    """
+                
+                cursor.execute(update_sql, (knowledge_id,))
+                conn.commit()
+                
+                # Clear cache
+                self.cache.clear()
+                
+                return {"success": True}
+                
         except Exception as e:
             logger.error(f"Failed to update feedback: {e}")
             return {"success": False, "error": str(e)}
@@ -384,34 +580,33 @@ class KnowledgeBaseService:
                             limit: int = 10) -> List[Dict]:
         """Get most popular/successful queries"""
         try:
-            conn = self._get_connection()
-            if not conn:
-                return []
-            
-            cursor = conn.cursor()
-            
-            sql = f"""
-            SELECT TOP {limit}
-                id, category, question, context, sql_query, dax_query, 
-                answer, response_type, metadata, success_count, created_at
-            FROM {self.table_name}
-            WHERE success_count > 0
-            """
-            
-            if category:
-                sql += " AND category = ? ORDER BY success_count DESC, last_used DESC"
-                cursor.execute(sql, (category,))
-            else:
-                sql += " ORDER BY success_count DESC, last_used DESC"
-                cursor.execute(sql)
-            
-            results = []
-            for row in cursor.fetchall():
-                results.append(self._row_to_dict(row))
-            
-            conn.close()
-            return results
-            
+            with self._get_connection() as conn:
+                if not conn:
+                    return []
+                
+                cursor = conn.cursor()
+                
+                sql = f"""
+                SELECT TOP {limit}
+                    id, category, question, context, sql_query, dax_query, 
+                    answer, response_type, metadata, success_count, created_at
+                FROM {self.table_name}
+                WHERE success_count > 0
+                """
+                
+                if category:
+                    sql += " AND category = ? ORDER BY success_count DESC, last_used DESC"
+                    cursor.execute(sql, (category,))
+                else:
+                    sql += " ORDER BY success_count DESC, last_used DESC"
+                    cursor.execute(sql)
+                
+                results = []
+                for row in cursor.fetchall():
+                    results.append(self._row_to_dict(row))
+                
+                return results
+                
         except Exception as e:
             logger.error(f"Failed to get popular queries: {e}")
             return []
@@ -428,38 +623,38 @@ class KnowledgeBaseService:
                 return cached_result['results']
         
         try:
-            conn = self._get_connection()
-            if not conn:
-                return []
-            
-            # Extract semantic features from the question
-            question_features = self._extract_comprehensive_features(question)
-            
-            # First try exact hash match (fastest)
-            exact_matches = self._find_exact_matches(question, category, conn)
-            if exact_matches:
-                return exact_matches[:3]
-            
-            # Semantic similarity search
-            similar_queries = self._find_semantic_matches(question, question_features, category, conn, threshold)
-            
-            # Cache the results
-            if not hasattr(self, '_search_cache'):
-                self._search_cache = {}
-            
-            self._search_cache[cache_key] = {
-                'results': similar_queries,
-                'timestamp': time.time()
-            }
-            
-            # Limit cache size
-            if len(self._search_cache) > 100:
-                oldest_key = min(self._search_cache.keys(), 
-                                 key=lambda k: self._search_cache[k]['timestamp'])
-                del self._search_cache[oldest_key]
-            
-            return similar_queries
-            
+            with self._get_connection() as conn:
+                if not conn:
+                    return []
+                
+                # Extract semantic features from the question
+                question_features = self._extract_comprehensive_features(question)
+                
+                # First try exact hash match (fastest)
+                exact_matches = self._find_exact_matches(question, category, conn)
+                if exact_matches:
+                    return exact_matches[:3]
+                
+                # Semantic similarity search
+                similar_queries = self._find_semantic_matches(question, question_features, category, conn, threshold)
+                
+                # Cache the results
+                if not hasattr(self, '_search_cache'):
+                    self._search_cache = {}
+                
+                self._search_cache[cache_key] = {
+                    'results': similar_queries,
+                    'timestamp': time.time()
+                }
+                
+                # Limit cache size
+                if len(self._search_cache) > 100:
+                    oldest_key = min(self._search_cache.keys(), 
+                                     key=lambda k: self._search_cache[k]['timestamp'])
+                    del self._search_cache[oldest_key]
+                
+                return similar_queries
+                
         except Exception as e:
             logger.error(f"Enhanced knowledge search failed: {e}")
             return []
@@ -483,64 +678,13 @@ class KnowledgeBaseService:
             'normalized_tokens': self._get_normalized_tokens(question_lower)
         }
         
-        # Business entities
-        business_entities = {
-            'sales', 'revenue', 'profit', 'income', 'cost', 'expense', 'margin',
-            'customer', 'client', 'user', 'account', 'contact',
-            'product', 'item', 'sku', 'inventory', 'stock',
-            'order', 'transaction', 'purchase', 'payment', 'invoice',
-            'region', 'territory', 'country', 'state', 'city', 'location',
-            'category', 'type', 'group', 'segment', 'division',
-            'employee', 'staff', 'person', 'team', 'department'
-        }
-        
-        # Operations and actions
-        operations = {
-            'show', 'display', 'list', 'get', 'find', 'search', 'lookup',
-            'count', 'sum', 'total', 'average', 'mean', 'max', 'min',
-            'compare', 'analyze', 'calculate', 'compute', 'measure',
-            'filter', 'where', 'having', 'group', 'sort', 'order'
-        }
-        
-        # Time references
-        time_references = {
-            'today', 'yesterday', 'tomorrow', 'week', 'month', 'year', 'quarter',
-            'daily', 'weekly', 'monthly', 'yearly', 'annual', 'quarterly',
-            'current', 'last', 'previous', 'next', 'recent', 'latest',
-            'january', 'february', 'march', 'april', 'may', 'june',
-            'july', 'august', 'september', 'october', 'november', 'december',
-            '2023', '2024', '2025'
-        }
-        
-        # Aggregation terms
-        aggregation_terms = {
-            'total', 'sum', 'count', 'average', 'mean', 'median', 'mode',
-            'max', 'maximum', 'min', 'minimum', 'highest', 'lowest',
-            'top', 'bottom', 'best', 'worst', 'most', 'least'
-        }
-        
-        # Comparison terms
-        comparison_terms = {
-            'greater', 'less', 'more', 'fewer', 'above', 'below', 'over', 'under',
-            'between', 'within', 'outside', 'equals', 'different', 'same',
-            'versus', 'vs', 'compared', 'against', 'than'
-        }
-        
         words = question_lower.split()
         for word in words:
-            # Clean word
-            clean_word = re.sub(r'[^\w]', '', word)
+            # Clean word (most are already bare)
+            clean_word = word if word.isalnum() else _NON_WORD_RE.sub('', word)
             
-            if clean_word in business_entities:
-                features['entities'].add(clean_word)
-            if clean_word in operations:
-                features['operations'].add(clean_word)
-            if clean_word in time_references:
-                features['time_references'].add(clean_word)
-            if clean_word in aggregation_terms:
-                features['aggregation_terms'].add(clean_word)
-            if clean_word in comparison_terms:
-                features['comparison_terms'].add(clean_word)
+            for bucket in _KEYWORD_FEATURES.get(clean_word, ()):
+                features[bucket].add(clean_word)
         
         # Extract table hints (words that might be table names)
         potential_tables = [word for word in words if len(word) > 3 and word.isalpha()]
@@ -598,46 +742,16 @@ class KnowledgeBaseService:
     
     def _extract_key_phrases(self, question: str) -> Set[str]:
         """Extract key phrases that preserve meaning"""
-        
-        # Common business phrase patterns
-        phrase_patterns = [
-            r'sales by \w+',
-            r'total \w+',
-            r'top \d+ \w+',
-            r'average \w+',
-            r'count of \w+',
-            r'\w+ by month',
-            r'\w+ by year',
-            r'\w+ by category',
-            r'last \w+ \w+',
-            r'current \w+',
-            r'\w+ trends?',
-            r'\w+ performance',
-            r'\w+ analysis'
-        ]
-        
-        key_phrases = set()
-        for pattern in phrase_patterns:
-            matches = re.findall(pattern, question, re.IGNORECASE)
-            key_phrases.update(match.lower() for match in matches)
-        
-        return key_phrases
+        return {match.lower() for pattern in _PHRASE_PATTERNS for match in pattern.findall(question)}
     
-    def _get_normalized_tokens(self, question: str) -> List[str]:
+    @staticmethod
+    @lru_cache(maxsize=4096)
+    def _get_normalized_tokens(question: str) -> Tuple[str, ...]:
         """Get normalized tokens for text similarity"""
         
         # Remove stop words but keep business-relevant ones
-        stop_words = {
-            'the', 'a', 'an', 'and', 'or', 'but', 'in', 'on', 'at', 'to', 'for',
-            'of', 'with', 'by', 'from', 'up', 'about', 'into', 'through', 'during',
-            'this', 'that', 'these', 'those', 'am', 'is', 'are', 'was', 'were',
-            'be', 'been', 'being', 'have', 'has', 'had', 'do', 'does', 'did',
-            'will', 'would', 'should', 'could', 'may', 'might', 'must', 'can',
-            'shall', 'me', 'my', 'give'
-        }
-        
-        words = re.findall(r'\b\w+\b', question.lower())
-        return [word for word in words if word not in stop_words and len(word) > 2]
+        return tuple(word for word in _WORD_RE.findall(question.lower())
+                     if word not in _TOKEN_STOP_WORDS and len(word) > 2)
     
     def _find_exact_matches(self, question: str, category: Optional[str], connection) -> List[Dict]:
         """Find exact or near-exact matches using hash"""
@@ -706,9 +820,9 @@ class KnowledgeBaseService:
             
             # Add text search conditions for key entities
             key_entities = list(question_features['entities']) + list(question_features['operations'])
-            for entity in key_entities[:3]:  # Limit to first 3 entities
-                sql += " AND (question_normalized LIKE ? OR context LIKE ?)"
-                params.extend([f"%{entity}%", f"%{entity}%"])
+            term_sql, term_params = self._term_filter(cursor, key_entities[:3], category)  # Limit to first 3 entities
+            sql += term_sql
+            params.extend(term_params)
             
             sql += " ORDER BY success_count DESC, last_used DESC"
             
@@ -746,7 +860,7 @@ class KnowledgeBaseService:
         """Calculate comprehensive similarity score using multiple factors"""
         
         # Extract features from candidate
-        candidate_features = self._extract_comprehensive_features(candidate_question)
+        candidate_features = self._candidate_features(candidate_question)
         
         # Calculate different similarity components
         similarity_scores = {
@@ -762,20 +876,17 @@ class KnowledgeBaseService:
         }
         
         # Weighted combination of similarity scores
-        weights = {
-            'intent': 0.25,      # Intent is very important
-            'entities': 0.25,    # Business entities are crucial
-            'operations': 0.20,  # Operations matter for understanding
-            'text': 0.15,        # Text similarity is still relevant
-            'structure': 0.10,   # Question structure helps
-            'phrases': 0.05      # Key phrases provide context
-        }
-        
-        final_score = sum(similarity_scores[component] * weights[component] 
-                          for component in weights.keys())
+        final_score = sum(similarity_scores[component] * weight 
+                          for component, weight in _SIMILARITY_WEIGHTS.items())
         
         return min(final_score, 1.0)  # Cap at 1.0
     
+    @lru_cache(maxsize=1024)
+    def _candidate_features(self, candidate_question: str) -> Dict:
+        """Features of a stored question; the same rows come back search after search.
+        The dict is shared between calls, so it must only be read."""
+        return self._extract_comprehensive_features(candidate_question)
+    
     def _calculate_intent_similarity(self, features1: Dict, features2: Dict) -> float:
         """Calculate similarity of question intents"""
         intent1 = features1['intent']
@@ -784,20 +895,7 @@ class KnowledgeBaseService:
         if intent1 == intent2:
             return 1.0
         
-        # Some intents are related
-        related_intents = {
-            ('RETRIEVE', 'FILTER'): 0.7,
-            ('COUNT', 'SUM'): 0.6,
-            ('TOP', 'BOTTOM'): 0.5,
-            ('AVERAGE', 'SUM'): 0.6,
-            ('COMPARE', 'TREND'): 0.5
-        }
-        
-        for (i1, i2), score in related_intents.items():
-            if (intent1, intent2) == (i1, i2) or (intent1, intent2) == (i2, i1):
-                return score
-        
-        return 0.0
+        return _RELATED_INTENTS.get((intent1, intent2), 0.0)
     
     def _calculate_entity_similarity(self, features1: Dict, features2: Dict) -> float:
         """Calculate similarity of business entities"""
@@ -891,71 +989,70 @@ class KnowledgeBaseService:
     def get_knowledge_analytics(self) -> Dict:
         """Get analytics about the knowledge base performance"""
         try:
-            conn = self._get_connection()
-            if not conn:
-                return {"error": "No database connection"}
-            
-            cursor = conn.cursor()
-            
-            # Basic statistics (Adjusted for T-SQL syntax)
-            stats_sql = f"""
-            SELECT 
-                COUNT(*),
-                COUNT(DISTINCT category),
-                AVG(CAST(success_count AS FLOAT)),
-                MAX(success_count),
-                SUM(CASE WHEN success_count > 5 THEN 1 ELSE 0 END)
-            FROM {self.table_name}
-            """
-            
-            cursor.execute(stats_sql)
-            stats = cursor.fetchone()
-            
-            # Category breakdown
-            category_sql = f"""
-            SELECT category, COUNT(*) as count, AVG(CAST(success_count AS FLOAT)) as avg_success
-            FROM {self.table_name}
-            GROUP BY category
-            ORDER BY count DESC
-            """
-            
-            cursor.execute(category_sql)
-            categories = cursor.fetchall()
-            
-            # Recent performance (Adjusted for T-SQL syntax)
-            recent_sql = f"""
-            SELECT TOP 30
-                CAST(created_at AS DATE) as entry_date,
-                COUNT(*) as queries_added,
-                AVG(CAST(success_count AS FLOAT)) as avg_success
-            FROM {self.table_name}
-            WHERE created_at >= DATEADD(day, -30, GETDATE())
-            GROUP BY CAST(created_at AS DATE)
-            ORDER BY entry_date DESC
-            """
-            
-            cursor.execute(recent_sql)
-            recent_performance = cursor.fetchall()
-            
-            cursor.close()
-            conn.close()
-            
-            return {
-                "total_entries": stats[0] if stats else 0,
-                "unique_categories": stats[1] if stats else 0,
-                "average_success_rate": round(stats[2], 2) if stats and stats[2] else 0,
-                "max_success_rate": stats[3] if stats else 0,
-                "highly_successful_queries": stats[4] if stats else 0,
-                "categories": [
-                    {"name": cat[0], "count": cat[1], "avg_success": round(cat[2], 2) if cat[2] else 0}
-                    for cat in categories
-                ],
-                "recent_performance": [
-                    {"date": perf[0].isoformat(), "queries_added": perf[1], "avg_success": round(perf[2], 2) if perf[2] else 0}
-                    for perf in recent_performance
-                ]
-            }
-            
+            with self._get_connection() as conn:
+                if not conn:
+                    return {"error": "No database connection"}
+                
+                cursor = conn.cursor()
+                
+                # Basic statistics (Adjusted for T-SQL syntax)
+                stats_sql = f"""
+                SELECT 
+                    COUNT(*),
+                    COUNT(DISTINCT category),
+                    AVG(CAST(success_count AS FLOAT)),
+                    MAX(success_count),
+                    SUM(CASE WHEN success_count > 5 THEN 1 ELSE 0 END)
+                FROM {self.table_name}
+                """
+                
+                cursor.execute(stats_sql)
+                stats = cursor.fetchone()
+                
+                # Category breakdown
+                category_sql = f"""
+                SELECT category, COUNT(*) as count, AVG(CAST(success_count AS FLOAT)) as avg_success
+                FROM {self.table_name}
+                GROUP BY category
+                ORDER BY count DESC
+                """
+                
+                cursor.execute(category_sql)
+                categories = cursor.fetchall()
+                
+                # Recent performance (Adjusted for T-SQL syntax)
+                recent_sql = f"""
+                SELECT TOP 30
+                    CAST(created_at AS DATE) as entry_date,
+                    COUNT(*) as queries_added,
+                    AVG(CAST(success_count AS FLOAT)) as avg_success
+                FROM {self.table_name}
+                WHERE created_at >= DATEADD(day, -30, GETDATE())
+                GROUP BY CAST(created_at AS DATE)
+                ORDER BY entry_date DESC
+                """
+                
+                cursor.execute(recent_sql)
+                recent_performance = cursor.fetchall()
+                
+                cursor.close()
+                
+                return {
+                    "total_entries": stats[0] if stats else 0,
+                    "unique_categories": stats[1] if stats else 0,
+                    "average_success_rate": round(stats[2], 2) if stats and stats[2] else 0,
+                    "max_success_rate": stats[3] if stats else 0,
+                    "highly_successful_queries": stats[4] if stats else 0,
+                    "categories": [
+                        {"name": cat[0], "count": cat[1], "avg_success": round(cat[2], 2) if cat[2] else 0}
+                        for cat in categories
+                    ],
+                    "recent_performance": [
+                        {"date": perf[0].isoformat(), "queries_added": perf[1], "avg_success": round(perf[2], 2) if perf[2] else 0}
+                        for perf in recent_performance
+                    ]
+                }
+                
         except Exception as e:
             logger.error(f"Failed to get knowledge analytics: {e}")
             return {"error": str(e)}
@@ -963,31 +1060,31 @@ class KnowledgeBaseService:
     def cleanup_old_entries(self, days: int = 90) -> Dict:
         """Clean up old, unused entries"""
         try:
-            conn = self._get_connection()
-            if not conn:
-                return {"success": False, "error": "No database connection"}
-            
-            cursor = conn.cursor()
-            
-            # Delete entries not used in X days with low success rate
-            delete_sql = f"""
-            DELETE FROM {self.table_name}
-            WHERE last_used < DATEADD(day, -{days}, GETDATE())
-            AND success_count < 3
-            AND failure_count > success_count
-            """
-            
-            cursor.execute(delete_sql)
-            deleted_count = cursor.rowcount
-            
-            conn.commit()
-            conn.close()
-            
-            # Clear cache
-            self.cache.clear()
-            
-            return {"success": True, "deleted": deleted_count}
-            
+            with self._get_connection() as conn:
+                if not conn:
+                    return {"success": False, "error": "No database connection"}
+                
+                cursor = conn.cursor()
+                
+                # Delete entries not used in X days with low success rate
+                delete_sql = f"""
+                DELETE FROM {self.table_name}
+                WHERE last_used < DATEADD(day, -{days}, GETDATE())
+                AND success_count < 3
+                AND failure_count > success_count
+                """
+                
+                cursor.execute(delete_sql)
+                deleted_count = cursor.rowcount
+                
+                conn.commit()
+                
+                # Clear cache
+                self.cache.clear()
+                self._term_index = None
+                
+                return {"success": True, "deleted": deleted_count}
+                
         except Exception as e:
             logger.error(f"Failed to cleanup: {e}")
             return {"success": False, "error": str(e)}
@@ -995,39 +1092,38 @@ class KnowledgeBaseService:
     def get_all_knowledge(self, category: Optional[str] = None) -> List[Dict]:
         """Get all knowledge entries"""
         try:
-            conn = self._get_connection()
-            if not conn:
-                return []
+            with self._get_connection() as conn:
+                if not conn:
+                    return []
+                    
+                cursor = conn.cursor()
+                
+                if category:
+                    sql = f"""
+                    SELECT 
+                        id, category, question, context, sql_query, dax_query, 
+                        answer, response_type, metadata, success_count, created_at
+                    FROM {self.table_name} 
+                    WHERE category = ? 
+                    ORDER BY created_at DESC
+                    """
+                    cursor.execute(sql, (category,))
+                else:
+                    sql = f"""
+                    SELECT 
+                        id, category, question, context, sql_query, dax_query, 
+                        answer, response_type, metadata, success_count, created_at
+                    FROM {self.table_name} 
+                    ORDER BY created_at DESC
+                    """
+                    cursor.execute(sql)
+                
+                results = []
+                for row in cursor.fetchall():
+                    results.append(self._row_to_dict(row))
+                
+                return results
                 
-            cursor = conn.cursor()
-            
-            if category:
-                sql = f"""
-                SELECT 
-                    id, category, question, context, sql_query, dax_query, 
-                    answer, response_type, metadata, success_count, created_at
-                FROM {self.table_name} 
-                WHERE category = ? 
-                ORDER BY created_at DESC
-                """
-                cursor.execute(sql, (category,))
-            else:
-                sql = f"""
-                SELECT 
-                    id, category, question, context, sql_query, dax_query, 
-                    answer, response_type, metadata, success_count, created_at
-                FROM {self.table_name} 
-                ORDER BY created_at DESC
-                """
-                cursor.execute(sql)
-            
-            results = []
-            for row in cursor.fetchall():
-                results.append(self._row_to_dict(row))
-            
-            conn.close()
-            return results
-            
         except Exception as e:
             logger.error(f"Failed to get knowledge: {e}")
             return []
@@ -1061,19 +1157,32 @@ class KnowledgeBaseService:
             imported = 0
             errors = []
             
-            for entry in entries:
-                result = self.add_knowledge(entry)
-                if result.get("success"):
-                    imported += 1
-                else:
-                    errors.append(f"Failed to import: {entry.get('question', 'Unknown')}")
-            
-            return {
-                "success": True,
-                "imported": imported,
-                "errors": errors
-            }
-            
+            # One connection for the whole import; commit per entry so a bad one doesn't undo the rest
+            with self._get_connection() as conn:
+                if not conn:
+                    return {"success": False, "error": "No database connection"}
+                    
+                cursor = conn.cursor()
+                for entry in entries:
+                    try:
+                        self._upsert_knowledge(cursor, entry)
+                        conn.commit()
+                        imported += 1
+                    except Exception as e:
+                        conn.rollback()
+                        logger.error(f"Failed to add knowledge: {e}")
+                        errors.append(f"Failed to import: {entry.get('question', 'Unknown')}")
+                
+                if imported:
+                    self.cache.clear()
+                    self._term_index = None
+                
+                return {
+                    "success": True,
+                    "imported": imported,
+                    "errors": errors
+                }
+                
         except Exception as e:
             logger.error(f"Failed to import knowledge: {e}")
             return {"success": False, "error": str(e)}
@@ -1,6 +1,6 @@
 from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from typing import Optional, Dict
 import os
 import logging
@@ -60,10 +60,20 @@ try:
 except Exception as e:
     logger.info(f"Knowledge base service not available: {e}")
 
+# Error bodies are serialized with orjson when it's installed
+try:
+    import orjson
+
+    def _error_response(status_code: int, content: Dict) -> Response:
+        return Response(orjson.dumps(content, default=str), status_code=status_code, media_type="application/json")
+except ImportError:
+    def _error_response(status_code: int, content: Dict) -> Response:
+        return JSONResponse(status_code=status_code, content=content)
+
 # Error handlers
 @app.exception_handler(HTTPException)
 async def custom_http_exception_handler(request: Request, exc: HTTPException):
-    return JSONResponse(
+    return _error_response(
         status_code=exc.status_code,
         content={
             "error": exc.detail,
@@ -74,7 +84,7 @@ async def custom_http_exception_handler(request: Request, exc: HTTPException):
 @app.exception_handler(Exception)
 async def general_exception_handler(request: Request, exc: Exception):
     logger.error(f"Unexpected error: {str(exc)}")
-    return JSONResponse(
+    return _error_response(
         status_code=500,
         content={
             "error": "Internal server error",
@@ -248,12 +258,13 @@ async def execute_query(body: Dict):
     if not query:
         raise HTTPException(status_code=400, detail="Query is required")
     
-    result = fabric_service.execute_query(query, limit)
+    # Rows are serialized straight from the cursor as they're sent
+    error, chunks = fabric_service.stream_query(query, limit)
     
-    if result.get("success"):
-        return result
+    if error is None:
+        return StreamingResponse(chunks, media_type="application/json")
     else:
-        raise HTTPException(status_code=400, detail=result.get("error", "Query execution failed"))
+        raise HTTPException(status_code=400, detail=error or "Query execution failed")
 
 @app.post("/api/fabric/sample")
 async def get_sample_data(body: Dict):
@@ -752,12 +763,20 @@ async def startup_event():
     logger.info("Chat with Data API starting up...")
     logger.info(f"Claude available: {claude_available}")
     logger.info(f"Multi-agent available: {multi_agent_available}")
+    auth_service.start_token_refresher()
+    enhanced_multi_agent_service.start_cache_cleanup()
     logger.info("API ready to accept requests")
 
 @app.on_event("shutdown")
 async def shutdown_event():
     """Application shutdown event"""
     logger.info("Chat with Data API shutting down...")
+    await enhanced_multi_agent_service.stop_cache_cleanup()
+    await enhanced_multi_agent_service.flush_pending_writes()
+    await auth_service.stop_token_refresher()
+    data_analysis_service.close()
+    if claude_service:
+        await claude_service.close()
 
 if __name__ == "__main__":
     import uvicorn
@@ -1,7 +1,7 @@
 import logging
 from typing import Dict, List, Optional
 import json
-from app.claude_service import claude_service
+from app.claude_service import claude_service, prompt_json
 from app.fabric_service import fabric_service
 from app.auth_service import auth_service
 
@@ -126,7 +126,7 @@ You ran this SQL query:
 {plan.get('sql_query')}
 
 The query returned {len(data)} rows. Here's the data:
-{json.dumps(data[:10], indent=2)}
+{prompt_json(data[:10])}
 
 Please provide a clear, natural language answer to the user's question based on this data."""
 
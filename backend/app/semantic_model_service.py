@@ -77,10 +77,11 @@ class SemanticModelService:
         self.client_id = None
         self.client_secret = None
         
-        # Try to setup ADOMD.NET and pyadomd
+        # ADOMD.NET and pyadomd are loaded on first Power BI use, see _ensure_dependencies
         self.adomd_available = False
         self.pyadomd_available = False
         self.error_message = None
+        self._dependencies_checked = False
         
         # DAX query templates
         self.dax_templates = {
@@ -123,8 +124,16 @@ TOPN(
 )"""
         }
         
-        self._initialize_dependencies()
-        
+    def _ensure_dependencies(self):
+        """Load ADOMD.NET and pyadomd once, the first time a Power BI path needs them.
+
+        Loading the CLR assemblies is slow, so it's kept out of import time;
+        SQL-only deployments never pay for it.
+        """
+        if not self._dependencies_checked:
+            self._dependencies_checked = True
+            self._initialize_dependencies()
+
     def _initialize_dependencies(self):
         """Initialize pyadomd and ADOMD.NET dependencies"""
         try:
@@ -169,6 +178,7 @@ TOPN(
         if not self.xmla_endpoint or not self.dataset_name:
             return {"success": False, "error": "XMLA endpoint and dataset name required"}
         
+        self._ensure_dependencies()
         if not self.pyadomd_available:
             return {
                 "success": False, 
@@ -578,6 +588,7 @@ TOPN(
         if not self.connected:
             return {"success": False, "error": "Not connected to Power BI"}
         
+        self._ensure_dependencies()
         if not self.pyadomd_available:
             return {"success": False, "error": f"pyadomd not available: {self.error_message}"}
         
@@ -1533,6 +1544,7 @@ TOPN(
 
     def get_status(self) -> Dict:
         """Get detailed status information"""
+        self._ensure_dependencies()
         return {
             "connected": self.connected,
             "pyadomd_available": self.pyadomd_available,